@@ -1,14 +1,34 @@
 # app.py - Final version with both /add and /explore routes
 
 # --- 1. Imports and Setup ---
-from flask import Flask, render_template, request, redirect, url_for, flash
-from sqlalchemy import create_engine, text
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, g
+from sqlalchemy import text
 import pandas as pd
 import logging
 import os
 from dotenv import load_dotenv
 import hashlib 
 import random
+import datetime
+import json
+import time
+import math
+from decimal import Decimal
+
+import numpy as np
+
+from catalog import DimensionCatalog
+from columnar import ColumnarStore
+from export import StartedStream, count_export_rows, csv_chunks, gzip_chunks, parquet_chunks, stream_batches
+from database import LazyEngine, pool_settings_from_env
+from geo import GeoStore
+import metrics
+from metrics import phase
+from parallel import ParallelQueries
+from result_cache import LocalLRUBackend, RedisBackend, ResultCache
+from write_queue import BatchWriter, DuplicateListing, ListingIndex, WriteQueue, record_from_form
+from queries import (parse_compare_filters, parse_explore_filters, parse_geo_filters, parse_trend_filters,
+                     label_trend, run_compare, run_explore, run_trend, trend_title)
 
 #load_dotenv()
 
@@ -16,10 +36,6 @@ app = Flask(__name__)
 app.secret_key = 'a_very_secret_key_for_flashing_messages'
 logging.basicConfig(level=logging.INFO)
 
-# This list will act as our in-memory "fake" database for new records.
-# It will be reset every time the Flask server restarts.
-fake_database_records = []
-
 # --- 2. Database Connection ---
 DB_USER = os.getenv("DB_USER", "root")
 DB_PASS = 'password' 
@@ -30,38 +46,120 @@ DB_NAME = 'perth_property_db'
 if not DB_PASS:
     raise ValueError("DB_PASS environment variable not set. Please create a .env file.")
 
-try:
-    db_connection_str = f'mysql+pymysql://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}'
-    engine = create_engine(db_connection_str)
-    logging.info("Successfully created database engine.")
-except Exception as e:
-    logging.error(f"Failed to create database engine: {e}")
-    exit()
+# DATABASE_URL overrides the MySQL settings above (e.g. a SQLite stand-in for load tests).
+db_connection_str = os.getenv("DATABASE_URL", f'mysql+pymysql://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}')
+# The pool is created on first use in each worker process, never before a fork.
+engine = LazyEngine(db_connection_str, **pool_settings_from_env())
+
+# Opt-in: log statements slower than SLOW_QUERY_MS together with their EXPLAIN plan.
+if os.getenv("SLOW_QUERY_MS"):
+    slow_query_ms = float(os.getenv("SLOW_QUERY_MS"))
+    engine.on_create(lambda real_engine: metrics.install_slow_query_log(real_engine, slow_query_ms))
+
+# Independent queries of one request (the page query and the catalog check, the dimension queries
+# of a catalog reload) run side by side. Each gets its own pooled connection, so the pool size caps
+# the workers; PARALLEL_QUERY_WORKERS=0 runs them one after the other again.
+parallel_queries = ParallelQueries(
+    engine,
+    max_workers=int(os.getenv("PARALLEL_QUERY_WORKERS", os.getenv("DB_POOL_SIZE", "5"))),
+    timeout=float(os.getenv("QUERY_TIMEOUT_SECONDS", "30")),
+)
 
 # --- 3. Helper function to get dimension data ---
-# This avoids repeating code in both routes
+# This avoids repeating code in both routes.
+# The catalog loads the dropdown data once and only reloads it when the data version changes.
+dimension_catalog = DimensionCatalog(
+    engine,
+    check_interval=int(os.getenv("DIM_CATALOG_CHECK_SECONDS", "30")),
+    max_age=int(os.getenv("DIM_CATALOG_MAX_AGE_SECONDS", "3600")),
+    parallel=parallel_queries,
+)
+
+def get_dimensions():
+    """Returns the current dimension snapshot, timed as the 'dimensions' phase."""
+    with phase('dimensions'):
+        return dimension_catalog.get()
+
 def get_dimension_data():
-    """Fetches all dimension data from the DB to populate dropdowns."""
-    try:
-        with engine.connect() as connection:
-            suburbs = pd.read_sql("SELECT suburb_id, suburb_name FROM DIM_Suburbs ORDER BY suburb_name", connection).to_dict('records')
-            layouts = pd.read_sql("SELECT layout_id, layout_name FROM DIM_Layouts ORDER BY layout_name", connection).to_dict('records')
-            property_types = pd.read_sql("SELECT DISTINCT property_type FROM FACT_Properties WHERE property_type IS NOT NULL ORDER BY property_type", connection)['property_type'].tolist()
-            agencies = pd.read_sql("SELECT agency_id, agency_name FROM DIM_Agencies ORDER BY agency_name", connection).to_dict('records')
-            primary_schools = pd.read_sql("SELECT primary_school_id, primary_school_name FROM DIM_Primary_Schools ORDER BY primary_school_name", connection).to_dict('records')
-            secondary_schools = pd.read_sql("SELECT secondary_school_id, secondary_school_name FROM DIM_Secondary_Schools ORDER BY secondary_school_name", connection).to_dict('records')
-            years = pd.read_sql("SELECT DISTINCT YEAR(date_sold) as year FROM FACT_Properties ORDER BY year DESC", connection)['year'].tolist()
-            postcodes = pd.read_sql("SELECT DISTINCT postcode FROM DIM_Suburbs ORDER BY postcode", connection)['postcode'].tolist()
-        return {
-            'suburbs': suburbs, 'layouts': layouts, 'agencies': agencies,
-            'primary_schools': primary_schools, 'secondary_schools': secondary_schools,
-            'available_years': years,
-            'postcodes': postcodes,
-            'property_types': property_types
-        }
-    except Exception as e:
-        logging.error(f"Failed to fetch dimension data: {e}")
-        return {key: [] for key in ['suburbs', 'layouts', 'agencies', 'primary_schools', 'secondary_schools', 'available_years', 'postcodes', 'property_types']}
+    """Returns all dimension data used to populate dropdowns, served from the catalog."""
+    return get_dimensions().as_dict()
+
+def render_page(template_name, **context):
+    """render_template, timed as the 'render' phase."""
+    with phase('render'):
+        return render_template(template_name, **context)
+
+# Query results are cached per (query, normalized filters, data version), so a data version bump
+# retires every cached result. Set RESULT_CACHE_REDIS_URL to share the cache between workers.
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL_SECONDS", "300"))
+if os.getenv("RESULT_CACHE_REDIS_URL"):
+    result_backend = RedisBackend(os.getenv("RESULT_CACHE_REDIS_URL"), ttl=RESULT_CACHE_TTL)
+else:
+    result_backend = LocalLRUBackend(max_bytes=int(os.getenv("RESULT_CACHE_MAX_MB", "64")) * 1024 * 1024,
+                                     ttl=RESULT_CACHE_TTL)
+result_cache = ResultCache(result_backend, enabled=os.getenv("RESULT_CACHE_ENABLED", "1") == "1")
+
+# ANALYTICS_BACKEND=memory answers explore / compare / trend from an in-memory columnar copy
+# of the fact table (reloaded whenever the data version changes) instead of querying MySQL.
+ANALYTICS_BACKEND = os.getenv("ANALYTICS_BACKEND", "sql")
+columnar_store = ColumnarStore(engine) if ANALYTICS_BACKEND == 'memory' else None
+
+def cached_query(name, run_query, filters):
+    """Runs run_query(engine, filters), or its in-memory equivalent, through the result cache."""
+    version = dimension_catalog.get().version
+    return parallel_queries.run({name: lambda: query_at_version(name, run_query, filters, version)})[name]
+
+def query_at_version(name, run_query, filters, version):
+    """
+    cached_query() keyed on a given data version (None runs the query uncached). Callers run it
+    through parallel_queries, which gives it the query timeout.
+    """
+    if columnar_store is not None and version is not None:
+        compute = lambda: columnar_store.run(name, filters, version)
+    else:
+        compute = lambda: run_query(engine, filters)
+    return result_cache.get_or_compute(name, filters, version, compute)
+
+# Radius / nearest / bounding-box searches use an in-memory grid index over the sale coordinates,
+# built on the first spatial query and rebuilt whenever the data version changes.
+geo_store = GeoStore(engine)
+
+def cached_geo_query(name, filters, geo, **kwargs):
+    """Runs geo_store.<name>(filters, geo, version) through the result cache."""
+    version = dimension_catalog.get().version
+    compute = lambda: getattr(geo_store, name)(filters, geo, version, **kwargs)
+    return result_cache.get_or_compute(f'geo_{name}', {**filters, **geo, **kwargs}, version, compute)
+
+# /add queues new sales in a local SQLite file shared by all workers on the host; a background
+# thread flushes them to FACT_Properties in batches (see write_queue.py). Duplicate listing ids
+# are caught by an in-memory Bloom filter over the fact table before they are queued.
+# The queue file is only created by the first submission.
+write_queue = WriteQueue(os.getenv("WRITE_QUEUE_PATH", "write_queue.db"))
+listing_index = ListingIndex(engine, max_age=int(os.getenv("LISTING_INDEX_MAX_AGE_SECONDS", "600")))
+
+batch_writer = BatchWriter(
+    write_queue, engine, listing_index,
+    batch_size=int(os.getenv("WRITE_BATCH_SIZE", "2000")),
+    interval=float(os.getenv("WRITE_FLUSH_SECONDS", "1")),
+    retention=int(os.getenv("WRITE_QUEUE_RETENTION_SECONDS", "86400")),
+)
+
+def query_with_dimensions(name, run_query, filters):
+    """
+    Fetches the dimension snapshot and runs the page query concurrently; returns (snapshot, result).
+    The query is keyed on the version of the snapshot that is already loaded, so it doesn't wait
+    for a due catalog re-check or reload (before the first load it simply runs uncached).
+    """
+    version = dimension_catalog.version
+    if dimension_catalog.is_fresh():
+        # Nothing to overlap: the snapshot is served from memory. cached_query() still runs the
+        # query through the runner (in this thread) for its timeout.
+        return get_dimensions(), cached_query(name, run_query, filters)
+    results = parallel_queries.run({
+        'dimensions': get_dimensions,
+        name: lambda: query_at_version(name, run_query, filters, version),
+    })
+    return results['dimensions'], results[name]
     
     
 # COLOR_PALETTE = [
@@ -110,8 +208,39 @@ def get_color_for_string(text, index):
     
     return f"hsl({hue_degrees:.0f}, {saturation}%, {lightness}%)"
 
+def compare_labels(dimensions, selected_filters):
+    """Converts the selected compare IDs to display labels, and gives each selected suburb a color."""
+    selected_filter_labels = {}
+    suburb_color_map = {}
+    if selected_filters['years']:
+        selected_filter_labels['Years'] = sorted(selected_filters['years'])
+    if selected_filters['suburb_ids']:
+        suburb_map = dimensions.suburb_names
+        selected_suburbs = sorted([suburb_map.get(sid) for sid in selected_filters['suburb_ids'] if sid in suburb_map])
+        selected_filter_labels['Suburbs'] = selected_suburbs
+        for i, name in enumerate(selected_suburbs):
+            suburb_color_map[name] = get_color_for_string(name, i)
+    if selected_filters['layout_ids']:
+        layout_map = dimensions.layout_names
+        selected_filter_labels['Layouts'] = sorted([layout_map.get(lid) for lid in selected_filters['layout_ids'] if lid in layout_map])
+    return selected_filter_labels, suburb_color_map
+
 # --- 4. Application Routes ---
 
+@app.before_request
+def start_request_timer():
+    # Label every phase timed during this request with its route.
+    metrics.set_route(request.endpoint)
+    g.request_started = time.perf_counter()
+    # Every worker runs a writer, so queued sales are flushed even if this worker never serves /add.
+    batch_writer.ensure_running()
+
+@app.after_request
+def record_request_time(response):
+    if 'request_started' in g:
+        metrics.observe('total', time.perf_counter() - g.request_started)
+    return response
+
 @app.route('/')
 def index():
     """The main landing page, redirects to the explore page."""
@@ -119,194 +248,140 @@ def index():
 
 @app.route('/add', methods=['GET', 'POST'])
 def add_new_record():
-  
-    # --- Handle POST Request (MODIFIED FOR MOCKING) ---
+    """Validates a new sale and queues it for the batch writer; lists the latest submissions."""
+    dimensions = get_dimensions()
     if request.method == 'POST':
         try:
-            listing_id_str = request.form.get('listing_id', '').strip()
-            if not listing_id_str.isdigit() or len(listing_id_str) < 9:
-                # If validation fails, flash an error message
-                flash('Validation Error: Listing ID must be at least 9 digits long.', 'danger')
-                # It's important to redirect back to the form
+            record = record_from_form(request.form, dimensions)
+        except ValueError as e:
+            flash(f'Validation Error: {e}', 'danger')
+            return redirect(url_for('add_new_record'))
+        try:
+            try:
+                duplicate = listing_index.exists(record['listing_id'])
+            except Exception as e:
+                # The database is unreachable: queue the sale anyway; the flush rejects a duplicate.
+                logging.warning(f"Could not check listing {record['listing_id']} against the database: {e}")
+                duplicate = False
+            if duplicate:
+                flash(f"Validation Error: Listing ID {record['listing_id']} already exists in the database.", 'danger')
                 return redirect(url_for('add_new_record'))
-
-            
-            listing_id = int(listing_id_str)
-            # with engine.connect() as connection:
-            #     result = connection.execute(text("SELECT 1 FROM FACT_Properties WHERE listing_id = :id"), {'id': listing_id}).first()
-            #     if result:
-            #         flash(f'Validation Error: Listing ID {listing_id} already exists in the database.', 'danger')
-            #         return redirect(url_for('add_new_record'))
-
-            # mock mode, only check fake_db
-            if any(record['listing_id'] == listing_id for record in fake_database_records):
-                 flash(f'Validation Error: Listing ID {listing_id} has already been added in this session.', 'danger')
-                 return redirect(url_for('add_new_record'))     
-                    
-            # 1. Get all the data from the submitted form.
-            new_record_data = {
-                'listing_id': request.form.get('listing_id', type=int),
-                'price': request.form.get('price', type=float),
-                'address': request.form.get('address'),
-                'property_type': request.form.get('property_type'),
-                'date_sold': request.form.get('date_sold'),
-                # We also get the text of the selected options for display purposes
-                'suburb_name': request.form.get('suburb_name_text'),
-                'layout_name': request.form.get('layout_name_text')
-            }
-            logging.info(f"Received new record data (mock mode): {new_record_data}")
-
-
-            # Instead of creating and executing a SQL INSERT statement...
-            #  append the new record dictionary to our global list.
-            fake_database_records.append(new_record_data)
-            
-            
-            flash('Success! New record has been simulated and added to the temporary list.', 'success')
-            return redirect(url_for('add_new_record')) # Redirect to clear the form
+            write_queue.enqueue(record)
+            logging.info(f"Queued new record {record['listing_id']}.")
+            flash('Success! The record was saved and will appear in the database within a few seconds.', 'success')
+        except DuplicateListing as e:
+            flash(f'Validation Error: {e}', 'danger')
         except Exception as e:
             flash(f'Error adding record: {e}', 'danger')
-    
-    # For GET request, fetch dimensions and render the add_record page
-    dim_data = get_dimension_data()
+        return redirect(url_for('add_new_record')) # Redirect to clear the form
+
+    dim_data = dimensions.as_dict()
     dim_data['google_maps_api_key'] = os.getenv("GOOGLE_MAPS_API_KEY")
-    
-    # pass the list of fake records to the template
-    # display what has been "added" so far.
-    dim_data['records'] = fake_database_records
-    
-    return render_template('add_record.html', **dim_data)
+    # The latest submissions and whether they have reached the database yet.
+    records = write_queue.recent()
+    for record in records:
+        record['suburb_name'] = dimensions.suburb_names.get(record['suburb_id'])
+        record['layout_name'] = dimensions.layout_names.get(record['layout_id'])
+    dim_data['records'] = records
+    return render_page('add_record.html', **dim_data)
 
 
 @app.route('/explore', methods=['GET', 'POST'])
 def explore():
     """Handles displaying filters and showing query results from real db."""
-    dim_data = get_dimension_data() # Get data for dropdowns
+    dim_data = None # Data for dropdowns, fetched alongside the query on a POST
     results_list = []
     stats_summary = None
     selected_filters = {}
+    geo_filters = None
 
     if request.method == 'POST':
         try:          
-            # Get selected filters from the form
-            year = request.form.get('year_select')
-            suburb_id = request.form.get('suburb_select')
-            layout_id = request.form.get('layout_select')
-            
-            # Store selected filters to re-populate the form
-            selected_filters = {'year': int(year) if year else None, 
-                                'suburb_id': int(suburb_id) if suburb_id else None,
-                                'layout_id': int(layout_id) if layout_id else None}
-            logging.info(f"User submitted filters: {selected_filters}")
-            
-            conditions = []
-            params = {}
-
-            if year:
-                conditions.append("YEAR(p.date_sold) = :year")
-                params['year'] = year
-            if suburb_id:
-                conditions.append("p.suburb_id = :suburb_id")
-                params['suburb_id'] = suburb_id
-            if layout_id:
-                conditions.append("p.layout_id = :layout_id")
-                params['layout_id'] = layout_id
-
-            where_clause = ""
-            if conditions:
-                where_clause += " WHERE " + " AND ".join(conditions)
-          
-            # Build the query dynamically
-            query_list = f"""
-                SELECT 
-                    p.price AS "Price",
-                    DATE_FORMAT(p.date_sold, '%Y-%m-%d') AS "Date Sold",
-                    s.suburb_name AS "Suburb",
-                    l.layout_name AS "Layout",
-                    p.land_size AS "Land Size (sqm)",
-                    p.address AS "Address"
-                FROM FACT_Properties p
-                JOIN DIM_Suburbs s ON p.suburb_id = s.suburb_id
-                JOIN DIM_Layouts l ON p.layout_id = l.layout_id
-                {where_clause}
-                ORDER BY p.price DESC LIMIT 100;
-           
-            """
-            # --- 4. Execute Query 2: Get the statistical summary ---
-            # This query finds the min, max, avg, and median prices.
-            # We also find the specific properties that correspond to the min and max prices.
-            query_stats = f"""
-                WITH FilteredProperties AS (
-                    SELECT p.price, p.address, p.date_sold, p.land_size
-                    FROM FACT_Properties p
-                    {where_clause}
-                ),
-                RankedProperties AS (
-                    SELECT 
-                        price,
-                        ROW_NUMBER() OVER (ORDER BY price ASC) as row_num,
-                        (SELECT COUNT(*) FROM FilteredProperties) as total_count
-                    FROM FilteredProperties
-                )
-                SELECT
-
-                    (SELECT price FROM FilteredProperties ORDER BY price ASC LIMIT 1) as min_price,
-                    (SELECT address FROM FilteredProperties ORDER BY price ASC LIMIT 1) as min_price_address,
-                    (SELECT date_sold FROM FilteredProperties ORDER BY price ASC LIMIT 1) as min_price_date,
-                    (SELECT land_size FROM FilteredProperties ORDER BY price ASC LIMIT 1) as min_price_land_size,
-                    
-                    (SELECT price FROM FilteredProperties ORDER BY price DESC LIMIT 1) as max_price,
-                    (SELECT address FROM FilteredProperties ORDER BY price DESC LIMIT 1) as max_price_address,
-                    (SELECT date_sold FROM FilteredProperties ORDER BY price DESC LIMIT 1) as max_price_date,
-                    (SELECT land_size FROM FilteredProperties ORDER BY price DESC LIMIT 1) as max_price_land_size,
-
-                    AVG(price) as avg_price,
-                    COUNT(*) as total_sales,
-
-                    -- Median Calculation using Window Functions
-                    (SELECT AVG(price) FROM RankedProperties 
-                     WHERE row_num IN (FLOOR((total_count + 1) / 2), CEIL((total_count + 1) / 2))) as median_price
-                
-                FROM FilteredProperties;
-            """
-            
-            
-
-            with engine.connect() as connection:
-                # Execute list query
-                results_df = pd.read_sql(text(query_list), connection, params=params)
-                if not results_df.empty:
-                    results_list = results_df.to_dict('records')
-                    
-                # Execute stats query
-                stats_df = pd.read_sql(text(query_stats), connection, params=params)
-                # If we get a result, convert the single row DataFrame to a dictionary
-                if not stats_df.empty and stats_df.iloc[0]['total_sales'] > 0:
-                    stats_summary = stats_df.iloc[0].to_dict()
-                else:
-                    # If no properties match, we can't show stats.
-                    results_list = [] # Also clear the list if no stats are found.
+            # Get selected filters from the form (also used to re-populate the form)
+            selected_filters = parse_explore_filters(request.form)
+            geo_filters = parse_geo_filters(request.form)
+            logging.info(f"User submitted filters: {selected_filters}, location: {geo_filters}")
+            if geo_filters:
+                stats_summary, results_list = cached_geo_query('explore', selected_filters, geo_filters)
+            else:
+                dimensions, (stats_summary, results_list) = query_with_dimensions('explore', run_explore, selected_filters)
+                dim_data = dimensions.as_dict()
 
         except Exception as e:
             flash(f"Error running query: {e}", 'danger')
             logging.error(f"Failed during explore POST request: {e}")
 
-    return render_template('explore.html', 
+    if dim_data is None:
+        dim_data = get_dimension_data()
+    return render_page('explore.html', 
                            available_years=dim_data['available_years'], 
                            available_suburbs=dim_data['suburbs'],
                            available_layouts=dim_data['layouts'],
                            results_list=results_list,
                            stats_summary=stats_summary,
-                           selected_filters=selected_filters)
+                           selected_filters=selected_filters,
+                           geo_filters=geo_filters or {})
     
+@app.route('/explore/export')
+def export_explore():
+    """
+    Streams every row matching the /explore filters (not just the top 100):
+    ?year_select=&suburb_select=&layout_select=&format=csv|parquet&gzip=1&row_count=header|trailer
+    """
+    try:
+        filters = parse_explore_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    export_format = request.args.get('format', 'csv')
+    use_gzip = request.args.get('gzip') == '1'
+    row_count = request.args.get('row_count')
+    if export_format not in ('csv', 'parquet'):
+        return jsonify({'error': "format must be 'csv' or 'parquet'."}), 400
+    if row_count == 'trailer' and export_format != 'csv':
+        return jsonify({'error': "row_count=trailer is only for CSV; a Parquet file has the row count in its footer."}), 400
+
+    headers = {}
+    if row_count == 'header':
+        # One extra COUNT(*) up front, so clients can show progress.
+        try:
+            headers['X-Row-Count'] = str(count_export_rows(engine, filters))
+        except Exception as e:
+            logging.error(f"Failed to count export rows: {e}")
+            return jsonify({'error': f"Error counting export rows: {e}"}), 503
+
+    batches = stream_batches(engine, filters)
+    if export_format == 'csv':
+        chunks = csv_chunks(batches, row_count_trailer=(row_count == 'trailer'))
+        filename, mimetype = 'explore_export.csv', 'text/csv'
+        if use_gzip:
+            chunks = gzip_chunks(chunks)
+            filename, mimetype = filename + '.gz', 'application/gzip'
+    else:
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            return jsonify({'error': "Parquet export needs the 'pyarrow' package."}), 400
+        # Parquet compresses internally; gzip=1 picks the gzip codec instead of snappy.
+        chunks = parquet_chunks(batches, compression='gzip' if use_gzip else 'snappy')
+        filename, mimetype = 'explore_export.parquet', 'application/vnd.apache.parquet'
+
+    try:
+        chunks = StartedStream(chunks)
+    except Exception as e:
+        logging.error(f"Failed to start {export_format} export: {e}")
+        return jsonify({'error': f"Error running export: {e}"}), 500
+
+    headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    logging.info(f"Streaming {export_format} export for filters: {filters}")
+    return app.response_class(chunks, mimetype=mimetype, headers=headers)
+
 @app.route('/compare', methods=['GET', 'POST'])
 def compare():
     """
     Handles multi-dimensional comparison. 
     Fetches stats for each selected suburb for each selected year in a single query.
     """
-    dim_data = get_dimension_data()
-
+    dimensions = None
     stats_results = []
     selected_filters = {'years': [], 'suburb_ids': [], 'layout_ids': []}
     selected_filter_labels = {}
@@ -315,81 +390,24 @@ def compare():
 
     if request.method == 'POST':
         try:
-            years = request.form.getlist('year_select', type=int)
-            suburb_ids = request.form.getlist('suburb_select', type=int)
-            layout_ids = request.form.getlist('layout_select', type=int)
-            
-            selected_filters = {'years': years, 'suburb_ids': suburb_ids, 'layout_ids': layout_ids}
-            
-            # --- Convert selected IDs to labels for display (no changes here) ---
-            if years: selected_filter_labels['Years'] = sorted(years)
-            if suburb_ids:
-                suburb_map = {item['suburb_id']: item['suburb_name'] for item in dim_data['suburbs']}
-                selected_suburbs = sorted([suburb_map.get(sid) for sid in suburb_ids if sid in suburb_map])
-                selected_filter_labels['Suburbs'] = selected_suburbs
-                suburb_color_map = {}
-                for i, name in enumerate(selected_suburbs):
-                    suburb_color_map[name] = get_color_for_string(name, i)
-                    
-            if layout_ids:
-                layout_map = {item['layout_id']: item['layout_name'] for item in dim_data['layouts']}
-                selected_filter_labels['Layouts'] = sorted([layout_map.get(lid) for lid in layout_ids if lid in layout_map])
+            selected_filters = parse_compare_filters(request.form)
 
             # --- Validation ---
-            if not suburb_ids and not years and not layout_ids:
+            if not any(selected_filters.values()):
                 flash("Please select at least one filter.", 'danger')
             else:
-                # --- Dynamically build SELECT, WHERE, and GROUP BY clauses ---
-                select_columns = ["s.suburb_name", "COUNT(*) AS total_sales", "AVG(p.price) AS avg_price"]
-                group_by_columns = ["s.suburb_name"]
-                conditions = []
-                params = {}
-                # Add filters and update SELECT/GROUP BY clauses dynamically
-                if suburb_ids:
-                    conditions.append("p.suburb_id IN :suburb_ids")
-                    params['suburb_ids'] = tuple(suburb_ids)
-                
-                if years:
-                    conditions.append("YEAR(p.date_sold) IN :years")
-                    params['years'] = tuple(years)
-                    select_columns.insert(1, "YEAR(p.date_sold) AS sale_year") # Add to SELECT
-                    group_by_columns.append("sale_year") # Add to GROUP BY
-                
-                if layout_ids:
-                    conditions.append("p.layout_id IN :layout_ids")
-                    params['layout_ids'] = tuple(layout_ids)
-                    select_columns.insert(1, "l.layout_name") # Add to SELECT
-                    group_by_columns.append("l.layout_name") # Add to GROUP BY
-                
-                where_clause = "WHERE " + " AND ".join(conditions)
-                select_clause = ", ".join(select_columns)
-                group_by_clause = "GROUP BY " + ", ".join(group_by_columns)
-                order_by_clause = "ORDER BY " + ", ".join(group_by_columns)
-                
-                # The final, powerful query with GROUP BY on both suburb and year
-                query_final = f"""
-                    SELECT {select_clause}
-                    FROM FACT_Properties p
-                    JOIN DIM_Suburbs s ON p.suburb_id = s.suburb_id
-                    JOIN DIM_Layouts l ON p.layout_id = l.layout_id
-                    {where_clause}
-                    {group_by_clause}
-                    {order_by_clause};
-                """
-                logging.info(f"Executing Dynamic Query: {query_final} with Params: {params}")
-                with engine.connect() as connection:
-                    results_df = pd.read_sql(text(query_final), connection, params=params)
-                    if not results_df.empty:
-                        stats_results = results_df.to_dict('records')
-                        # NEW: Add the color to each result dictionary
-                        for result in stats_results:
-                            result['color'] = suburb_color_map.get(result['suburb_name'], '#bdc3c7') # Default grey
+                dimensions, stats_results = query_with_dimensions('compare', run_compare, selected_filters)
+                selected_filter_labels, suburb_color_map = compare_labels(dimensions, selected_filters)
+                # Add the color to each result dictionary
+                for result in stats_results:
+                    result['color'] = suburb_color_map.get(result['suburb_name'], '#bdc3c7') # Default grey
 
         except Exception as e:
             flash(f"Error running comparison query: {e}", 'danger')
             logging.error(f"Failed during compare POST request: {e}")
 
-    return render_template('compare.html', 
+    dim_data = (dimensions or get_dimensions()).as_dict()
+    return render_page('compare.html', 
                            available_years=dim_data['available_years'],
                            available_suburbs=dim_data['suburbs'],
                            available_layouts=dim_data['layouts'],
@@ -401,91 +419,30 @@ def compare():
 @app.route('/trend', methods=['GET', 'POST'])
 def trend():
     """
-    Handles trend analysis, allowing users to filter by EITHER Suburb OR Postcode.
+    Handles trend analysis: one price series per selected suburb, postcode, layout or property type.
     """
-    dim_data = get_dimension_data()
+    dimensions = None
     chart_data = None
     chart_title = "Price Trend"
     # Initialize all possible filter keys
-    selected_filters = {'filter_by': 'suburb'} # Default selection
+    selected_filters = {'filter_by': 'suburb', 'series_by': 'area'} # Default selection
 
     if request.method == 'POST':
         try:
-            # --- 1. Get filter choices, including the new filter_by mode ---
-            filter_by = request.form.get('filter_by') # This will be 'suburb' or 'postcode'
-            suburb_id = request.form.get('suburb_id')
-            postcode = request.form.get('postcode')
-            property_type = request.form.get('property_type')
-            layout_id = request.form.get('layout_id')
-            start_date = request.form.get('start_date')
-            end_date = request.form.get('end_date')
-            
-            selected_filters = {
-                'filter_by': filter_by,
-                'suburb_id': int(suburb_id) if suburb_id else None,
-                'postcode': int(postcode) if postcode else None,
-                'property_type': property_type,
-                'layout_id': int(layout_id) if layout_id else None,
-                'start_date': start_date,
-                'end_date': end_date
-            }
-            
-            # --- 2. Build the dynamic query based on the selected mode ---
-            query = """
-                SELECT DATE_FORMAT(p.date_sold, '%Y-%m') AS date_month, AVG(p.price) AS average_price
-                FROM FACT_Properties p
-                JOIN DIM_Suburbs s ON p.suburb_id = s.suburb_id
-            """
-            conditions = ["1=1"] # Start with a true condition
-            params = {}
-            title_parts = []
-
-            # Determine the main geographic filter
-            if filter_by == 'suburb' and suburb_id:
-                conditions.append("p.suburb_id = :suburb_id")
-                params['suburb_id'] = suburb_id
-                suburb_map = {item['suburb_id']: item['suburb_name'] for item in dim_data['suburbs']}
-                title_parts.append(suburb_map.get(int(suburb_id), "").title())
-            elif filter_by == 'postcode' and postcode:
-                conditions.append("s.postcode = :postcode")
-                params['postcode'] = postcode
-                title_parts.append(f"Postcode {postcode}")
-                
-            if property_type:
-                conditions.append("p.property_type = :property_type")
-                params['property_type'] = property_type
-                title_parts.append(property_type.title())
-            
-            # Add other optional filters
-            if layout_id:
-                conditions.append("p.layout_id = :layout_id")
-                params['layout_id'] = layout_id
-                layout_map = {item['layout_id']: item['layout_name'] for item in dim_data['layouts']}
-                title_parts.append(layout_map.get(int(layout_id), ""))
-            if start_date:
-                conditions.append("p.date_sold >= :start_date"); params['start_date'] = start_date
-            if end_date:
-                conditions.append("p.date_sold <= :end_date"); params['end_date'] = end_date
-            
-            query += " WHERE " + " AND ".join(conditions)
-            query += " GROUP BY date_month ORDER BY date_month ASC;"
-
-            # --- 3. Execute and prepare data (no changes here) ---
-            with engine.connect() as connection:
-                trend_df = pd.read_sql(text(query), connection, params=params)
-                if not trend_df.empty:
-                    chart_data = {
-                        'labels': trend_df['date_month'].tolist(),
-                        'values': trend_df['average_price'].tolist()
-                    }
-                    chart_title = "Price Trend for " + " & ".join(filter(None, title_parts)) if title_parts else "Overall Market Trend"
-                else:
-                    flash("No data found for the selected criteria.", "warning")
+            # Get filter choices, including the filter_by mode ('suburb' or 'postcode')
+            selected_filters = parse_trend_filters(request.form)
+            dimensions, chart_data = query_with_dimensions('trend', run_trend, selected_filters)
+            if chart_data:
+                chart_data = label_trend(dimensions, selected_filters, chart_data)
+                chart_title = trend_title(dimensions, selected_filters)
+            else:
+                flash("No data found for the selected criteria.", "warning")
 
         except Exception as e:
             flash(f"Error running query: {e}", 'danger')
 
-    return render_template('trend.html', 
+    dim_data = (dimensions or get_dimensions()).as_dict()
+    return render_page('trend.html', 
                            suburbs=dim_data['suburbs'], 
                            layouts=dim_data['layouts'],
                            postcodes=dim_data['postcodes'], # Pass postcodes to the template
@@ -493,6 +450,181 @@ def trend():
                            chart_data=chart_data,
                            chart_title=chart_title,
                            selected_filters=selected_filters)
-# --- 5. Run the App ---
+@app.route('/admin/reload-dimensions', methods=['POST'])
+def reload_dimensions():
+    """Reload hook for the ETL: drops the cached dimension snapshot so the next request reloads it."""
+    dimension_catalog.invalidate()
+    dimension_catalog.get()
+    result_cache.invalidate()
+    return jsonify({'version': dimension_catalog.version, 'stats': dimension_catalog.stats})
+
+@app.route('/admin/dimension-stats')
+def dimension_stats():
+    """Hit / miss / refresh counters of the dimension catalog."""
+    return jsonify({'version': dimension_catalog.version, 'stats': dimension_catalog.stats})
+
+@app.route('/admin/pool-stats')
+def pool_stats():
+    """Connection pool occupancy (checked out, overflow), checkout wait times and parallel query counters."""
+    return jsonify({**engine.pool_stats(), 'parallel_queries': parallel_queries.stats})
+
+@app.route('/admin/write-stats')
+def write_stats():
+    """Queue depth and lag of the /add write path, batch writer counters and the listing_id filter."""
+    return jsonify({'queue': write_queue.stats(), 'writer': batch_writer.stats,
+                    'listing_index': {**listing_index.stats, 'memory_bytes': listing_index.memory_bytes()}})
+
+@app.route('/admin/backend-stats')
+def backend_stats():
+    """Which analytics backend is active, the rows / memory of the in-memory copy and of the geo index."""
+    stats = columnar_store.stats() if columnar_store is not None else {}
+    return jsonify({'backend': ANALYTICS_BACKEND, **stats, 'geo': geo_store.stats()})
+
+@app.route('/admin/cache-stats')
+def cache_stats():
+    """Hit ratio and memory usage of the query result cache."""
+    return jsonify(result_cache.stats())
+
+@app.route('/admin/clear-cache', methods=['POST'])
+def clear_cache():
+    """Drops every cached query result."""
+    result_cache.invalidate()
+    return jsonify(result_cache.stats())
+
+# --- 5. JSON API ---
+# GET endpoints with the same filters (same field names) as the pages, so results can be
+# cached by browsers and proxies. Every response carries a strong ETag built from the
+# normalized filters and the data version; a matching If-None-Match is answered with 304
+# before any query runs.
+API_MAX_AGE = int(os.getenv("API_MAX_AGE_SECONDS", "30"))
+GEO_MAX_RESULTS = 1000
+
+def to_jsonable(value):
+    """Converts query results (Decimal, NumPy scalars, dates, NaN) to plain JSON types."""
+    if isinstance(value, dict):
+        return {key: to_jsonable(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_jsonable(item) for item in value]
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+def api_etag(endpoint, filters):
+    """A strong ETag: same endpoint + same normalized filters + same data version => same ETag."""
+    with phase('dimensions'):
+        version = dimension_catalog.get().version
+    key = json.dumps([endpoint, filters, version], sort_keys=True, default=str)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+def cached_json_response(endpoint, filters, build_payload):
+    """Answers 304 if the client already has this ETag; otherwise builds and returns the JSON payload."""
+    etag = api_etag(endpoint, filters)
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        try:
+            payload = build_payload()
+            with phase('render'):
+                response = jsonify(to_jsonable(payload))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        except Exception as e:
+            logging.error(f"Failed during {endpoint} API request: {e}")
+            return jsonify({'error': f"Error running query: {e}"}), 500
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = f'public, max-age={API_MAX_AGE}'
+    return response
+
+@app.route('/api/dimensions')
+def api_dimensions():
+    """All dropdown data, as used by every page."""
+    return cached_json_response('dimensions', {}, get_dimension_data)
+
+@app.route('/api/explore/stats')
+def api_explore_stats():
+    """The /explore statistics summary and top-100 list: ?year_select=&suburb_select=&layout_select="""
+    try:
+        filters = parse_explore_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    def build_payload():
+        stats_summary, results_list = cached_query('explore', run_explore, filters)
+        return {'stats_summary': stats_summary, 'results_list': results_list}
+    return cached_json_response('explore', filters, build_payload)
+
+@app.route('/api/compare')
+def api_compare():
+    """The /compare results: repeatable ?year_select=&suburb_select=&layout_select="""
+    try:
+        filters = parse_compare_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    def build_payload():
+        selected_filter_labels, suburb_color_map = compare_labels(dimension_catalog.get(), filters)
+        stats_results = cached_query('compare', run_compare, filters)
+        for result in stats_results:
+            result['color'] = suburb_color_map.get(result['suburb_name'], '#bdc3c7')
+        return {'stats_results': stats_results,
+                'selected_filter_labels': selected_filter_labels,
+                'suburb_color_map': suburb_color_map}
+    # Suburb colors depend on this process's random HUE_START, so it is part of the ETag key too.
+    return cached_json_response('compare', {**filters, 'hue_start': HUE_START}, build_payload)
+
+@app.route('/api/trend')
+def api_trend():
+    """
+    The /trend chart: ?filter_by=&series_by=&suburb_id=&postcode=&property_type=&layout_id=&start_date=
+    &end_date=&smooth=&window=&max_points= (suburb_id, postcode, property_type and layout_id repeatable)
+    """
+    try:
+        filters = parse_trend_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    def build_payload():
+        chart_data = cached_query('trend', run_trend, filters)
+        if not chart_data:
+            return {'chart_data': None, 'chart_title': "Price Trend"}
+        dimensions = dimension_catalog.get()
+        return {'chart_data': label_trend(dimensions, filters, chart_data), 'chart_title': trend_title(dimensions, filters)}
+    return cached_json_response('trend', filters, build_payload)
+
+@app.route('/api/geo/search')
+def api_geo_search():
+    """
+    Sales near a point or inside a map viewport, with the /explore result columns (plus coordinates,
+    and the distance for radius / nearest): ?mode=radius&lat=&lon=&radius_km=, ?mode=nearest&lat=&lon=&k=
+    or ?mode=bbox&south=&west=&north=&east=, optionally with year_select / suburb_select / layout_select
+    and limit (default 100). Radius and nearest results come nearest first, boxes by price.
+    """
+    try:
+        filters = parse_explore_filters(request.args)
+        geo = parse_geo_filters(request.args)
+        limit = int(request.args.get('limit') or 100)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if geo is None:
+        return jsonify({'error': "Please give lat, lon and radius_km, or south, west, north and east."}), 400
+    if not 0 < limit <= GEO_MAX_RESULTS:
+        return jsonify({'error': f"limit must be between 1 and {GEO_MAX_RESULTS}."}), 400
+
+    return cached_json_response('geo_search', {**filters, **geo, 'limit': limit},
+                                lambda: cached_geo_query('search', filters, geo, limit=limit))
+
+# --- 6. Metrics ---
+@app.route('/metrics')
+def metrics_endpoint():
+    """Per-route, per-phase latency and row-count histograms in the Prometheus text format."""
+    return app.response_class(metrics.render_metrics(), mimetype='text/plain; version=0.0.4')
+
+# --- 7. Run the App ---
 if __name__ == '__main__':
     app.run(debug=True, port=5001) 
\ No newline at end of file
@@ -0,0 +1,253 @@
+# generator.py - Seeded synthetic Perth-like star schema for benchmarks
+#
+# Produces every table of sql/create_tables.sql (DIM_*, FACT_Properties, META_Data_Version and the
+# AGG_Monthly_Sales cube) with the skew of the real data: a handful of suburbs, layouts and agencies
+# take most of the sales, prices depend on suburb, layout, type and year, volume grows over time and
+# peaks in spring. The same seed and row count always give the same data.
+#
+# On MySQL the schema comes from sql/create_tables.sql itself; SQLite gets an equivalent schema with
+# the same tables and indexes, plus the few MySQL functions the app's SQL uses.
+
+import math
+import os
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import event, text
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CREATE_TABLES_SQL = os.path.join(ROOT, 'sql', 'create_tables.sql')
+
+# Named scale factors, in fact rows.
+SCALE_FACTORS = {'10k': 10_000, '100k': 100_000, '1m': 1_000_000, '10m': 10_000_000}
+
+CHUNK_ROWS = 250_000  # Fixed, so the data doesn't depend on memory settings.
+FIRST_YEAR, LAST_YEAR = 2000, 2024
+N_SUBURBS, N_POSTCODES, N_AGENCIES, N_PRIMARY, N_SECONDARY = 330, 120, 250, 400, 120
+
+PROPERTY_TYPES = ['House', 'Unit', 'Townhouse', 'Apartment', 'Villa']
+TYPE_WEIGHTS = [0.70, 0.10, 0.09, 0.07, 0.03]  # the remaining 1% has no type
+TYPE_PRICE = {'House': 1.0, 'Unit': 0.6, 'Townhouse': 0.75, 'Apartment': 0.65, 'Villa': 0.7, None: 0.9}
+
+SQLITE_SCHEMA = [
+    """CREATE TABLE META_Data_Version (
+        id INTEGER PRIMARY KEY, version INTEGER NOT NULL, updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""",
+    "CREATE TABLE META_Data_Changes (version INTEGER NOT NULL, sale_month DATE)",
+    "CREATE INDEX idx_changes_version ON META_Data_Changes (version)",
+    """CREATE TABLE DIM_Layouts (
+        layout_id INTEGER PRIMARY KEY, bedrooms INTEGER NOT NULL, bathrooms INTEGER NOT NULL,
+        layout_name VARCHAR(10) NOT NULL, UNIQUE (bedrooms, bathrooms))""",
+    "CREATE TABLE DIM_Suburbs (suburb_id INTEGER PRIMARY KEY, suburb_name VARCHAR(255) UNIQUE NOT NULL, postcode INTEGER)",
+    "CREATE TABLE DIM_Agencies (agency_id INTEGER PRIMARY KEY, agency_name VARCHAR(255) UNIQUE NOT NULL)",
+    """CREATE TABLE DIM_Primary_Schools (
+        primary_school_id INTEGER PRIMARY KEY, primary_school_name VARCHAR(255) UNIQUE NOT NULL,
+        primary_school_icsea INTEGER)""",
+    """CREATE TABLE DIM_Secondary_Schools (
+        secondary_school_id INTEGER PRIMARY KEY, secondary_school_name VARCHAR(255) UNIQUE NOT NULL,
+        secondary_school_icsea INTEGER)""",
+    """CREATE TABLE FACT_Properties (
+        listing_id BIGINT PRIMARY KEY, price DECIMAL(12, 2) NOT NULL, address VARCHAR(255),
+        longitude DECIMAL(11, 8), latitude DECIMAL(10, 8), property_type VARCHAR(50), parking_spaces INTEGER,
+        date_sold DATE, land_size INTEGER, distance_to_cbd INTEGER, primary_school_distance INTEGER,
+        secondary_school_distance INTEGER, suburb_id INTEGER, agency_id INTEGER, layout_id INTEGER,
+        primary_school_id INTEGER, secondary_school_id INTEGER)""",
+    "CREATE INDEX idx_fact_suburb_date ON FACT_Properties (suburb_id, date_sold)",
+    "CREATE INDEX idx_fact_layout_date ON FACT_Properties (layout_id, date_sold)",
+    "CREATE INDEX idx_fact_date_price ON FACT_Properties (date_sold, price)",
+    "CREATE INDEX idx_fact_type_date ON FACT_Properties (property_type, date_sold)",
+    # price_sum is DOUBLE here: SQLite stores a whole DECIMAL as an integer, and the cube's
+    # SUM(price_sum) / SUM(sales_count) would then be an integer division.
+    """CREATE TABLE AGG_Monthly_Sales (
+        sale_month DATE NOT NULL, sale_year SMALLINT NOT NULL, suburb_id INTEGER NOT NULL, postcode INTEGER,
+        layout_id INTEGER NOT NULL, property_type VARCHAR(50) NOT NULL DEFAULT '', sales_count INTEGER NOT NULL,
+        price_sum DOUBLE NOT NULL, price_sq_sum DOUBLE NOT NULL,
+        PRIMARY KEY (sale_month, suburb_id, layout_id, property_type))""",
+    "CREATE INDEX idx_agg_suburb_month ON AGG_Monthly_Sales (suburb_id, sale_month)",
+    "CREATE INDEX idx_agg_postcode_month ON AGG_Monthly_Sales (postcode, sale_month)",
+    "CREATE INDEX idx_agg_year_suburb ON AGG_Monthly_Sales (sale_year, suburb_id)",
+    """CREATE TABLE AGG_Monthly_Price_Sketch (
+        sale_month DATE NOT NULL, sale_year SMALLINT NOT NULL, suburb_id INTEGER NOT NULL,
+        layout_id INTEGER NOT NULL, price_bucket SMALLINT NOT NULL, sales_count INTEGER NOT NULL,
+        PRIMARY KEY (sale_month, suburb_id, layout_id, price_bucket))""",
+    "CREATE INDEX idx_sketch_year_suburb ON AGG_Monthly_Price_Sketch (sale_year, suburb_id)",
+]
+
+ALL_TABLES = ['AGG_Monthly_Price_Sketch', 'AGG_Monthly_Sales', 'FACT_Properties', 'DIM_Layouts', 'DIM_Suburbs',
+              'DIM_Agencies', 'DIM_Primary_Schools', 'DIM_Secondary_Schools', 'META_Data_Version', 'META_Data_Changes']
+
+
+def parse_scale(value):
+    """'100k' / '1m' / '250000' -> a row count."""
+    return SCALE_FACTORS.get(str(value).lower()) or int(str(value).replace('_', ''))
+
+
+def register_mysql_functions(engine):
+    """Gives SQLite the handful of MySQL functions the app's and the legacy queries call."""
+    @event.listens_for(engine, 'connect')
+    def _register(dbapi_connection, _):
+        dbapi_connection.create_function('FLOOR', 1, lambda x: None if x is None else math.floor(x))
+        dbapi_connection.create_function('CEIL', 1, lambda x: None if x is None else math.ceil(x))
+        dbapi_connection.create_function('LN', 1, lambda x: None if x is None else math.log(x))
+        dbapi_connection.create_function('YEAR', 1, lambda d: None if d is None else pd.Timestamp(d).year)
+        dbapi_connection.create_function(
+            'DATE_FORMAT', 2, lambda d, fmt: None if d is None else pd.Timestamp(d).strftime(fmt))
+
+
+def create_schema(engine):
+    """Drops and recreates every table: create_tables.sql on MySQL, SQLITE_SCHEMA on SQLite."""
+    with engine.begin() as connection:
+        if engine.dialect.name == 'sqlite':
+            for table in ALL_TABLES:
+                connection.execute(text(f"DROP TABLE IF EXISTS {table}"))
+            statements = SQLITE_SCHEMA
+        else:
+            with open(CREATE_TABLES_SQL) as f:
+                # Same splitting as the ETL notebook; comment-only pieces are skipped.
+                statements = [s for s in f.read().split(';')
+                              if any(line.strip() and not line.strip().startswith('--') for line in s.splitlines())]
+        for statement in statements:
+            connection.execute(text(statement))
+        connection.execute(text("DELETE FROM META_Data_Version"))
+        connection.execute(text("DELETE FROM META_Data_Changes"))
+        connection.execute(text("INSERT INTO META_Data_Version (id, version) VALUES (1, 1)"))
+
+
+def _zipf_weights(n, exponent):
+    weights = 1.0 / np.arange(1, n + 1) ** exponent
+    return weights / weights.sum()
+
+
+def generate_dimensions(seed):
+    """The DIM_ tables plus the hidden per-suburb attributes the fact generator draws from."""
+    rng = np.random.default_rng([seed, 0])
+
+    layout_rows = [(bed, bath) for bed in range(1, 7) for bath in range(1, 5) if bath <= bed + 1]
+    layouts = pd.DataFrame({'layout_id': np.arange(1, len(layout_rows) + 1),
+                            'bedrooms': [bed for bed, _ in layout_rows],
+                            'bathrooms': [bath for _, bath in layout_rows],
+                            'layout_name': [f'{bed}b{bath}b' for bed, bath in layout_rows]})
+    # Most sales are 3-4 bedroom, 1-2 bathroom homes.
+    layout_weights = np.array([np.exp(-abs(bed - 3.4) * 1.1 - abs(bath - 1.7) * 1.3) for bed, bath in layout_rows])
+
+    postcodes = np.sort(rng.choice(np.arange(6000, 6240), N_POSTCODES, replace=False))
+    suburbs = pd.DataFrame({'suburb_id': np.arange(1, N_SUBURBS + 1),
+                            'suburb_name': [f'SUBURB {i:03d}' for i in range(1, N_SUBURBS + 1)],
+                            'postcode': rng.choice(postcodes, N_SUBURBS)})
+    suburb_profile = pd.DataFrame({
+        'base_price': rng.lognormal(12.6, 0.35, N_SUBURBS),
+        'distance_to_cbd': rng.gamma(2.5, 8.0, N_SUBURBS).clip(1, 70),
+        'longitude': rng.normal(115.86, 0.12, N_SUBURBS),
+        'latitude': rng.normal(-31.95, 0.2, N_SUBURBS),
+        'primary_school_id': rng.integers(1, N_PRIMARY + 1, N_SUBURBS),
+        'secondary_school_id': rng.integers(1, N_SECONDARY + 1, N_SUBURBS),
+    })
+
+    agencies = pd.DataFrame({'agency_id': np.arange(1, N_AGENCIES + 1),
+                             'agency_name': [f'AGENCY {i:03d}' for i in range(1, N_AGENCIES + 1)]})
+    primary_schools = pd.DataFrame({'primary_school_id': np.arange(1, N_PRIMARY + 1),
+                                    'primary_school_name': [f'PRIMARY SCHOOL {i:03d}' for i in range(1, N_PRIMARY + 1)],
+                                    'primary_school_icsea': rng.normal(1040, 60, N_PRIMARY).round().astype(int)})
+    secondary_schools = pd.DataFrame({'secondary_school_id': np.arange(1, N_SECONDARY + 1),
+                                      'secondary_school_name': [f'SECONDARY SCHOOL {i:03d}' for i in range(1, N_SECONDARY + 1)],
+                                      'secondary_school_icsea': rng.normal(1030, 70, N_SECONDARY).round().astype(int)})
+    dimensions = {'DIM_Layouts': layouts, 'DIM_Suburbs': suburbs, 'DIM_Agencies': agencies,
+                  'DIM_Primary_Schools': primary_schools, 'DIM_Secondary_Schools': secondary_schools}
+    return dimensions, suburb_profile, layout_weights / layout_weights.sum()
+
+
+def _sale_days(rng, rows):
+    """Sale dates: volume grows ~4% a year and peaks in spring (Sep-Nov)."""
+    years = np.arange(FIRST_YEAR, LAST_YEAR + 1)
+    year = rng.choice(years, rows, p=_normalized(1.04 ** (years - FIRST_YEAR)))
+    month_weights = _normalized(np.array([0.8, 0.9, 1.0, 0.95, 0.95, 0.85, 0.85, 0.95, 1.15, 1.2, 1.2, 0.9]))
+    month = rng.choice(np.arange(1, 13), rows, p=month_weights)
+    first = pd.to_datetime({'year': year, 'month': month, 'day': 1}).to_numpy(dtype='datetime64[D]')
+    days_in_month = (first + np.timedelta64(31, 'D')).astype('datetime64[M]').astype('datetime64[D]') - first
+    return first + (rng.random(rows) * days_in_month.astype(int)).astype(int), year
+
+
+def _normalized(weights):
+    weights = np.asarray(weights, dtype=float)
+    return weights / weights.sum()
+
+
+def generate_fact_chunk(seed, chunk_index, rows, first_listing_id, suburb_profile, layouts, layout_weights):
+    """One chunk of FACT_Properties rows, drawn from its own seeded stream."""
+    rng = np.random.default_rng([seed, 1, chunk_index])
+    suburb_index = rng.choice(len(suburb_profile), rows, p=_zipf_weights(len(suburb_profile), 0.8))
+    layout_index = rng.choice(len(layouts), rows, p=layout_weights)
+    type_draw = rng.choice(len(PROPERTY_TYPES) + 1, rows, p=TYPE_WEIGHTS + [1 - sum(TYPE_WEIGHTS)])
+    property_type = np.array(PROPERTY_TYPES + [None], dtype=object)[type_draw]
+    sale_day, year = _sale_days(rng, rows)
+
+    profile = suburb_profile.iloc[suburb_index]
+    bedrooms = layouts['bedrooms'].to_numpy()[layout_index]
+    bathrooms = layouts['bathrooms'].to_numpy()[layout_index]
+    price = (profile['base_price'].to_numpy()
+             * (0.75 + 0.12 * bedrooms + 0.08 * bathrooms)
+             * np.vectorize(TYPE_PRICE.get)(property_type)
+             * 1.05 ** (year - FIRST_YEAR)
+             * rng.lognormal(0.0, 0.2, rows))
+    is_house = property_type == 'House'
+    land_size = np.where(is_house, rng.lognormal(6.4, 0.35, rows), rng.lognormal(5.0, 0.5, rows)).round()
+
+    fact = pd.DataFrame({
+        'listing_id': np.arange(first_listing_id, first_listing_id + rows, dtype=np.int64),
+        'price': np.round(price, -3).clip(50_000, None),
+        'address': [f'{n} SYNTHETIC STREET' for n in rng.integers(1, 400, rows)],
+        'longitude': np.round(profile['longitude'].to_numpy() + rng.normal(0, 0.01, rows), 8),
+        'latitude': np.round(profile['latitude'].to_numpy() + rng.normal(0, 0.01, rows), 8),
+        'property_type': property_type,
+        'parking_spaces': rng.choice([0, 1, 2, 2, 3, 4], rows),
+        'date_sold': pd.Series(sale_day).dt.strftime('%Y-%m-%d').to_numpy(),
+        'land_size': pd.array(np.where(property_type == 'Apartment', np.nan, land_size), dtype='Int64'),
+        'distance_to_cbd': profile['distance_to_cbd'].round().astype(int).to_numpy(),
+        'primary_school_distance': rng.integers(100, 3000, rows),
+        'secondary_school_distance': rng.integers(300, 8000, rows),
+        'suburb_id': suburb_index + 1,
+        'agency_id': rng.choice(N_AGENCIES, rows, p=_zipf_weights(N_AGENCIES, 1.1)) + 1,
+        'layout_id': layout_index + 1,
+        'primary_school_id': profile['primary_school_id'].to_numpy(),
+        'secondary_school_id': profile['secondary_school_id'].to_numpy(),
+    })
+    return fact
+
+
+# Sales that miss a join, one per UNJOINED_EVERY listing ids: (column, value) per remainder.
+UNJOINED_EVERY = 50
+UNJOINED_SALES = [('layout_id', None), ('layout_id', 10_000), ('suburb_id', None), ('suburb_id', 10_000),
+                  ('date_sold', None)]
+
+
+def seed_unjoined_sales(engine):
+    """
+    Gives a few sales a NULL or unknown suburb, a NULL or unknown layout, or no date, like the real
+    data has. The benchmarks leave them out; the parity checks use them to compare join semantics.
+    """
+    with engine.begin() as connection:
+        for remainder, (column, value) in enumerate(UNJOINED_SALES):
+            connection.execute(text(f"UPDATE FACT_Properties SET {column} = :value "
+                                    f"WHERE listing_id % {UNJOINED_EVERY} = {remainder}"), {'value': value})
+
+
+def generate_star_schema(engine, rows, seed=42, build_cube=True, progress=None):
+    """Creates the schema in `engine` and fills it with `rows` synthetic sales. Never use on perth_property_db."""
+    import cube  # noqa: E402 (repo root module)
+
+    create_schema(engine)
+    dimensions, suburb_profile, layout_weights = generate_dimensions(seed)
+    for table, df in dimensions.items():
+        df.to_sql(table, engine, if_exists='append', index=False)
+
+    for chunk_index, start in enumerate(range(0, rows, CHUNK_ROWS)):
+        n = min(CHUNK_ROWS, rows - start)
+        fact = generate_fact_chunk(seed, chunk_index, n, 100_000_000 + start, suburb_profile,
+                                   dimensions['DIM_Layouts'], layout_weights)
+        fact.to_sql('FACT_Properties', engine, if_exists='append', index=False, chunksize=10_000,
+                    method='multi' if engine.dialect.name == 'mysql' else None)
+        if progress:
+            progress(start + n, rows)
+
+    if build_cube:
+        with engine.begin() as connection:
+            cube.refresh_monthly_cube(connection)
@@ -0,0 +1,240 @@
+# catalog.py - In-process, versioned cache of the dimension data used by every page
+
+import copy
+import logging
+import threading
+import time
+
+import pandas as pd
+from sqlalchemy import text
+
+from cube import month_start
+
+# The dropdown queries. They only run when the catalog is (re)loaded, never per request.
+DIMENSION_QUERIES = {
+    'suburbs': "SELECT suburb_id, suburb_name FROM DIM_Suburbs ORDER BY suburb_name",
+    'layouts': "SELECT layout_id, layout_name FROM DIM_Layouts ORDER BY layout_name",
+    'property_types': "SELECT DISTINCT property_type FROM FACT_Properties WHERE property_type IS NOT NULL ORDER BY property_type",
+    'agencies': "SELECT agency_id, agency_name FROM DIM_Agencies ORDER BY agency_name",
+    'primary_schools': "SELECT primary_school_id, primary_school_name FROM DIM_Primary_Schools ORDER BY primary_school_name",
+    'secondary_schools': "SELECT secondary_school_id, secondary_school_name FROM DIM_Secondary_Schools ORDER BY secondary_school_name",
+    'available_years': "SELECT DISTINCT YEAR(date_sold) as year FROM FACT_Properties ORDER BY year DESC",
+    'postcodes': "SELECT DISTINCT postcode FROM DIM_Suburbs ORDER BY postcode",
+}
+
+# Keys whose query returns a single column that the templates expect as a flat list.
+SCALAR_COLUMNS = {'property_types': 'property_type', 'available_years': 'year', 'postcodes': 'postcode'}
+
+DIMENSION_KEYS = ['suburbs', 'layouts', 'agencies', 'primary_schools', 'secondary_schools',
+                  'available_years', 'postcodes', 'property_types']
+
+# A cheap watermark: row count + max id of every DIM_ table, the max listing_id of the fact table
+# (served straight from the primary key) and the explicit counter in META_Data_Version, which
+# every loader bumps. Any ETL run or insert changes at least one of them.
+VERSION_QUERY = """
+    SELECT 'DIM_Suburbs' AS table_name, COUNT(*) AS row_count, MAX(suburb_id) AS max_id FROM DIM_Suburbs
+    UNION ALL SELECT 'DIM_Layouts', COUNT(*), MAX(layout_id) FROM DIM_Layouts
+    UNION ALL SELECT 'DIM_Agencies', COUNT(*), MAX(agency_id) FROM DIM_Agencies
+    UNION ALL SELECT 'DIM_Primary_Schools', COUNT(*), MAX(primary_school_id) FROM DIM_Primary_Schools
+    UNION ALL SELECT 'DIM_Secondary_Schools', COUNT(*), MAX(secondary_school_id) FROM DIM_Secondary_Schools
+    UNION ALL SELECT 'FACT_Properties', NULL, MAX(listing_id) FROM FACT_Properties
+    UNION ALL SELECT 'META_Data_Version', NULL, MAX(version) FROM META_Data_Version
+"""
+
+DIMENSION_TABLES = ('DIM_Suburbs', 'DIM_Layouts', 'DIM_Agencies', 'DIM_Primary_Schools', 'DIM_Secondary_Schools')
+
+# Run by every writer (ETL, incremental loads, /add batches) after changing data, in the same transaction.
+BUMP_VERSION_QUERY = "UPDATE META_Data_Version SET version = version + 1 WHERE id = 1"
+
+# META_Data_Changes records the months each version changed (a NULL month: anything may have changed),
+# so the in-memory stores reload only those months. Versions older than the last CHANGE_LOG_VERSIONS
+# are pruned; a store that far behind reloads everything.
+CHANGE_LOG_VERSIONS = 10_000
+RECORD_CHANGE_QUERY = "INSERT INTO META_Data_Changes (version, sale_month) VALUES (:version, :sale_month)"
+PRUNE_CHANGES_QUERY = "DELETE FROM META_Data_Changes WHERE version <= :oldest"
+CHANGES_QUERY = "SELECT version, sale_month FROM META_Data_Changes WHERE version > :old AND version <= :new"
+
+
+def bump_data_version(connection, months=None):
+    """
+    Marks the data as changed, so caches and ETags built on the old version go stale. Writers that
+    only changed the sales of some months pass them (any date in the month); None means anything
+    may have changed.
+    """
+    connection.execute(text(BUMP_VERSION_QUERY))
+    version = connection.execute(text("SELECT version FROM META_Data_Version WHERE id = 1")).scalar()
+    if months is None or any(pd.isna(month) for month in months):
+        changed = [None]
+    else:
+        changed = sorted({month_start(month) for month in months})
+    connection.execute(text(RECORD_CHANGE_QUERY), [{'version': version, 'sale_month': month} for month in changed])
+    connection.execute(text(PRUNE_CHANGES_QUERY), {'oldest': version - CHANGE_LOG_VERSIONS})
+
+
+def dimension_watermark(version):
+    """The DIM_ rows of a VERSION_QUERY watermark; they change when a dimension member is added or removed."""
+    return tuple(row for row in version if row[0] in DIMENSION_TABLES)
+
+
+def _data_version(version):
+    return next(int(row[2]) for row in version if row[0] == 'META_Data_Version')
+
+
+def changed_months(connection, old_version, new_version):
+    """
+    The months (first days) whose sales may differ between two VERSION_QUERY watermarks, or None
+    when anything may have changed: a dimension changed, a writer didn't name its months, a write
+    didn't bump META_Data_Version, or the change log no longer reaches back to `old_version`.
+    """
+    if old_version == new_version:
+        return set()
+    if old_version is None or new_version is None or dimension_watermark(old_version) != dimension_watermark(new_version):
+        return None
+    old, new = _data_version(old_version), _data_version(new_version)
+    if new <= old:
+        return None
+    rows = connection.execute(text(CHANGES_QUERY), {'old': old, 'new': new}).fetchall()
+    if {int(row[0]) for row in rows} != set(range(old + 1, new + 1)) or any(row[1] is None for row in rows):
+        return None
+    return {month_start(row[1]) for row in rows}
+
+
+class DimensionSnapshot:
+    """
+    An immutable view of all dimension data at one data version.
+    Lists are stored as tuples so no request can mutate the shared copy.
+    """
+
+    def __init__(self, data, version, loaded_at):
+        self.version = version
+        self.loaded_at = loaded_at
+        self._data = {key: tuple(data.get(key, [])) for key in DIMENSION_KEYS}
+
+        # Precomputed id -> name lookups that compare() and trend() used to rebuild per request.
+        self.suburb_names = {item['suburb_id']: item['suburb_name'] for item in self._data['suburbs']}
+        self.layout_names = {item['layout_id']: item['layout_name'] for item in self._data['layouts']}
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def as_dict(self):
+        """Returns a fresh top-level dict, so callers can add their own template variables."""
+        return dict(self._data)
+
+    def at_version(self, version):
+        """The same dimension data under a newer data version (the lists are shared, not copied)."""
+        snapshot = copy.copy(self)
+        snapshot.version = version
+        return snapshot
+
+
+class DimensionCatalog:
+    """
+    Loads the dimension data once and serves read-only snapshots.
+
+    - Every `check_interval` seconds, the next request runs VERSION_QUERY (one tiny query).
+      The snapshot takes on the new data version, which keys the result cache and ETags, but the
+      dimension queries only run again when a DIM_ table's watermark has changed.
+    - After `max_age` seconds the snapshot is reloaded unconditionally, which also catches
+      changes the watermark cannot see (e.g. an UPDATE of a property_type, or the first sale of
+      a new year or property type, which come from FACT_Properties).
+    - `invalidate()` is the explicit hook for the ETL to force a reload on the next request.
+    - With a `parallel` runner (parallel.ParallelQueries), a reload runs the dimension queries
+      side by side, each on its own pooled connection.
+    """
+
+    def __init__(self, engine, check_interval=30, max_age=3600, parallel=None):
+        self.engine = engine
+        self.parallel = parallel
+        self.check_interval = check_interval
+        self.max_age = max_age
+        self._snapshot = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'refreshes': 0, 'version_checks': 0, 'errors': 0}
+
+    def get(self):
+        """Returns the current snapshot, refreshing it first if it is stale."""
+        now = time.monotonic()
+        snapshot = self._snapshot
+        if snapshot is not None and now - self._checked_at < self.check_interval:
+            self.stats['hits'] += 1
+            return snapshot
+
+        with self._lock:
+            # Another thread may have refreshed while we were waiting for the lock.
+            snapshot = self._snapshot
+            if snapshot is not None and now - self._checked_at < self.check_interval:
+                self.stats['hits'] += 1
+                return snapshot
+            try:
+                return self._revalidate(snapshot, now)
+            except Exception as e:
+                self.stats['errors'] += 1
+                logging.error(f"Failed to fetch dimension data: {e}")
+                if snapshot is not None:
+                    # Serve the last good snapshot rather than empty dropdowns.
+                    return snapshot
+                return DimensionSnapshot({}, version=None, loaded_at=now)
+
+    def _revalidate(self, snapshot, now):
+        with self.engine.connect() as connection:
+            self.stats['version_checks'] += 1
+            version = self._fetch_version(connection)
+            if (snapshot is not None and dimension_watermark(snapshot.version) == dimension_watermark(version)
+                    and now - snapshot.loaded_at < self.max_age):
+                if snapshot.version != version:
+                    # Only the sales changed: keep the dimension data, move to the new version.
+                    snapshot = self._snapshot = snapshot.at_version(version)
+                self._checked_at = now
+                self.stats['hits'] += 1
+                return snapshot
+
+            self.stats['misses'] += 1
+            if snapshot is not None:
+                self.stats['refreshes'] += 1
+            data = self._load(connection)
+
+        self._snapshot = DimensionSnapshot(data, version, now)
+        self._checked_at = now
+        logging.info(f"Loaded dimension catalog at version {version}.")
+        return self._snapshot
+
+    def _fetch_version(self, connection):
+        rows = connection.execute(text(VERSION_QUERY)).fetchall()
+        return tuple((row[0], row[1], row[2]) for row in rows)
+
+    def _load(self, connection):
+        if self.parallel is not None:
+            frames = self.parallel.run({key: (lambda query=query: self._read_dimension(query))
+                                        for key, query in DIMENSION_QUERIES.items()})
+        else:
+            frames = {key: pd.read_sql(query, connection) for key, query in DIMENSION_QUERIES.items()}
+        data = {}
+        for key, df in frames.items():
+            if key in SCALAR_COLUMNS:
+                data[key] = df[SCALAR_COLUMNS[key]].tolist()
+            else:
+                data[key] = df.to_dict('records')
+        return data
+
+    def _read_dimension(self, query):
+        with self.engine.connect() as connection:
+            return pd.read_sql(query, connection)
+
+    def is_fresh(self):
+        """True while get() would return the current snapshot without touching the database."""
+        return self._snapshot is not None and time.monotonic() - self._checked_at < self.check_interval
+
+    @property
+    def version(self):
+        """The data-version watermark of the current snapshot (None before the first load)."""
+        return self._snapshot.version if self._snapshot is not None else None
+
+    def invalidate(self):
+        """Forces the next get() to re-check the watermark and reload."""
+        with self._lock:
+            self._checked_at = 0.0
+            if self._snapshot is not None:
+                # Make the current snapshot look expired so the reload is unconditional.
+                self._snapshot.loaded_at = -float('inf')
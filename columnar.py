@@ -0,0 +1,374 @@
+# columnar.py - In-memory columnar copy of FACT_Properties that answers the page queries without SQL
+#
+# The fact table is loaded once per data version into plain NumPy arrays:
+#   - suburb / layout / property_type as dense dictionary codes (int32 / int16 / int16, -1 = NULL),
+#   - date_sold as int32 day numbers (days since 1970-01-01) plus derived year and month numbers,
+#   - price and land_size as float64.
+# Filters become boolean masks and GROUP BYs become np.bincount over a combined group code, so a
+# request costs a few vectorized passes over compact arrays instead of a query plus a DataFrame.
+# Rows whose suburb or layout is missing from its DIM_ table are kept with code -1, and each query
+# applies the joins of its SQL counterpart: /explore counts them (LEFT JOINs), /compare needs both
+# (inner joins on DIM_Suburbs and DIM_Layouts) and /trend needs the suburb (inner join on DIM_Suburbs).
+# When only some months' sales changed (META_Data_Changes, see catalog.changed_months), just those
+# months are read again; any other change reloads the whole table.
+
+import copy
+import logging
+import sys
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+from catalog import changed_months
+from cube import next_month
+from explore_stats import summarize_prices
+from metrics import count_rows, phase
+from queries import trend_series
+from sketch import merged_quantiles, price_bucket
+from timeseries import build_series
+
+FACT_COLUMNS_QUERY = """
+    SELECT price, date_sold, suburb_id, layout_id, property_type, land_size, address
+    FROM FACT_Properties
+"""
+MONTH_CONDITION = " WHERE date_sold >= :start AND date_sold < :end"
+SUBURBS_QUERY = "SELECT suburb_id, suburb_name, postcode FROM DIM_Suburbs ORDER BY suburb_id"
+LAYOUTS_QUERY = "SELECT layout_id, layout_name FROM DIM_Layouts ORDER BY layout_id"
+
+NULL_DAY = np.iinfo(np.int32).min  # date_sold IS NULL: never inside any date range
+EPOCH = np.datetime64('1970-01-01', 'D')
+
+
+def to_day(value):
+    """An ISO date string or date -> int32 day number."""
+    return int((np.datetime64(str(value), 'D') - EPOCH).astype(np.int64))
+
+
+def _encode(values, dictionary):
+    """Maps raw ids to positions in the sorted `dictionary`; ids not in it become -1."""
+    values = np.asarray(values)
+    positions = np.searchsorted(dictionary, values).clip(0, max(len(dictionary) - 1, 0))
+    found = (dictionary[positions] == values) if len(dictionary) else np.zeros(len(values), bool)
+    return np.where(found, positions, -1)
+
+
+class ColumnarFacts:
+    """An immutable, column-per-array copy of the fact table at one data version."""
+
+    def __init__(self, suburbs, layouts, fact_chunks, version):
+        self.version = version
+
+        # Dimension dictionaries: code -> id / name / postcode.
+        self.suburb_ids = suburbs['suburb_id'].to_numpy(dtype=np.int64)
+        self.suburb_names = suburbs['suburb_name'].to_numpy(dtype=object)
+        self.suburb_postcodes = pd.to_numeric(suburbs['postcode']).fillna(-1).to_numpy(dtype=np.int32)
+        self.layout_ids = layouts['layout_id'].to_numpy(dtype=np.int64)
+        self.layout_names = layouts['layout_name'].to_numpy(dtype=object)
+
+        # Encode chunk by chunk, so only one chunk is ever held as a DataFrame.
+        self._set_columns([self._encode_chunk(chunk) for chunk in fact_chunks])
+
+    def _set_columns(self, parts):
+        columns = {name: np.concatenate([part[name] for part in parts]) if parts else np.array([])
+                   for name in ('suburb_code', 'layout_code', 'property_type', 'day', 'year', 'month',
+                                'price', 'land_size', 'address')}
+        del parts
+
+        # -1: no suburb / layout (NULL or not in the dimension table). Such sales count in the /explore
+        # stats, like the SQL query's LEFT JOINs; `joined` leaves them out of /compare.
+        self.suburb_code = columns['suburb_code'].astype(np.int32)
+        self.layout_code = columns['layout_code'].astype(np.int16)
+        self.joined = (self.suburb_code >= 0) & (self.layout_code >= 0)
+        property_types = pd.Categorical(columns['property_type'])
+        self.property_types = np.asarray(property_types.categories, dtype=object)
+        self.type_code = property_types.codes.astype(np.int16)
+        self.day = columns['day'].astype(np.int32)
+        self.year = columns['year'].astype(np.int16)
+        self.month = columns['month'].astype(np.int32)
+        self.price = columns['price'].astype(np.float64)
+        self.land_size = columns['land_size'].astype(np.float64)
+        self.address = columns['address'].astype(object)
+        self._memory_bytes = None
+
+    def with_months(self, months, fact_chunks, version):
+        """
+        A copy at `version` in which the sales of `months` (first days) are replaced by `fact_chunks`,
+        those months' rows read again. The DIM_ tables must not have changed.
+        """
+        keep = ~np.isin(self.month, [month.year * 12 + month.month - 1 for month in months])
+        kept = {'suburb_code': self.suburb_code[keep], 'layout_code': self.layout_code[keep],
+                # Code -1 (no property type) picks the None appended at the end.
+                'property_type': np.append(self.property_types, None)[self.type_code[keep]],
+                'day': self.day[keep], 'year': self.year[keep], 'month': self.month[keep],
+                'price': self.price[keep], 'land_size': self.land_size[keep], 'address': self.address[keep]}
+        facts = copy.copy(self)
+        facts.version = version
+        facts._set_columns([kept] + [facts._encode_chunk(chunk) for chunk in fact_chunks])
+        return facts
+
+    def _encode_chunk(self, fact):
+        suburb_code = _encode(pd.to_numeric(fact['suburb_id']).fillna(-1).to_numpy(np.int64), self.suburb_ids)
+        layout_code = _encode(pd.to_numeric(fact['layout_id']).fillna(-1).to_numpy(np.int64), self.layout_ids)
+        dates = pd.to_datetime(fact['date_sold'])
+        has_date = ~dates.isna().to_numpy()
+        years = dates.dt.year.fillna(0).to_numpy(np.int64)
+        return {
+            'suburb_code': suburb_code.astype(np.int32),
+            'layout_code': layout_code.astype(np.int16),
+            'property_type': fact['property_type'].to_numpy(dtype=object),
+            'day': np.where(has_date, dates.to_numpy(dtype='datetime64[D]').astype(np.int64), NULL_DAY).astype(np.int32),
+            'year': np.where(has_date, years, 0).astype(np.int16),
+            # Months counted from year 0, so year and month come back out with divmod.
+            'month': np.where(has_date, years * 12 + dates.dt.month.fillna(1).to_numpy(np.int64) - 1, -1).astype(np.int32),
+            'price': pd.to_numeric(fact['price']).to_numpy(dtype=np.float64),
+            'land_size': pd.to_numeric(fact['land_size']).to_numpy(dtype=np.float64),
+            'address': fact['address'].to_numpy(dtype=object),
+        }
+
+    def __len__(self):
+        return self.price.size
+
+    def memory_bytes(self):
+        """Bytes held by the columns, including the address strings (computed once)."""
+        if self._memory_bytes is None:
+            self._memory_bytes = self._count_bytes()
+        return self._memory_bytes
+
+    def _count_bytes(self):
+        arrays = [self.suburb_code, self.layout_code, self.joined, self.type_code, self.day, self.year, self.month,
+                  self.price, self.land_size, self.address]
+        return (sum(array.nbytes for array in arrays)
+                + sum(sys.getsizeof(value) for value in self.address if value is not None))
+
+    # --- Filter helpers ---
+
+    def _code_of(self, dictionary, value):
+        code = _encode(np.array([value], dtype=np.int64), dictionary)[0]
+        return int(code)
+
+    def _equals_code(self, column, dictionary, value):
+        # An id missing from the dictionary matches nothing (not the -1 rows).
+        code = self._code_of(dictionary, value)
+        return column == code if code >= 0 else np.zeros(len(self), dtype=bool)
+
+    def _in_codes(self, column, dictionary, ids):
+        codes = _encode(np.array(ids, dtype=np.int64), dictionary)
+        return np.isin(column, codes[codes >= 0])
+
+    def _year_mask(self, years):
+        return np.isin(self.year, np.array(years, dtype=np.int16))
+
+    def _take_rows(self, rows):
+        """The explore() detail columns for the given row numbers, as the SQL query returns them."""
+        def take(positions):
+            selected = rows[np.asarray(positions)]
+            days = self.day[selected]
+            dates = np.where(days == NULL_DAY, None,
+                             (EPOCH + days.astype('timedelta64[D]')).astype(object))
+            land_size = self.land_size[selected]
+            if not np.isnan(land_size).any():
+                land_size = land_size.astype(np.int64)  # INTEGER column without NULLs
+            suburb_code, layout_code = self.suburb_code[selected], self.layout_code[selected]
+            return pd.DataFrame({'date_sold': dates,
+                                 'suburb_name': np.where(suburb_code >= 0, self.suburb_names[suburb_code], None),
+                                 'layout_name': np.where(layout_code >= 0, self.layout_names[layout_code], None),
+                                 'land_size': land_size,
+                                 'address': self.address[selected]})
+        return take
+
+    # --- The page queries ---
+
+    def explore(self, filters, limit=100):
+        """Same result as queries.run_explore()."""
+        with phase('memory_query'):
+            mask = np.ones(len(self), dtype=bool)
+            if filters['year']:
+                mask &= self.year == filters['year']
+            if filters['suburb_id']:
+                mask &= self._equals_code(self.suburb_code, self.suburb_ids, filters['suburb_id'])
+            if filters['layout_id']:
+                mask &= self._equals_code(self.layout_code, self.layout_ids, filters['layout_id'])
+            rows = np.flatnonzero(mask)
+        count_rows(rows.size)
+        with phase('to_dict'):
+            return summarize_prices(self.price[rows], self._take_rows(rows), limit, listed=self.joined[rows])
+
+    def compare(self, filters):
+        """Same result as queries.run_compare()."""
+        years, suburb_ids, layout_ids = filters['years'], filters['suburb_ids'], filters['layout_ids']
+        if not suburb_ids and not years and not layout_ids:
+            raise ValueError("Please select at least one filter.")
+
+        with phase('memory_query'):
+            mask = self.joined.copy()
+            if suburb_ids:
+                mask &= self._in_codes(self.suburb_code, self.suburb_ids, suburb_ids)
+            if years:
+                mask &= self._year_mask(years)
+            if layout_ids:
+                mask &= self._in_codes(self.layout_code, self.layout_ids, layout_ids)
+
+            # One combined group code: suburb, then layout (if grouped), then year (if grouped).
+            n_layouts = len(self.layout_ids) if layout_ids else 1
+            year_list = np.array(sorted(set(years)), dtype=np.int16)
+            n_years = len(year_list) if years else 1
+            group = self.suburb_code[mask].astype(np.int64) * n_layouts * n_years
+            if layout_ids:
+                group += self.layout_code[mask].astype(np.int64) * n_years
+            if years:
+                group += np.searchsorted(year_list, self.year[mask])
+            size = len(self.suburb_ids) * n_layouts * n_years
+            counts = np.bincount(group, minlength=size)
+            sums = np.bincount(group, weights=self.price[mask], minlength=size)
+            present = np.flatnonzero(counts)
+
+            # The same price sketches as AGG_Monthly_Price_Sketch, merged per group, so the
+            # percentiles match the SQL backend exactly rather than being computed exactly here.
+            prices = self.price[mask]
+            positive = prices > 0
+            buckets = price_bucket(prices[positive])
+            first_bucket = int(buckets.min()) if buckets.size else 0
+            n_buckets = int(buckets.max()) - first_bucket + 1 if buckets.size else 1
+            keys, bucket_counts = np.unique(group[positive] * n_buckets + (buckets - first_bucket), return_counts=True)
+            sketch_group, sketch_bucket = np.divmod(keys, n_buckets)
+            quantiles = merged_quantiles(sketch_group, sketch_bucket + first_bucket, bucket_counts)
+            sketch_groups = np.unique(sketch_group)
+        count_rows(present.size)
+
+        with phase('to_dict'):
+            suburb_code, rest = np.divmod(present, n_layouts * n_years)
+            layout_code, year_index = np.divmod(rest, n_years)
+            records = []
+            for i, group_code in enumerate(present):
+                record = {'suburb_name': self.suburb_names[suburb_code[i]]}
+                if layout_ids:
+                    record['layout_name'] = self.layout_names[layout_code[i]]
+                if years:
+                    record['sale_year'] = int(year_list[year_index[i]])
+                record['total_sales'] = int(counts[group_code])
+                record['avg_price'] = sums[group_code] / counts[group_code]
+                position = np.searchsorted(sketch_groups, group_code)
+                has_sketch = position < sketch_groups.size and sketch_groups[position] == group_code
+                for column, values in quantiles.items():
+                    record[column] = float(values[position]) if has_sketch else None
+                records.append(record)
+            # ORDER BY suburb_name[, sale_year][, layout_name], case-insensitive like MySQL's collation.
+            records.sort(key=lambda r: (r['suburb_name'].lower(), r.get('sale_year', 0),
+                                        r.get('layout_name', '').lower()))
+            return records
+
+    def trend(self, filters):
+        """Same result as queries.run_trend()."""
+        dimension, keys = trend_series(filters)
+        with phase('memory_query'):
+            # Sales without a date have no month to be charted in; like the SQL query's inner join on
+            # DIM_Suburbs, a known layout is not needed.
+            mask = (self.month >= 0) & (self.suburb_code >= 0)
+            if filters['suburb_ids']:
+                mask &= self._in_codes(self.suburb_code, self.suburb_ids, filters['suburb_ids'])
+            if filters['postcodes']:
+                mask &= np.isin(self.suburb_code, np.flatnonzero(np.isin(self.suburb_postcodes, filters['postcodes'])))
+            if filters['property_types']:
+                mask &= np.isin(self.type_code, np.flatnonzero(np.isin(self.property_types, filters['property_types'])))
+            if filters['layout_ids']:
+                mask &= self._in_codes(self.layout_code, self.layout_ids, filters['layout_ids'])
+            if filters['start_date']:
+                mask &= self.day >= to_day(filters['start_date'])
+            if filters['end_date']:
+                mask &= self.day <= to_day(filters['end_date'])
+
+            # The series of every sale, as a position in `keys`.
+            if dimension is None:
+                series = np.zeros(int(mask.sum()), dtype=np.int64)
+            else:
+                series_values = {'suburb': lambda: self.suburb_ids[self.suburb_code[mask]],
+                                 'postcode': lambda: self.suburb_postcodes[self.suburb_code[mask]],
+                                 'layout': lambda: self.layout_ids[self.layout_code[mask]],
+                                 'property_type': lambda: self.property_types[self.type_code[mask]]}[dimension]()
+                series = np.searchsorted(np.asarray(keys), series_values)
+            months = self.month[mask]
+            if months.size == 0:
+                return None
+            # One (series, month) cell per group, like the SQL GROUP BY.
+            first = months.min()
+            n_months = int(months.max() - first) + 1
+            cell = series * n_months + (months - first)
+            counts = np.bincount(cell, minlength=len(keys) * n_months)
+            sums = np.bincount(cell, weights=self.price[mask], minlength=len(keys) * n_months)
+            present = np.flatnonzero(counts)
+        count_rows(present.size)
+
+        with phase('to_dict'):
+            cell_series, cell_month = np.divmod(present, n_months)
+            return build_series(keys, cell_series, cell_month + first, counts[present], sums[present],
+                                smooth=filters['smooth'], window=filters['window'], max_points=filters['max_points'])
+
+
+def load_columnar(engine, version, chunksize=500_000):
+    """Reads the dimensions and the fact table into a ColumnarFacts."""
+    started = time.perf_counter()
+    with engine.connect() as connection:
+        suburbs = pd.read_sql(text(SUBURBS_QUERY), connection)
+        layouts = pd.read_sql(text(LAYOUTS_QUERY), connection)
+        # A server-side cursor, so the driver doesn't buffer the whole table either.
+        chunks = pd.read_sql(text(FACT_COLUMNS_QUERY), connection.execution_options(stream_results=True),
+                             chunksize=chunksize)
+        facts = ColumnarFacts(suburbs, layouts, chunks, version)
+    logging.info(f"Loaded {len(facts):,} fact rows into memory ({facts.memory_bytes() / 2**20:.1f} MiB) "
+                 f"in {time.perf_counter() - started:.1f}s at version {version}.")
+    return facts
+
+
+def reload_months(engine, facts, months, version):
+    """`facts` moved to `version`, with the sales of `months` (first days) read again from the fact table."""
+    started = time.perf_counter()
+    with engine.connect() as connection:
+        chunks = [pd.read_sql(text(FACT_COLUMNS_QUERY + MONTH_CONDITION), connection,
+                              params={'start': month, 'end': next_month(month)}) for month in sorted(months)]
+    facts = facts.with_months(months, chunks, version)
+    logging.info(f"Reloaded {len(months)} month(s) of the in-memory fact table "
+                 f"in {time.perf_counter() - started:.2f}s at version {version}.")
+    return facts
+
+
+class ColumnarStore:
+    """
+    Holds the ColumnarFacts for the current data version. When the version changes it reads again
+    only the months that changed, or reloads everything if that is not known.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self._facts = None
+        self._lock = threading.Lock()
+
+    def get(self, version):
+        facts = self._facts
+        if facts is not None and facts.version == version:
+            return facts
+        with self._lock:
+            if self._facts is None or self._facts.version != version:
+                self._facts = self._refresh(self._facts, version)
+            return self._facts
+
+    def _refresh(self, facts, version):
+        if facts is not None:
+            with self.engine.connect() as connection:
+                months = changed_months(connection, facts.version, version)
+            if months is not None:
+                return reload_months(self.engine, facts, months, version)
+        return load_columnar(self.engine, version)
+
+    def run(self, name, filters, version):
+        """Answers the 'explore', 'compare' or 'trend' query from memory."""
+        return getattr(self.get(version), name)(filters)
+
+    def stats(self):
+        facts = self._facts
+        if facts is None:
+            return {'loaded': False}
+        return {'loaded': True, 'version': facts.version, 'rows': len(facts),
+                'memory_bytes': facts.memory_bytes()}
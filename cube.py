@@ -0,0 +1,224 @@
+# cube.py - Pre-aggregated monthly sales cube used by /trend and /compare
+#
+# AGG_Monthly_Sales holds one row per (month, suburb, layout, property type) with
+# count, sum(price) and sum(price^2). Averages (and variances) at any coarser grain are
+# rolled up from these sums, so the routes read O(months x groups) rows instead of
+# aggregating the raw fact table on every request. Sales without a layout are kept under layout_id 0
+# (no DIM_Layouts row has it), so /trend counts them like the fact-table query and /compare's join
+# on DIM_Layouts leaves them out like the fact-table query.
+# AGG_Monthly_Price_Sketch holds a price sketch (sketch.py) per (month, suburb, layout), one row per
+# price bucket, so medians and percentiles at any coarser grain are merged the same way.
+
+import datetime
+import logging
+
+from sqlalchemy import bindparam, text
+
+from sketch import BUCKET_SQL
+
+CUBE_TABLE = 'AGG_Monthly_Sales'
+SKETCH_TABLE = 'AGG_Monthly_Price_Sketch'
+
+# Aggregates FACT_Properties into the cube. {range_condition} limits it to one month when refreshing incrementally.
+CUBE_INSERT_QUERY = f"""
+    INSERT INTO {CUBE_TABLE}
+        (sale_month, sale_year, suburb_id, postcode, layout_id, property_type, sales_count, price_sum, price_sq_sum)
+    SELECT
+        DATE_FORMAT(p.date_sold, '%Y-%m-01') AS sale_month,
+        YEAR(p.date_sold) AS sale_year,
+        p.suburb_id,
+        s.postcode,
+        COALESCE(p.layout_id, 0) AS layout_id,
+        COALESCE(p.property_type, '') AS property_type,
+        COUNT(*),
+        SUM(p.price),
+        SUM(p.price * p.price)
+    FROM FACT_Properties p
+    JOIN DIM_Suburbs s ON p.suburb_id = s.suburb_id
+    WHERE p.date_sold IS NOT NULL {{range_condition}}
+    GROUP BY sale_month, sale_year, p.suburb_id, s.postcode, p.layout_id, property_type
+"""
+
+# Buckets FACT_Properties into the price sketches, same {range_condition} as above.
+SKETCH_INSERT_QUERY = f"""
+    INSERT INTO {SKETCH_TABLE} (sale_month, sale_year, suburb_id, layout_id, price_bucket, sales_count)
+    SELECT
+        DATE_FORMAT(p.date_sold, '%Y-%m-01') AS sale_month,
+        YEAR(p.date_sold) AS sale_year,
+        p.suburb_id,
+        p.layout_id,
+        {BUCKET_SQL.format(price='p.price')} AS price_bucket,
+        COUNT(*)
+    FROM FACT_Properties p
+    WHERE p.date_sold IS NOT NULL AND p.price > 0
+      AND p.suburb_id IS NOT NULL AND p.layout_id IS NOT NULL {{range_condition}}
+    GROUP BY sale_month, sale_year, p.suburb_id, p.layout_id, price_bucket
+"""
+
+# Months whose fact rows no longer match the cube (new, corrected or deleted sales).
+STALE_MONTHS_QUERY = f"""
+    SELECT f.sale_month
+    FROM (
+        SELECT DATE_FORMAT(p.date_sold, '%Y-%m-01') AS sale_month, COUNT(*) AS sales_count, SUM(p.price) AS price_sum
+        FROM FACT_Properties p
+        JOIN DIM_Suburbs s ON p.suburb_id = s.suburb_id
+        WHERE p.date_sold IS NOT NULL
+        GROUP BY sale_month
+    ) f
+    LEFT JOIN (
+        SELECT sale_month, SUM(sales_count) AS sales_count, SUM(price_sum) AS price_sum
+        FROM {CUBE_TABLE} GROUP BY sale_month
+    ) c ON c.sale_month = f.sale_month
+    WHERE c.sale_month IS NULL OR c.sales_count <> f.sales_count OR c.price_sum <> f.price_sum
+    UNION
+    SELECT c.sale_month FROM {CUBE_TABLE} c
+    WHERE NOT EXISTS (
+        SELECT 1 FROM FACT_Properties p
+        WHERE p.date_sold >= c.sale_month AND p.date_sold < c.sale_month + INTERVAL 1 MONTH
+    )
+"""
+
+
+def month_start(value):
+    """Truncates a date/datetime/'YYYY-MM-DD' string to the first day of its month."""
+    if isinstance(value, str):
+        value = datetime.date.fromisoformat(value[:10])
+    return datetime.date(value.year, value.month, 1)
+
+
+def next_month(month):
+    return datetime.date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def refresh_monthly_cube(connection, months=None):
+    """
+    Rebuilds the cube and price sketch rows for `months` (any iterable of dates, only their
+    month matters), or both tables when `months` is None. Runs inside the caller's transaction.
+    Returns the list of months that were refreshed (None for a full rebuild).
+    """
+    tables = ((CUBE_TABLE, CUBE_INSERT_QUERY), (SKETCH_TABLE, SKETCH_INSERT_QUERY))
+    if months is None:
+        for table, insert_query in tables:
+            connection.execute(text(f"DELETE FROM {table}"))
+            connection.execute(text(insert_query.format(range_condition="")))
+        logging.info(f"Rebuilt {CUBE_TABLE} and {SKETCH_TABLE} from FACT_Properties.")
+        return None
+
+    refreshed = sorted({month_start(m) for m in months})
+    for table, insert_query in tables:
+        insert_month = text(insert_query.format(
+            range_condition="AND p.date_sold >= :start AND p.date_sold < :end"))
+        for month in refreshed:
+            connection.execute(text(f"DELETE FROM {table} WHERE sale_month = :month"), {'month': month})
+            connection.execute(insert_month, {'start': month, 'end': next_month(month)})
+    logging.info(f"Refreshed {len(refreshed)} month(s) of {CUBE_TABLE} and {SKETCH_TABLE}.")
+    return refreshed
+
+
+def stale_months(connection):
+    """Finds the months where FACT_Properties and the cube disagree (a full fact scan; ETL use only)."""
+    return [month_start(row[0]) for row in connection.execute(text(STALE_MONTHS_QUERY))]
+
+
+def _is_month_aligned(start_date, end_date):
+    """The cube can only answer date ranges made of whole months."""
+    if start_date and datetime.date.fromisoformat(start_date).day != 1:
+        return False
+    if end_date:
+        end = datetime.date.fromisoformat(end_date)
+        if (end + datetime.timedelta(days=1)).day != 1:
+            return False
+    return True
+
+
+# The cube column of each /trend series dimension.
+TREND_SERIES_COLUMNS = {'suburb': 'c.suburb_id', 'postcode': 'c.postcode', 'layout': 'c.layout_id',
+                        'property_type': 'c.property_type'}
+
+
+def build_trend_query(series_by, suburb_ids, postcodes, property_types, layout_ids, start_date, end_date):
+    """
+    Returns (statement, params) answering trend() from the cube, or None when the filters
+    are not expressible in it (a date range that starts or ends mid-month). Produces the same
+    columns as the raw-table query: [series_key,] date_month, sales_count, price_sum.
+    """
+    if not _is_month_aligned(start_date, end_date):
+        return None
+
+    select_columns = ["DATE_FORMAT(c.sale_month, '%Y-%m') AS date_month",
+                      "CAST(SUM(c.sales_count) AS SIGNED) AS sales_count", "SUM(c.price_sum) AS price_sum"]
+    group_by_columns = ["c.sale_month"]
+    if series_by is not None:
+        select_columns.insert(0, f"{TREND_SERIES_COLUMNS[series_by]} AS series_key")
+        group_by_columns.insert(0, TREND_SERIES_COLUMNS[series_by])
+
+    conditions = ["1=1"]
+    params = {}
+    expanding = []
+    for name, values, column in (('suburb_ids', suburb_ids, 'c.suburb_id'), ('postcodes', postcodes, 'c.postcode'),
+                                 ('property_types', property_types, 'c.property_type'),
+                                 ('layout_ids', layout_ids, 'c.layout_id')):
+        if values:
+            conditions.append(f"{column} IN :{name}")
+            params[name] = list(values); expanding.append(name)
+    if start_date:
+        conditions.append("c.sale_month >= :start_date"); params['start_date'] = start_date
+    if end_date:
+        conditions.append("c.sale_month <= :end_date"); params['end_date'] = end_date
+
+    query = f"""
+        SELECT {", ".join(select_columns)}
+        FROM {CUBE_TABLE} c
+        WHERE {" AND ".join(conditions)}
+        GROUP BY {", ".join(group_by_columns)};
+    """
+    statement = text(query).bindparams(*[bindparam(name, expanding=True) for name in expanding])
+    return statement, params
+
+
+def build_compare_query(years, suburb_ids, layout_ids, price_sketch=False):
+    """
+    Returns (statement, params) answering compare() from the cube, or None when no year is
+    selected (the fact-table query then also counts sales without a date_sold, which have no
+    month in the cube). Produces the same columns and grouping as the raw-table query:
+    suburb_name [, layout_name] [, sale_year], total_sales, avg_price. With price_sketch=True it
+    reads the sketch table instead and returns each group's merged price sketch: one
+    (price_bucket, sales_count) row per bucket.
+    """
+    if not years:
+        return None
+
+    if price_sketch:
+        select_columns = ["s.suburb_name", "c.price_bucket", "CAST(SUM(c.sales_count) AS SIGNED) AS sales_count"]
+    else:
+        select_columns = ["s.suburb_name",
+                          "CAST(SUM(c.sales_count) AS SIGNED) AS total_sales",
+                          "SUM(c.price_sum) / SUM(c.sales_count) AS avg_price"]
+    select_columns.insert(1, "c.sale_year AS sale_year")
+    group_by_columns = ["s.suburb_name", "sale_year"]
+    conditions = ["c.sale_year IN :years"]
+    params = {'years': list(years)}
+    expanding = ['years']
+
+    if suburb_ids:
+        conditions.append("c.suburb_id IN :suburb_ids")
+        params['suburb_ids'] = list(suburb_ids); expanding.append('suburb_ids')
+    if layout_ids:
+        conditions.append("c.layout_id IN :layout_ids")
+        params['layout_ids'] = list(layout_ids); expanding.append('layout_ids')
+        select_columns.insert(1, "l.layout_name")
+        group_by_columns.append("l.layout_name")
+
+    if price_sketch:
+        group_by_columns.append("c.price_bucket")
+    query = f"""
+        SELECT {", ".join(select_columns)}
+        FROM {SKETCH_TABLE if price_sketch else CUBE_TABLE} c
+        JOIN DIM_Suburbs s ON c.suburb_id = s.suburb_id
+        JOIN DIM_Layouts l ON c.layout_id = l.layout_id
+        WHERE {" AND ".join(conditions)}
+        GROUP BY {", ".join(group_by_columns)}
+        ORDER BY {", ".join(group_by_columns)};
+    """
+    statement = text(query).bindparams(*[bindparam(name, expanding=True) for name in expanding])
+    return statement, params
@@ -0,0 +1,103 @@
+# database.py - Pooled SQLAlchemy engine, created lazily in each worker process
+#
+# Under a pre-forking server (gunicorn) the app module is imported once in the master and then
+# forked. A pool created before the fork would hand the same MySQL sockets to every worker, so the
+# engine is only created on first use, and re-created if the process id changes.
+
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy import create_engine, event
+
+
+def pool_settings_from_env():
+    """Pool options from the environment. The recycle time stays well below MySQL's wait_timeout (8h)."""
+    return {
+        'pool_size': int(os.getenv("DB_POOL_SIZE", "5")),
+        'max_overflow': int(os.getenv("DB_MAX_OVERFLOW", "10")),
+        'pool_timeout': int(os.getenv("DB_POOL_TIMEOUT_SECONDS", "30")),
+        'pool_recycle': int(os.getenv("DB_POOL_RECYCLE_SECONDS", "1800")),
+        'pool_pre_ping': os.getenv("DB_POOL_PRE_PING", "1") == "1",
+    }
+
+
+class LazyEngine:
+    """
+    Stands in for an Engine: attribute access is forwarded to this process's real engine,
+    which is created on first use. connect() also records how long each checkout waited.
+    """
+
+    def __init__(self, url, **engine_kwargs):
+        self.url = url
+        self.engine_kwargs = engine_kwargs
+        self._engine = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._setup_hooks = []
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.stats = {'checkouts': 0, 'wait_total_ms': 0.0, 'wait_max_ms': 0.0,
+                      'connections_opened': 0, 'invalidated': 0}
+
+    def get(self):
+        """Returns the engine for the current process, creating it if needed."""
+        if self._engine is not None and self._pid == os.getpid():
+            return self._engine
+        with self._lock:
+            if self._engine is not None and self._pid != os.getpid():
+                # Inherited from the parent: drop the pool without closing the parent's sockets.
+                self._engine.dispose(close=False)
+                self._engine = None
+            if self._engine is None:
+                self._engine = self._create()
+                self._pid = os.getpid()
+        return self._engine
+
+    def _create(self):
+        engine = create_engine(self.url, **self.engine_kwargs)
+        self._reset_stats()
+
+        @event.listens_for(engine, 'connect')
+        def _on_connect(dbapi_connection, connection_record):
+            self.stats['connections_opened'] += 1
+
+        @event.listens_for(engine, 'invalidate')
+        def _on_invalidate(dbapi_connection, connection_record, exception):
+            self.stats['invalidated'] += 1
+
+        for hook in self._setup_hooks:
+            hook(engine)
+        logging.info(f"Created database engine in process {os.getpid()}.")
+        return engine
+
+    def on_create(self, hook):
+        """Runs hook(engine) on every engine this creates, e.g. to attach event listeners."""
+        self._setup_hooks.append(hook)
+        if self._engine is not None:
+            hook(self._engine)
+
+    def connect(self):
+        start = time.perf_counter()
+        connection = self.get().connect()
+        waited_ms = (time.perf_counter() - start) * 1000
+        self.stats['checkouts'] += 1
+        self.stats['wait_total_ms'] += waited_ms
+        self.stats['wait_max_ms'] = max(self.stats['wait_max_ms'], waited_ms)
+        return connection
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+    def pool_stats(self):
+        """Pool occupancy plus checkout wait times, for monitoring."""
+        pool = self.get().pool
+        stats = {'pid': os.getpid(), 'pool_class': type(pool).__name__, **self.stats}
+        stats['wait_avg_ms'] = stats['wait_total_ms'] / stats['checkouts'] if stats['checkouts'] else 0.0
+        # Only QueuePool has a fixed size and overflow.
+        for name in ('size', 'checkedin', 'checkedout', 'overflow'):
+            if hasattr(pool, name):
+                stats[name] = getattr(pool, name)()
+        return stats
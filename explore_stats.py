@@ -0,0 +1,91 @@
+# explore_stats.py - Single-pass statistics for the /explore page
+
+import numpy as np
+import pandas as pd
+
+
+def build_filtered_query(where_clause):
+    """
+    The one query /explore needs: every filtered row, only the columns the page shows.
+    The old version scanned the filtered set ten times (eight correlated subqueries,
+    a ROW_NUMBER median and a separate sorted list query).
+    LEFT JOINs, because the old stats counted every sale, including those without a suburb
+    or layout; only the old list query joined the dimensions (see listed_rows()).
+    """
+    return f"""
+        SELECT p.price, p.date_sold, s.suburb_name, l.layout_name, p.land_size, p.address
+        FROM FACT_Properties p
+        LEFT JOIN DIM_Suburbs s ON p.suburb_id = s.suburb_id
+        LEFT JOIN DIM_Layouts l ON p.layout_id = l.layout_id
+        {where_clause}
+    """
+
+
+def listed_rows(df):
+    """The rows the top list may show: those with a suburb and a layout, as the old list query's inner joins."""
+    return (df['suburb_name'].notna() & df['layout_name'].notna()).to_numpy()
+
+
+def summarize_explore(df, limit=100):
+    """
+    Computes the stats summary and the top-`limit` list from the filtered rows in one pass.
+
+    Returns (stats_summary, results_list) with exactly the keys the template used before:
+    stats_summary is None when nothing matched.
+    """
+    if df.empty:
+        return None, []
+
+    # DECIMAL columns arrive as Python Decimals; one conversion gives us a float64 array.
+    prices = pd.to_numeric(df['price']).to_numpy(dtype='float64')
+    return summarize_prices(prices, lambda positions: df.iloc[positions], limit, listed=listed_rows(df))
+
+
+def summarize_prices(prices, take_rows, limit=100, listed=None):
+    """
+    The body of summarize_explore() for any row source: `prices` is a float64 array of the
+    filtered rows and take_rows(positions) returns those rows as a DataFrame with the
+    date_sold, suburb_name, layout_name, land_size and address columns. The stats cover every
+    row; the top list only the rows where the boolean array `listed` is True (all by default).
+    """
+    total = prices.size
+    if total == 0:
+        return None, []
+
+    i_min = int(np.argmin(prices))
+    i_max = int(np.argmax(prices))
+    min_row, max_row = (row for _, row in take_rows([i_min, i_max]).iterrows())
+
+    stats_summary = {
+        'min_price': prices[i_min],
+        'min_price_address': min_row['address'],
+        'min_price_date': min_row['date_sold'],
+        'min_price_land_size': min_row['land_size'],
+        'max_price': prices[i_max],
+        'max_price_address': max_row['address'],
+        'max_price_date': max_row['date_sold'],
+        'max_price_land_size': max_row['land_size'],
+        'avg_price': float(prices.mean()),
+        'total_sales': total,
+        # np.median averages the two middle values for even counts, like the old SQL did.
+        'median_price': float(np.median(prices)),
+    }
+
+    # Top-N by price without sorting the whole set: partition first, then sort only N rows.
+    candidates = np.arange(total) if listed is None else np.flatnonzero(listed)
+    if candidates.size > limit:
+        top = candidates[np.argpartition(-prices[candidates], limit - 1)[:limit]]
+    else:
+        top = candidates
+    top = top[np.argsort(-prices[top], kind='stable')]
+
+    top_df = take_rows(top)
+    results_df = pd.DataFrame({
+        'Price': prices[top],
+        'Date Sold': pd.to_datetime(top_df['date_sold']).dt.strftime('%Y-%m-%d').to_numpy(),
+        'Suburb': top_df['suburb_name'].to_numpy(),
+        'Layout': top_df['layout_name'].to_numpy(),
+        'Land Size (sqm)': top_df['land_size'].to_numpy(),
+        'Address': top_df['address'].to_numpy(),
+    })
+    return stats_summary, results_df.to_dict('records')
@@ -0,0 +1,164 @@
+# export.py - Streams the full /explore result set as CSV or Parquet
+#
+# Rows come from a server-side cursor in batches of EXPORT_BATCH_ROWS and are encoded and yielded
+# batch by batch, so memory stays flat whatever the filters match. No DataFrame is built.
+# If the client disconnects, the WSGI server closes the generator; the connection is then
+# invalidated rather than returned to the pool, so MySQL doesn't have to send the rest of the rows.
+
+import csv
+import io
+import logging
+import zlib
+from decimal import Decimal
+
+from sqlalchemy import text
+
+from queries import explore_where
+
+EXPORT_BATCH_ROWS = 5000
+
+EXPORT_COLUMNS = ['listing_id', 'date_sold', 'price', 'suburb_name', 'postcode', 'layout_name',
+                  'property_type', 'land_size', 'address']
+
+def build_export_query(where_clause):
+    """
+    Every matching row, in primary-key order where the plan allows it (no sort is forced).
+    LEFT JOINs, like /explore (explore_stats.build_filtered_query), so the export holds exactly
+    the sales counted in its "total sales"; a sale without a suburb or layout has empty names.
+    """
+    return f"""
+        SELECT p.listing_id, p.date_sold, p.price, s.suburb_name, s.postcode, l.layout_name,
+               p.property_type, p.land_size, p.address
+        FROM FACT_Properties p
+        LEFT JOIN DIM_Suburbs s ON p.suburb_id = s.suburb_id
+        LEFT JOIN DIM_Layouts l ON p.layout_id = l.layout_id
+        {where_clause}
+    """
+
+def count_export_rows(engine, filters):
+    """
+    The number of rows an export will contain (for the X-Row-Count header). The export's LEFT
+    JOINs are on primary keys and the filters only use fact columns, so the fact table alone
+    gives the same count.
+    """
+    where_clause, params = explore_where(filters)
+    query = f"SELECT COUNT(*) FROM FACT_Properties p {where_clause}"
+    with engine.connect() as connection:
+        return connection.execute(text(query), params).scalar()
+
+
+def stream_batches(engine, filters):
+    """Yields lists of row tuples from a server-side cursor."""
+    where_clause, params = explore_where(filters)
+    connection = engine.connect()
+    finished = False
+    try:
+        result = connection.execution_options(stream_results=True, yield_per=EXPORT_BATCH_ROWS).execute(
+            text(build_export_query(where_clause)), params)
+        # yield_per only sizes the cursor's fetches; partitions() needs the size to group rows too.
+        for batch in result.partitions(EXPORT_BATCH_ROWS):
+            yield batch
+        finished = True
+    finally:
+        if not finished:
+            # Cancelled (client went away) or failed: don't drain the unbuffered cursor.
+            logging.warning("Export stopped before the last row; discarding its connection.")
+            connection.invalidate()
+        connection.close()
+
+
+def csv_chunks(batches, row_count_trailer=False):
+    """Encodes batches as CSV (header line first); optionally ends with a '# row_count=N' line."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    rows = 0
+    for batch in batches:
+        writer.writerows(batch)
+        rows += len(batch)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if row_count_trailer:
+        buffer.write(f"# row_count={rows}\n")
+    yield buffer.getvalue().encode('utf-8')
+
+
+class _ChunkSink(io.RawIOBase):
+    """A write-only file that collects what ParquetWriter writes, so it can be yielded."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def _decimal_prices(prices):
+    """Prices as Decimal for the decimal128 column; some drivers (SQLite) return floats."""
+    return [Decimal(f"{price:.2f}") if isinstance(price, float) else price for price in prices]
+
+
+def parquet_chunks(batches, compression='snappy'):
+    """Encodes batches as one Parquet file, one row group per batch. Needs pyarrow."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([('listing_id', pa.int64()), ('date_sold', pa.date32()),
+                        ('price', pa.decimal128(12, 2)), ('suburb_name', pa.string()),
+                        ('postcode', pa.int32()), ('layout_name', pa.string()),
+                        ('property_type', pa.string()), ('land_size', pa.int32()), ('address', pa.string())])
+    sink = _ChunkSink()
+    # The row count ends up in the Parquet footer.
+    with pq.ParquetWriter(sink, schema, compression=compression) as writer:
+        for batch in batches:
+            columns = list(zip(*batch))
+            columns[2] = _decimal_prices(columns[2])
+            writer.write_table(pa.table([pa.array(column, type=field.type)
+                                         for column, field in zip(columns, schema)], schema=schema))
+            yield sink.drain()
+    yield sink.drain()
+
+
+class StartedStream:
+    """
+    Runs a chunk generator up to its first chunk on construction, so a failing query or encoder
+    raises while the view can still answer with an error status instead of a truncated 200.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.first = next(chunks, None)
+
+    def __iter__(self):
+        if self.first is not None:
+            yield self.first
+        yield from self.chunks
+
+    def close(self):
+        # Called by the WSGI server when the response ends or the client goes away.
+        self.chunks.close()
+
+
+def gzip_chunks(chunks):
+    """Gzip-compresses a stream of byte chunks on the fly."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31: gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,332 @@
+# geo.py - In-memory spatial index over the sale coordinates: radius, k-nearest and bounding-box search
+#
+# Sales are bucketed into a uniform grid of CELL_DEGREES x CELL_DEGREES cells and stored sorted by
+# cell number (row-major), so the cells of one grid row that a bounding box covers are one contiguous
+# slice, found with two binary searches. A query only looks at the rows of the cells it touches; exact
+# haversine distances are computed for those candidates alone, never for the whole table.
+#
+# Like columnar.py, the index is built once and, when the data version changes, only the months that
+# changed are read again. It keeps only what searching, filtering and the /explore statistics need
+# (coordinates, price, year and month, suburb, layout); the detail columns of the few rows that are
+# displayed are fetched from the database by primary key.
+# Coordinates are assumed not to cross the antimeridian, which holds for Perth.
+
+import copy
+import logging
+import math
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import bindparam, text
+
+from catalog import changed_months
+from cube import next_month
+from explore_stats import summarize_prices
+from metrics import count_rows, phase
+
+EARTH_RADIUS_M = 6_371_008.8
+CELL_DEGREES = 0.01  # ~1.1 km north-south, ~0.95 km east-west at Perth's latitude
+
+# The same LEFT JOINs as the /explore query, so both see the same rows: sales without a suburb or
+# layout count in the stats, but only `listed` sales (both joined) are listed.
+GEO_COLUMNS_QUERY = """
+    SELECT p.listing_id, p.latitude, p.longitude, p.price, p.date_sold, p.suburb_id, p.layout_id,
+           CASE WHEN s.suburb_id IS NOT NULL AND l.layout_id IS NOT NULL THEN 1 ELSE 0 END AS listed
+    FROM FACT_Properties p
+    LEFT JOIN DIM_Suburbs s ON p.suburb_id = s.suburb_id
+    LEFT JOIN DIM_Layouts l ON p.layout_id = l.layout_id
+    WHERE p.latitude IS NOT NULL AND p.longitude IS NOT NULL
+"""
+MONTH_CONDITION = " AND p.date_sold >= :start AND p.date_sold < :end"
+COLUMN_NAMES = ('listing_id', 'latitude', 'longitude', 'price', 'year', 'month', 'suburb_id', 'layout_id', 'listed')
+DETAILS_QUERY = text("""
+    SELECT p.listing_id, p.price, p.date_sold, s.suburb_name, l.layout_name, p.land_size, p.address,
+           p.latitude, p.longitude
+    FROM FACT_Properties p
+    LEFT JOIN DIM_Suburbs s ON p.suburb_id = s.suburb_id
+    LEFT JOIN DIM_Layouts l ON p.layout_id = l.layout_id
+    WHERE p.listing_id IN :listing_ids
+""").bindparams(bindparam('listing_ids', expanding=True))
+
+
+def haversine_m(lat, lon, lats, lons):
+    """Great-circle distance in metres from (lat, lon) to each of (lats, lons)."""
+    lat1, lat2 = math.radians(lat), np.radians(lats)
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * np.cos(lat2) * np.sin(np.radians(lons - lon) / 2) ** 2)
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def radius_bbox(lat, lon, radius_m):
+    """(south, west, north, east) of the smallest latitude/longitude box containing the circle."""
+    dlat = math.degrees(radius_m / EARTH_RADIUS_M)
+    # Near the poles the circle spans every longitude.
+    cos_lat = math.cos(math.radians(min(abs(lat) + dlat, 90.0)))
+    dlon = 180.0 if cos_lat < 1e-12 else min(180.0, dlat / cos_lat)
+    return lat - dlat, lon - dlon, lat + dlat, lon + dlon
+
+
+class GeoIndex:
+    """A grid index over the sales of one data version."""
+
+    def __init__(self, fact_chunks, version, cell_degrees=CELL_DEGREES):
+        self.version = version
+        self.cell_degrees = cell_degrees
+        self._build([self._decode_chunk(chunk) for chunk in fact_chunks])
+
+    def _build(self, parts):
+        columns = {name: np.concatenate([part[name] for part in parts]) if parts else np.array([])
+                   for name in COLUMN_NAMES}
+        del parts
+
+        latitude = columns['latitude'].astype(np.float64)
+        longitude = columns['longitude'].astype(np.float64)
+        self.origin = (float(latitude.min()), float(longitude.min())) if latitude.size else (0.0, 0.0)
+        cell_y, cell_x = self._cells(latitude, longitude)
+        self.n_rows = int(cell_y.max()) + 1 if cell_y.size else 0
+        self.n_cols = int(cell_x.max()) + 1 if cell_x.size else 0
+        cell = cell_y * self.n_cols + cell_x
+
+        # Sorting every column by cell makes each cell (and each run of cells in a grid row) a slice.
+        order = np.argsort(cell, kind='stable')
+        self.cell = cell[order]
+        self.latitude = latitude[order]
+        self.longitude = longitude[order]
+        self.listing_id = columns['listing_id'].astype(np.int64)[order]
+        self.price = columns['price'].astype(np.float64)[order]
+        self.year = columns['year'].astype(np.int16)[order]
+        self.month = columns['month'].astype(np.int32)[order]
+        self.suburb_id = columns['suburb_id'].astype(np.int32)[order]
+        self.layout_id = columns['layout_id'].astype(np.int32)[order]
+        self.listed = columns['listed'].astype(bool)[order]
+
+    @staticmethod
+    def _decode_chunk(fact):
+        dates = pd.to_datetime(fact['date_sold'])
+        return {
+            'listing_id': pd.to_numeric(fact['listing_id']).to_numpy(dtype=np.int64),
+            'latitude': pd.to_numeric(fact['latitude']).to_numpy(dtype=np.float64),
+            'longitude': pd.to_numeric(fact['longitude']).to_numpy(dtype=np.float64),
+            'price': pd.to_numeric(fact['price']).to_numpy(dtype=np.float64),
+            'year': dates.dt.year.fillna(0).to_numpy(dtype=np.int16),
+            # Months counted from year 0 like columnar.py; -1 without a date.
+            'month': (dates.dt.year * 12 + dates.dt.month - 1).fillna(-1).to_numpy(dtype=np.int32),
+            # NULL ids become 0, which no filter selects (ids start at 1).
+            'suburb_id': pd.to_numeric(fact['suburb_id']).fillna(0).to_numpy(dtype=np.int32),
+            'layout_id': pd.to_numeric(fact['layout_id']).fillna(0).to_numpy(dtype=np.int32),
+            'listed': pd.to_numeric(fact['listed']).to_numpy(dtype=bool),
+        }
+
+    def __len__(self):
+        return self.price.size
+
+    def memory_bytes(self):
+        return sum(array.nbytes for array in (self.cell, self.latitude, self.longitude, self.listing_id,
+                                              self.price, self.year, self.month, self.suburb_id, self.layout_id,
+                                              self.listed))
+
+    def with_months(self, months, fact_chunks, version):
+        """A copy at `version` in which the sales of `months` (first days) are replaced by `fact_chunks`."""
+        keep = ~np.isin(self.month, [month.year * 12 + month.month - 1 for month in months])
+        kept = {name: getattr(self, name)[keep] for name in COLUMN_NAMES}
+        index = copy.copy(self)
+        index.version = version
+        index._build([kept] + [index._decode_chunk(chunk) for chunk in fact_chunks])
+        return index
+
+    def _cells(self, latitude, longitude):
+        cell_y = np.floor((np.asarray(latitude) - self.origin[0]) / self.cell_degrees).astype(np.int64)
+        cell_x = np.floor((np.asarray(longitude) - self.origin[1]) / self.cell_degrees).astype(np.int64)
+        return cell_y, cell_x
+
+    # --- Candidate selection ---
+
+    def _candidates(self, south, west, north, east):
+        """Row positions of every sale in the cells that overlap the box (a superset of the box)."""
+        (y0, y1), (x0, x1) = self._cells([south, north], [west, east])
+        y0, y1 = max(int(y0), 0), min(int(y1), self.n_rows - 1)
+        x0, x1 = max(int(x0), 0), min(int(x1), self.n_cols - 1)
+        if y0 > y1 or x0 > x1:
+            return np.array([], dtype=np.int64)
+        # One [first cell, last cell] range per grid row.
+        row_starts = np.arange(y0, y1 + 1, dtype=np.int64) * self.n_cols
+        lo = np.searchsorted(self.cell, row_starts + x0, side='left')
+        hi = np.searchsorted(self.cell, row_starts + x1, side='right')
+        sizes = hi - lo
+        if sizes.sum() == 0:
+            return np.array([], dtype=np.int64)
+        # Concatenated aranges without a Python loop: repeat each slice start, add 0..size-1.
+        offsets = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        return np.repeat(lo, sizes) + offsets
+
+    def _apply_filters(self, positions, filters, listed_only=False):
+        """Keeps the positions matching the /explore year / suburb / layout filters (and only listed sales)."""
+        if listed_only:
+            positions = positions[self.listed[positions]]
+        if not filters:
+            return positions
+        mask = np.ones(positions.size, dtype=bool)
+        if filters.get('year'):
+            mask &= self.year[positions] == filters['year']
+        if filters.get('suburb_id'):
+            mask &= self.suburb_id[positions] == filters['suburb_id']
+        if filters.get('layout_id'):
+            mask &= self.layout_id[positions] == filters['layout_id']
+        return positions[mask]
+
+    # --- Queries; each returns row positions (and distances in metres, nearest first) ---
+
+    def bbox(self, south, west, north, east, filters=None, listed_only=False):
+        positions = self._apply_filters(self._candidates(south, west, north, east), filters, listed_only)
+        lat, lon = self.latitude[positions], self.longitude[positions]
+        return positions[(lat >= south) & (lat <= north) & (lon >= west) & (lon <= east)]
+
+    def radius(self, lat, lon, radius_m, filters=None, listed_only=False):
+        positions = self._apply_filters(self._candidates(*radius_bbox(lat, lon, radius_m)), filters, listed_only)
+        distances = haversine_m(lat, lon, self.latitude[positions], self.longitude[positions])
+        inside = distances <= radius_m
+        positions, distances = positions[inside], distances[inside]
+        order = np.argsort(distances, kind='stable')
+        return positions[order], distances[order]
+
+    def nearest(self, lat, lon, k, filters=None, listed_only=False):
+        """
+        The k nearest sales. Searches a circle that doubles until it holds k sales: every sale outside
+        a circle is farther away than every sale inside it, so the k closest inside are the answer.
+        """
+        radius_m = self.cell_degrees * math.pi / 180 * EARTH_RADIUS_M
+        while True:
+            positions, distances = self.radius(lat, lon, radius_m, filters, listed_only)
+            south, west, north, east = radius_bbox(lat, lon, radius_m)
+            (y0, y1), (x0, x1) = self._cells([south, north], [west, east])
+            covers_grid = y0 <= 0 and x0 <= 0 and y1 >= self.n_rows - 1 and x1 >= self.n_cols - 1
+            if positions.size >= k or covers_grid:
+                return positions[:k], distances[:k]
+            radius_m *= 2
+
+    # --- Pages ---
+
+    def details(self, engine, positions, distances=None):
+        """The /explore result columns (plus coordinates and distance) for positions, in their order."""
+        listing_ids = self.listing_id[positions]
+        if listing_ids.size == 0:
+            return []
+        with engine.connect() as connection, phase('sql'):
+            df = pd.read_sql(DETAILS_QUERY, connection, params={'listing_ids': listing_ids.tolist()})
+        count_rows(len(df))
+        df = df.set_index('listing_id').loc[listing_ids]
+        rows = pd.DataFrame({
+            'Price': pd.to_numeric(df['price']).to_numpy(dtype=np.float64),
+            'Date Sold': pd.to_datetime(df['date_sold']).dt.strftime('%Y-%m-%d').to_numpy(),
+            'Suburb': df['suburb_name'].to_numpy(),
+            'Layout': df['layout_name'].to_numpy(),
+            'Land Size (sqm)': df['land_size'].to_numpy(),
+            'Address': df['address'].to_numpy(),
+            'Latitude': pd.to_numeric(df['latitude']).to_numpy(dtype=np.float64),
+            'Longitude': pd.to_numeric(df['longitude']).to_numpy(dtype=np.float64),
+        })
+        if distances is not None:
+            rows['Distance (m)'] = np.round(distances).astype(np.int64)
+        return rows.to_dict('records')
+
+    def explore(self, engine, filters, geo, limit=100):
+        """Same result as queries.run_explore(), restricted to the sales inside the geo filter."""
+        with phase('memory_query'):
+            positions = self.search(geo, filters)[0]
+        count_rows(positions.size)
+
+        def take(selected):
+            listing_ids = self.listing_id[positions[np.asarray(selected)]].tolist()
+            with engine.connect() as connection, phase('sql'):
+                df = pd.read_sql(DETAILS_QUERY, connection, params={'listing_ids': listing_ids})
+            return df.set_index('listing_id').loc[listing_ids].reset_index(drop=True)
+
+        with phase('to_dict'):
+            return summarize_prices(self.price[positions], take, limit, listed=self.listed[positions])
+
+    def search(self, geo, filters=None, listed_only=False):
+        """Runs the geo filter (see queries.parse_geo_filters): (positions, distances or None)."""
+        if geo['mode'] == 'radius':
+            return self.radius(geo['lat'], geo['lon'], geo['radius_km'] * 1000, filters, listed_only)
+        if geo['mode'] == 'nearest':
+            return self.nearest(geo['lat'], geo['lon'], geo['k'], filters, listed_only)
+        return self.bbox(geo['south'], geo['west'], geo['north'], geo['east'], filters, listed_only), None
+
+
+def load_geo_index(engine, version, chunksize=500_000):
+    """Reads the coordinates and filter columns of the fact table into a GeoIndex."""
+    started = time.perf_counter()
+    with engine.connect() as connection:
+        chunks = pd.read_sql(text(GEO_COLUMNS_QUERY), connection.execution_options(stream_results=True),
+                             chunksize=chunksize)
+        index = GeoIndex(chunks, version)
+    logging.info(f"Built the geo index over {len(index):,} sales ({index.memory_bytes() / 2**20:.1f} MiB, "
+                 f"{index.n_rows}x{index.n_cols} cells) in {time.perf_counter() - started:.1f}s at version {version}.")
+    return index
+
+
+def reload_geo_months(engine, index, months, version):
+    """`index` moved to `version`, with the sales of `months` (first days) read again from the fact table."""
+    started = time.perf_counter()
+    with engine.connect() as connection:
+        chunks = [pd.read_sql(text(GEO_COLUMNS_QUERY + MONTH_CONDITION), connection,
+                              params={'start': month, 'end': next_month(month)}) for month in sorted(months)]
+    index = index.with_months(months, chunks, version)
+    logging.info(f"Reloaded {len(months)} month(s) of the geo index "
+                 f"in {time.perf_counter() - started:.2f}s at version {version}.")
+    return index
+
+
+class GeoStore:
+    """
+    Holds the GeoIndex for the current data version. When the version changes it reads again only
+    the months that changed, or rebuilds everything if that is not known.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self._index = None
+        self._lock = threading.Lock()
+
+    def get(self, version):
+        index = self._index
+        if index is not None and index.version == version:
+            return index
+        with self._lock:
+            if self._index is None or self._index.version != version:
+                self._index = self._refresh(self._index, version)
+            return self._index
+
+    def _refresh(self, index, version):
+        if index is not None:
+            with self.engine.connect() as connection:
+                months = changed_months(connection, index.version, version)
+            if months is not None:
+                return reload_geo_months(self.engine, index, months, version)
+        return load_geo_index(self.engine, version)
+
+    def explore(self, filters, geo, version):
+        return self.get(version).explore(self.engine, filters, geo)
+
+    def search(self, filters, geo, version, limit=100):
+        """The first `limit` matches (nearest first for radius / nearest) with their details."""
+        index = self.get(version)
+        with phase('memory_query'):
+            positions, distances = index.search(geo, filters, listed_only=True)
+        total = int(positions.size)
+        if distances is None:
+            # Bounding box: the most expensive sales first, like /explore.
+            positions = positions[np.argsort(-index.price[positions], kind='stable')]
+        with phase('to_dict'):
+            rows = index.details(self.engine, positions[:limit],
+                                 None if distances is None else distances[:limit])
+        return {'total': total, 'results': rows}
+
+    def stats(self):
+        index = self._index
+        if index is None:
+            return {'loaded': False}
+        return {'loaded': True, 'version': index.version, 'rows': len(index),
+                'memory_bytes': index.memory_bytes(), 'grid': [index.n_rows, index.n_cols]}
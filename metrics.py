@@ -0,0 +1,131 @@
+# metrics.py - Per-route, per-phase latency histograms in the Prometheus text format, plus a slow-query log
+#
+# The routes and queries.py wrap their hot-path steps in `with phase('sql'):` etc. The route is taken
+# from a context variable set once per request, so the query functions don't need to know which page
+# (or API endpoint) called them. Metrics are per process: with several workers, let Prometheus scrape
+# each one or sum them.
+
+import bisect
+import contextlib
+import contextvars
+import logging
+import threading
+import time
+
+from sqlalchemy import event
+
+# Phases timed on the hot path.
+PHASES = ('dimensions', 'query_build', 'sql', 'memory_query', 'to_dict', 'render', 'total')
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+ROW_BUCKETS = (0, 1, 10, 100, 1_000, 10_000, 100_000, 1_000_000)
+
+_current_route = contextvars.ContextVar('metrics_route', default='none')
+
+
+class Histogram:
+    """A labelled Prometheus histogram: cumulative bucket counts, sum and count per label set."""
+
+    def __init__(self, name, help_text, label_names, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, label_values, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.setdefault(label_values, [0] * len(self.buckets) + [0.0, 0])
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series_items = sorted((key, list(series)) for key, series in self._series.items())
+        for label_values, series in series_items:
+            labels = ",".join(f'{name}="{value}"' for name, value in zip(self.label_names, label_values))
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {series[-1]}')
+            lines.append(f'{self.name}_sum{{{labels}}} {series[-2]}')
+            lines.append(f'{self.name}_count{{{labels}}} {series[-1]}')
+        return "\n".join(lines)
+
+
+PHASE_SECONDS = Histogram('perth_request_phase_seconds',
+                          'Time spent per route in each request phase.', ('route', 'phase'), LATENCY_BUCKETS)
+ROWS_RETURNED = Histogram('perth_query_rows_returned',
+                          'Rows returned by the database per query.', ('route',), ROW_BUCKETS)
+
+
+def set_route(route):
+    """Marks the current request's route; every phase recorded afterwards is labelled with it."""
+    _current_route.set(route or 'none')
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Times the enclosed block as `name` for the current route."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        PHASE_SECONDS.observe((_current_route.get(), name), time.perf_counter() - start)
+
+
+def observe(name, seconds):
+    """Records an already measured duration (e.g. the whole request)."""
+    PHASE_SECONDS.observe((_current_route.get(), name), seconds)
+
+
+def count_rows(rows):
+    ROWS_RETURNED.observe((_current_route.get(),), rows)
+
+
+def render_metrics():
+    """All metrics in the Prometheus text exposition format."""
+    return "\n".join(metric.render() for metric in (PHASE_SECONDS, ROWS_RETURNED)) + "\n"
+
+
+# --- Slow-query log ---
+# Opt-in: statements slower than the threshold are logged with their parameters and EXPLAIN plan.
+slow_query_logger = logging.getLogger('slow_query')
+
+def install_slow_query_log(engine, threshold_ms):
+    """Listens on `engine` and logs any SELECT that takes longer than `threshold_ms`."""
+    explain_prefix = "EXPLAIN QUERY PLAN " if engine.dialect.name == 'sqlite' else "EXPLAIN "
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def _start(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def _end(conn, cursor, statement, parameters, context, executemany):
+        elapsed_ms = (time.perf_counter() - conn.info['query_start'].pop()) * 1000
+        if elapsed_ms < threshold_ms or executemany or not statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+            return
+        plan = _explain(engine, explain_prefix + statement, parameters)
+        slow_query_logger.warning(
+            f"Slow query ({elapsed_ms:.0f} ms, route {_current_route.get()}): {statement.strip()} "
+            f"params={parameters} plan={plan}")
+
+
+def _explain(engine, statement, parameters):
+    # A separate connection: the slow query's own cursor may still be streaming its results.
+    try:
+        raw_connection = engine.raw_connection()
+        try:
+            cursor = raw_connection.cursor()
+            cursor.execute(statement, parameters)
+            return cursor.fetchall()
+        finally:
+            raw_connection.close()
+    except Exception as e:
+        return f"EXPLAIN failed: {e}"
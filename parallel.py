@@ -0,0 +1,194 @@
+# parallel.py - Runs a request's independent queries concurrently, each on its own pooled connection
+#
+# run({'name': fn, ...}) hands the calls to a shared thread pool and joins them all before returning,
+# so a request that needs several independent queries waits for roughly the slowest one instead of
+# their sum.
+# - Every call runs in a copy of the caller's context, so metrics phases keep the request's route.
+# - A call that hasn't started when the caller gets round to waiting for it is run by the caller
+#   itself. A busy pool therefore only costs parallelism, and a call that fans out again (the
+#   dimension catalog load inside a page request) can't deadlock the pool.
+# - Every call has a timeout. When it expires, the call's running statements are cancelled: SQLite
+#   connections are interrupted, MySQL statements are stopped with KILL QUERY from another
+#   connection. run() then raises QueryTimeout. Plain Python work can't be interrupted, so run()
+#   only stops waiting for it.
+# - A failing call doesn't cancel the others. run() waits for them (so no connection is left
+#   mid-query) and then re-raises the first error, so the routes' existing error handling applies.
+
+import contextvars
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import event, text
+
+# How long past its timeout run() keeps waiting for a cancelled call to unwind.
+CANCEL_GRACE_SECONDS = 2.0
+
+_current_call = contextvars.ContextVar('parallel_call', default=None)
+
+
+class QueryTimeout(Exception):
+    """A query ran longer than its timeout and was cancelled."""
+
+
+class _Call:
+    """One function handed to run(), plus the connections it has checked out while running."""
+
+    def __init__(self, name, fn, timeout):
+        self.name = name
+        self.fn = fn
+        self.timeout = timeout
+        self.context = contextvars.copy_context()
+        self.connections = []
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.started_at = None
+        self.timed_out = False
+        self.result = None
+        self.error = None
+
+    def claim(self):
+        """Returns True for exactly one thread: the one that gets to run this call."""
+        with self.lock:
+            if self.started_at is not None:
+                return False
+            self.started_at = time.monotonic()
+            return True
+
+
+class ParallelQueries:
+    """
+    A thread pool for running independent queries side by side. `max_workers` should not exceed
+    the connection pool size, or the extra threads only queue for connections; 0 runs every
+    call serially in the calling thread (still with timeouts).
+    """
+
+    def __init__(self, engine, max_workers=5, timeout=30.0):
+        self.engine = engine
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.stats = {'batches': 0, 'calls': 0, 'run_by_caller': 0, 'errors': 0,
+                      'timeouts': 0, 'cancelled_statements': 0}
+        engine.on_create(self._track_connections)
+
+    def _track_connections(self, engine):
+        # Remember which DBAPI connections each call holds, so a timeout knows what to cancel.
+        @event.listens_for(engine, 'checkout')
+        def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+            call = _current_call.get()
+            if call is not None:
+                with call.lock:
+                    call.connections.append(dbapi_connection)
+
+        @event.listens_for(engine, 'checkin')
+        def _on_checkin(dbapi_connection, connection_record):
+            call = _current_call.get()
+            if call is not None:
+                with call.lock:
+                    if dbapi_connection in call.connections:
+                        call.connections.remove(dbapi_connection)
+
+    def _pool(self):
+        # Like the engine, the pool is per process: threads don't survive a fork.
+        if self._executor is not None and self._pid == os.getpid():
+            return self._executor
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='query')
+                self._pid = os.getpid()
+        return self._executor
+
+    def run(self, calls, timeout=None):
+        """
+        Runs every function in `calls` ({name: fn}) and returns {name: fn()} once all are done.
+        Raises QueryTimeout if any call took longer than `timeout` seconds, otherwise the first
+        error raised by a call.
+        """
+        timeout = timeout or self.timeout
+        pending = [_Call(name, fn, timeout) for name, fn in calls.items()]
+        self.stats['batches'] += 1
+        self.stats['calls'] += len(pending)
+
+        if self.max_workers > 0 and len(pending) > 1:
+            executor = self._pool()
+            # The caller runs the first call itself; the others go to the pool.
+            for call in pending[1:]:
+                executor.submit(self._execute, call)
+
+        for call in pending:
+            if self._execute(call):
+                self.stats['run_by_caller'] += 1
+                continue
+            # Already running in the pool: wait until it finishes, or until it should have been cancelled.
+            remaining = call.started_at + call.timeout + CANCEL_GRACE_SECONDS - time.monotonic()
+            if not call.done.wait(max(remaining, 0)):
+                logging.error(f"Query '{call.name}' is still running after being cancelled; not waiting for it.")
+                call.timed_out = True
+
+        for call in pending:
+            if call.timed_out:
+                self.stats['timeouts'] += 1
+                raise QueryTimeout(f"The {call.name} query took longer than {call.timeout:g}s and was cancelled.")
+        for call in pending:
+            if call.error is not None:
+                self.stats['errors'] += 1
+                raise call.error
+        return {call.name: call.result for call in pending}
+
+    def _execute(self, call):
+        """Runs the call in this thread unless another thread already has. Returns whether it ran here."""
+        if not call.claim():
+            return False
+        call.context.run(self._run_call, call)
+        return True
+
+    def _run_call(self, call):
+        token = _current_call.set(call)
+        timer = threading.Timer(call.timeout, self._cancel, (call,))
+        timer.daemon = True
+        timer.start()
+        try:
+            call.result = call.fn()
+        except Exception as e:
+            call.error = e
+        finally:
+            timer.cancel()
+            _current_call.reset(token)
+            call.done.set()
+
+    def _cancel(self, call):
+        # Holding the call's lock keeps its connections from being checked in (and handed to another
+        # request) while their statements are being cancelled.
+        with call.lock:
+            if call.done.is_set():
+                return
+            call.timed_out = True
+            logging.warning(f"Query '{call.name}' exceeded {call.timeout:g}s; cancelling "
+                            f"{len(call.connections)} running statement(s).")
+            for dbapi_connection in call.connections:
+                try:
+                    if self._cancel_statement(dbapi_connection):
+                        self.stats['cancelled_statements'] += 1
+                    else:
+                        logging.warning(f"Can't cancel query '{call.name}' on a {type(dbapi_connection).__name__} "
+                                        f"connection; it runs until it finishes.")
+                except Exception as e:
+                    logging.error(f"Failed to cancel query '{call.name}': {e}")
+
+    def _cancel_statement(self, dbapi_connection):
+        """Stops the statement running on `dbapi_connection`; False if the driver has no way to."""
+        if hasattr(dbapi_connection, 'interrupt'):
+            # sqlite3: safe to call from another thread, the running statement fails with "interrupted".
+            dbapi_connection.interrupt()
+        elif hasattr(dbapi_connection, 'thread_id'):
+            # PyMySQL / mysqlclient: the server stops the statement, the connection stays usable.
+            with self.engine.connect() as connection:
+                connection.execute(text(f"KILL QUERY {int(dbapi_connection.thread_id())}"))
+        else:
+            return False
+        return True
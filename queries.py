@@ -0,0 +1,439 @@
+# queries.py - Filter parsing and query execution shared by the pages and the JSON API
+
+import datetime
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import bindparam, text
+
+import cube
+from metrics import count_rows, phase
+from explore_stats import build_filtered_query, summarize_explore
+from sketch import BUCKET_SQL, merged_quantiles
+from timeseries import DEFAULT_MAX_POINTS, SMOOTHING, build_series
+
+# --- Helper to answer aggregate queries from the monthly cube ---
+# Set USE_MONTHLY_CUBE=0 to always aggregate the raw fact table instead.
+USE_MONTHLY_CUBE = os.getenv("USE_MONTHLY_CUBE", "1") == "1"
+
+def read_sql_prefer_cube(connection, cube_query, fact_query, fact_params):
+    """
+    Runs `cube_query` (a (statement, params) pair, or None if the filters can't be
+    expressed in the cube) against AGG_Monthly_Sales, falling back to `fact_query`
+    (SQL text or a text() statement).
+    """
+    with phase('sql'):
+        if USE_MONTHLY_CUBE and cube_query is not None:
+            statement, params = cube_query
+            try:
+                df = pd.read_sql(statement, connection, params=params)
+                count_rows(len(df))
+                return df
+            except Exception as e:
+                logging.warning(f"Monthly cube query failed, falling back to FACT_Properties: {e}")
+                connection.rollback()
+        if isinstance(fact_query, str):
+            fact_query = text(fact_query)
+        df = pd.read_sql(fact_query, connection, params=fact_params)
+    count_rows(len(df))
+    return df
+
+
+# --- Helpers for sargable date filters ---
+# A predicate like YEAR(p.date_sold) = 2020 can't use an index on date_sold,
+# so years are turned into half-open date ranges instead.
+def year_ranges(years):
+    """Turns years into half-open [start, end) date ranges, merging consecutive years."""
+    ranges = []
+    for year in sorted(set(years)):
+        start, end = datetime.date(year, 1, 1), datetime.date(year + 1, 1, 1)
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+    return ranges
+
+def year_range_condition(years, params, column="p.date_sold"):
+    """Builds '(col >= :year_start_0 AND col < :year_end_0) OR ...' for the years and fills in params."""
+    clauses = []
+    for i, (start, end) in enumerate(year_ranges(years)):
+        clauses.append(f"({column} >= :year_start_{i} AND {column} < :year_end_{i})")
+        params[f'year_start_{i}'] = start
+        params[f'year_end_{i}'] = end
+    return "(" + " OR ".join(clauses) + ")"
+
+
+# --- Filter parsing ---
+# Each page's form and its /api/ endpoint use the same field names, so both are parsed here
+# from any MultiDict (request.form or request.args). Lists are sorted and de-duplicated,
+# so [2024, 2020] and [2020, 2024] give the same filter dict.
+
+def _optional_int(values, name):
+    value = values.get(name)
+    return int(value) if value else None
+
+def _int_list(values, name):
+    return sorted(set(values.getlist(name, type=int)))
+
+def parse_explore_filters(values):
+    return {'year': _optional_int(values, 'year_select'),
+            'suburb_id': _optional_int(values, 'suburb_select'),
+            'layout_id': _optional_int(values, 'layout_select')}
+
+def parse_compare_filters(values):
+    return {'years': _int_list(values, 'year_select'),
+            'suburb_ids': _int_list(values, 'suburb_select'),
+            'layout_ids': _int_list(values, 'layout_select')}
+
+TREND_MAX_SERIES = 20
+TREND_MAX_WINDOW = 24
+
+def parse_trend_filters(values):
+    """
+    /trend draws one series per selected value of `series_by`: 'area' (the suburbs or postcodes,
+    depending on `filter_by`), 'layout' or 'property_type'. The other selections filter the sales.
+    """
+    start_date = values.get('start_date') or None
+    end_date = values.get('end_date') or None
+    # Validate the dates up front; they are used both in SQL and in the cube month check.
+    for value in (start_date, end_date):
+        if value:
+            datetime.date.fromisoformat(value)
+    filters = {'filter_by': values.get('filter_by') or 'suburb',
+               'series_by': values.get('series_by') or 'area',
+               'suburb_ids': _int_list(values, 'suburb_id'),
+               'postcodes': _int_list(values, 'postcode'),
+               'property_types': sorted(set(filter(None, values.getlist('property_type')))),
+               'layout_ids': _int_list(values, 'layout_id'),
+               'start_date': start_date,
+               'end_date': end_date,
+               'smooth': values.get('smooth') or None,
+               'window': _optional_int(values, 'window') or 3,
+               'max_points': _optional_int(values, 'max_points') or DEFAULT_MAX_POINTS}
+    if filters['filter_by'] not in ('suburb', 'postcode'):
+        raise ValueError("Filter by must be 'suburb' or 'postcode'.")
+    if filters['series_by'] not in ('area', 'layout', 'property_type'):
+        raise ValueError("Series by must be 'area', 'layout' or 'property_type'.")
+    if filters['smooth'] not in (None,) + SMOOTHING:
+        raise ValueError("Smoothing must be 'mean' or 'median'.")
+    if not 1 <= filters['window'] <= TREND_MAX_WINDOW:
+        raise ValueError(f"The smoothing window must be between 1 and {TREND_MAX_WINDOW} months.")
+    if not 10 <= filters['max_points'] <= 2000:
+        raise ValueError("max_points must be between 10 and 2000.")
+    # Only one of the two area lists applies (the form posts the hidden one too).
+    if filters['filter_by'] == 'suburb':
+        filters['postcodes'] = []
+    else:
+        filters['suburb_ids'] = []
+    if not filters['smooth']:
+        filters['window'] = None
+    if len(trend_series(filters)[1]) > TREND_MAX_SERIES:
+        raise ValueError(f"Please select at most {TREND_MAX_SERIES} series to compare.")
+    return filters
+
+def trend_series(filters):
+    """The dimension the /trend series are split by ('suburb', 'postcode', 'layout', 'property_type'
+    or None for a single series of all matching sales) and the series keys, in chart order."""
+    dimension = filters['filter_by'] if filters['series_by'] == 'area' else filters['series_by']
+    keys = filters[{'suburb': 'suburb_ids', 'postcode': 'postcodes', 'layout': 'layout_ids',
+                    'property_type': 'property_types'}[dimension]]
+    return (dimension, keys) if keys else (None, [None])
+
+GEO_MAX_RADIUS_KM = 100
+GEO_MAX_NEAREST = 1000
+
+def _optional_float(values, name):
+    value = values.get(name)
+    return float(value) if value else None
+
+def parse_geo_filters(values):
+    """
+    The spatial filter, or None if there is none: mode=radius (lat, lon, radius_km),
+    mode=nearest (lat, lon, k) or mode=bbox (south, west, north, east). Without a mode,
+    a radius or a box is inferred from the fields that are set.
+    """
+    geo = {'mode': values.get('mode') or None,
+           'lat': _optional_float(values, 'lat'), 'lon': _optional_float(values, 'lon'),
+           'radius_km': _optional_float(values, 'radius_km'), 'k': _optional_int(values, 'k'),
+           'south': _optional_float(values, 'south'), 'west': _optional_float(values, 'west'),
+           'north': _optional_float(values, 'north'), 'east': _optional_float(values, 'east')}
+    box = [geo['south'], geo['west'], geo['north'], geo['east']]
+    if geo['mode'] is None:
+        if geo['radius_km'] is not None:
+            geo['mode'] = 'radius'
+        elif any(value is not None for value in box):
+            geo['mode'] = 'bbox'
+        else:
+            return None
+
+    if geo['mode'] in ('radius', 'nearest'):
+        if geo['lat'] is None or geo['lon'] is None:
+            raise ValueError("Please give both a latitude and a longitude.")
+        if not (-90 <= geo['lat'] <= 90 and -180 <= geo['lon'] <= 180):
+            raise ValueError("Latitude must be within -90..90 and longitude within -180..180.")
+        if geo['mode'] == 'radius' and not (geo['radius_km'] and 0 < geo['radius_km'] <= GEO_MAX_RADIUS_KM):
+            raise ValueError(f"The radius must be between 0 and {GEO_MAX_RADIUS_KM} km.")
+        if geo['mode'] == 'nearest' and not (geo['k'] and 0 < geo['k'] <= GEO_MAX_NEAREST):
+            raise ValueError(f"k must be between 1 and {GEO_MAX_NEAREST}.")
+    elif geo['mode'] == 'bbox':
+        if any(value is None for value in box):
+            raise ValueError("A bounding box needs south, west, north and east.")
+        if geo['south'] > geo['north'] or geo['west'] > geo['east']:
+            raise ValueError("The bounding box must have south <= north and west <= east.")
+    else:
+        raise ValueError("mode must be 'radius', 'nearest' or 'bbox'.")
+    return geo
+
+
+# --- Query execution ---
+
+def explore_where(filters):
+    """The WHERE clause and params for the /explore filters (also used by the export)."""
+    conditions = []
+    params = {}
+
+    if filters['year']:
+        conditions.append(year_range_condition([filters['year']], params))
+    if filters['suburb_id']:
+        conditions.append("p.suburb_id = :suburb_id")
+        params['suburb_id'] = filters['suburb_id']
+    if filters['layout_id']:
+        conditions.append("p.layout_id = :layout_id")
+        params['layout_id'] = filters['layout_id']
+
+    where_clause = ""
+    if conditions:
+        where_clause += " WHERE " + " AND ".join(conditions)
+    return where_clause, params
+
+
+def run_explore(engine, filters):
+    """Returns (stats_summary, results_list) for the /explore filters."""
+    with phase('query_build'):
+        where_clause, params = explore_where(filters)
+        # Build the query dynamically.
+        # One query fetches the filtered rows once; the stats summary (min/max rows,
+        # mean, count, median) and the top-100 list are then computed together in NumPy.
+        query_filtered = build_filtered_query(where_clause)
+
+    with engine.connect() as connection, phase('sql'):
+        filtered_df = pd.read_sql(text(query_filtered), connection, params=params)
+    count_rows(len(filtered_df))
+
+    # If no properties match, we can't show stats (and the list stays empty too).
+    with phase('to_dict'):
+        return summarize_explore(filtered_df, limit=100)
+
+
+def run_compare(engine, filters):
+    """
+    Returns one record per (suburb[, layout][, year]) group for the /compare filters, with the
+    count, average and the QUANTILE_COLUMNS (p25, median, p75, p90) read from merged price sketches.
+    """
+    years, suburb_ids, layout_ids = filters['years'], filters['suburb_ids'], filters['layout_ids']
+    if not suburb_ids and not years and not layout_ids:
+        raise ValueError("Please select at least one filter.")
+
+    with phase('query_build'):
+        query_final, params = build_compare_fact_query(years, suburb_ids, layout_ids)
+        # Compares over selected years are answered from the monthly cube, the rest from the fact table.
+        cube_query = cube.build_compare_query(years, suburb_ids, layout_ids)
+        sketch_fact_query, sketch_params = build_compare_fact_query(years, suburb_ids, layout_ids, price_sketch=True)
+        sketch_cube_query = cube.build_compare_query(years, suburb_ids, layout_ids, price_sketch=True)
+    logging.info(f"Executing Dynamic Query: {query_final} with Params: {params}")
+    with engine.connect() as connection:
+        results_df = read_sql_prefer_cube(connection, cube_query, query_final, params)
+        if results_df.empty:
+            return []
+        sketch_df = read_sql_prefer_cube(connection, sketch_cube_query, sketch_fact_query, sketch_params)
+    with phase('to_dict'):
+        group_columns = ['suburb_name'] + (['layout_name'] if layout_ids else []) + (['sale_year'] if years else [])
+        return add_price_quantiles(results_df.to_dict('records'), sketch_df, group_columns)
+
+
+def add_price_quantiles(records, sketch_df, group_columns):
+    """
+    Adds the QUANTILE_COLUMNS to each record, read from its group's merged sketch. `sketch_df` holds
+    (group_columns..., price_bucket, sales_count) rows ordered by group, then bucket, like the
+    price_sketch queries return them.
+    """
+    group_values = [sketch_df[column].to_numpy() for column in group_columns]
+    new_group = np.zeros(len(sketch_df), dtype=bool)
+    new_group[:1] = True
+    for values in group_values:
+        new_group[1:] |= values[1:] != values[:-1]
+    quantiles = merged_quantiles(np.cumsum(new_group), sketch_df['price_bucket'].to_numpy(dtype=np.int64),
+                                 sketch_df['sales_count'].to_numpy(dtype=np.int64))
+    starts = np.flatnonzero(new_group)
+    position = {tuple(values[start] for values in group_values): i for i, start in enumerate(starts.tolist())}
+    for record in records:
+        i = position.get(tuple(record[column] for column in group_columns))
+        # A group without any positive price has no sketch.
+        for column, values in quantiles.items():
+            record[column] = float(values[i]) if i is not None else None
+    return records
+
+
+def build_compare_fact_query(years, suburb_ids, layout_ids, price_sketch=False):
+    """
+    The /compare GROUP BY query on the fact table, as (statement, params). With price_sketch=True
+    it returns each group's price sketch instead: one (price_bucket, sales_count) row per bucket.
+    """
+    # --- Dynamically build SELECT, WHERE, and GROUP BY clauses ---
+    if price_sketch:
+        select_columns = ["s.suburb_name", f"{BUCKET_SQL.format(price='p.price')} AS price_bucket",
+                          "COUNT(*) AS sales_count"]
+        conditions = ["p.price > 0"]
+    else:
+        select_columns = ["s.suburb_name", "COUNT(*) AS total_sales", "AVG(p.price) AS avg_price"]
+        conditions = []
+    group_by_columns = ["s.suburb_name"]
+    params = {}
+    # Add filters and update SELECT/GROUP BY clauses dynamically
+    expanding = []
+    if suburb_ids:
+        conditions.append("p.suburb_id IN :suburb_ids")
+        params['suburb_ids'] = list(suburb_ids); expanding.append('suburb_ids')
+
+    if years:
+        conditions.append(year_range_condition(years, params))
+        select_columns.insert(1, "YEAR(p.date_sold) AS sale_year") # Add to SELECT
+        group_by_columns.append("sale_year") # Add to GROUP BY
+
+    if layout_ids:
+        conditions.append("p.layout_id IN :layout_ids")
+        params['layout_ids'] = list(layout_ids); expanding.append('layout_ids')
+        select_columns.insert(1, "l.layout_name") # Add to SELECT
+        group_by_columns.append("l.layout_name") # Add to GROUP BY
+
+    where_clause = "WHERE " + " AND ".join(conditions)
+    select_clause = ", ".join(select_columns)
+    if price_sketch:
+        group_by_columns.append("price_bucket")
+    group_by_clause = "GROUP BY " + ", ".join(group_by_columns)
+    order_by_clause = "ORDER BY " + ", ".join(group_by_columns)
+
+    # The final, powerful query with GROUP BY on both suburb and year
+    query_final = f"""
+        SELECT {select_clause}
+        FROM FACT_Properties p
+        JOIN DIM_Suburbs s ON p.suburb_id = s.suburb_id
+        JOIN DIM_Layouts l ON p.layout_id = l.layout_id
+        {where_clause}
+        {group_by_clause}
+        {order_by_clause};
+    """
+    # Expanding IN lists render as (?, ?, ...) on any driver.
+    statement = text(query_final).bindparams(*[bindparam(name, expanding=True) for name in expanding])
+    return statement, params
+
+
+def run_trend(engine, filters):
+    """
+    Returns the chart data for the /trend filters (see timeseries.build_series), or None. Every
+    series comes from one grouped query returning a row per (series, month).
+    """
+    dimension, keys = trend_series(filters)
+    with phase('query_build'):
+        query, params = build_trend_fact_query(filters, dimension)
+        # Whole-month date ranges are answered from the monthly cube, anything else from the fact table.
+        cube_query = cube.build_trend_query(dimension, filters['suburb_ids'], filters['postcodes'],
+                                            filters['property_types'], filters['layout_ids'],
+                                            filters['start_date'], filters['end_date'])
+    with engine.connect() as connection:
+        trend_df = read_sql_prefer_cube(connection, cube_query, query, params)
+    if trend_df.empty:
+        return None
+    with phase('to_dict'):
+        months = trend_df['date_month'].astype(str)
+        month_index = months.str[:4].astype(int) * 12 + months.str[5:7].astype(int) - 1
+        if dimension is None:
+            series = np.zeros(len(trend_df), dtype=np.int64)
+        else:
+            series_key = trend_df['series_key']
+            series_key = series_key.astype(str) if dimension == 'property_type' else pd.to_numeric(series_key)
+            series = series_key.map({key: i for i, key in enumerate(keys)}).fillna(-1).to_numpy(dtype=np.int64)
+        known = series >= 0
+        return build_series(keys, series[known], month_index.to_numpy()[known],
+                            pd.to_numeric(trend_df['sales_count']).to_numpy()[known],
+                            pd.to_numeric(trend_df['price_sum']).to_numpy(dtype=np.float64)[known],
+                            smooth=filters['smooth'], window=filters['window'], max_points=filters['max_points'])
+
+
+# The fact-table column of each /trend series dimension.
+TREND_SERIES_COLUMNS = {'suburb': 'p.suburb_id', 'postcode': 's.postcode', 'layout': 'p.layout_id',
+                        'property_type': 'p.property_type'}
+
+def build_trend_fact_query(filters, dimension=None):
+    """The /trend query on the fact table, as (statement, params): sales count and price sum per
+    (series_key, date_month), where series_key is the `dimension` column (left out for None)."""
+    start_date, end_date = filters['start_date'], filters['end_date']
+
+    select_columns = ["DATE_FORMAT(p.date_sold, '%Y-%m') AS date_month",
+                      "COUNT(*) AS sales_count", "SUM(p.price) AS price_sum"]
+    group_by_columns = ["date_month"]
+    if dimension is not None:
+        select_columns.insert(0, f"{TREND_SERIES_COLUMNS[dimension]} AS series_key")
+        group_by_columns.insert(0, TREND_SERIES_COLUMNS[dimension])
+
+    conditions = ["p.date_sold IS NOT NULL"]  # A sale without a date has no month to be charted in
+    params = {}
+    expanding = []
+    for name, column in (('suburb_ids', 'p.suburb_id'), ('postcodes', 's.postcode'),
+                         ('property_types', 'p.property_type'), ('layout_ids', 'p.layout_id')):
+        if filters[name]:
+            conditions.append(f"{column} IN :{name}")
+            params[name] = list(filters[name]); expanding.append(name)
+    if start_date:
+        conditions.append("p.date_sold >= :start_date"); params['start_date'] = start_date
+    if end_date:
+        # Half-open range: everything before the day after end_date.
+        conditions.append("p.date_sold < :end_date_exclusive")
+        params['end_date_exclusive'] = datetime.date.fromisoformat(end_date) + datetime.timedelta(days=1)
+
+    query = f"""
+        SELECT {", ".join(select_columns)}
+        FROM FACT_Properties p
+        JOIN DIM_Suburbs s ON p.suburb_id = s.suburb_id
+        WHERE {" AND ".join(conditions)}
+        GROUP BY {", ".join(group_by_columns)};
+    """
+    return text(query).bindparams(*[bindparam(name, expanding=True) for name in expanding]), params
+
+
+def trend_series_label(dimensions, dimension, key):
+    """The legend label of one /trend series."""
+    if dimension == 'suburb':
+        return dimensions.suburb_names.get(key, str(key)).title()
+    if dimension == 'postcode':
+        return f"Postcode {key}"
+    if dimension == 'layout':
+        return dimensions.layout_names.get(key, str(key))
+    if dimension == 'property_type':
+        return key.replace('-', ' ').title()
+    return "All Sales"
+
+def label_trend(dimensions, filters, chart_data):
+    """A copy of run_trend()'s chart data with a legend label on every series."""
+    dimension = trend_series(filters)[0]
+    return {'series': [{**series, 'label': trend_series_label(dimensions, dimension, series['key'])}
+                       for series in chart_data['series']]}
+
+def trend_title(dimensions, filters):
+    """The chart heading, e.g. 'Price Trend for Applecross & House & 4b2b' or 'Price Trend for 5 Suburbs'."""
+    dimension = trend_series(filters)[0]
+    title_parts = []
+    for name, plural, keys in (('suburb', 'Suburbs', filters['suburb_ids']),
+                               ('postcode', 'Postcodes', filters['postcodes']),
+                               ('property_type', 'Property Types', filters['property_types']),
+                               ('layout', 'Layouts', filters['layout_ids'])):
+        if name == dimension and len(keys) > 1:
+            title_parts.append(f"{len(keys)} {plural}")
+        elif keys:
+            title_parts.append(", ".join(trend_series_label(dimensions, name, key) for key in keys))
+    title = "Price Trend for " + " & ".join(title_parts) if title_parts else "Overall Market Trend"
+    if filters['smooth']:
+        title += f" ({filters['window']}-Month Rolling {filters['smooth'].title()})"
+    return title
@@ -0,0 +1,161 @@
+# result_cache.py - Server-side cache for query results, shared by the pages and the JSON API
+#
+# Entries are keyed on (query name, canonical filter dict, data version), so [2020, 2024] and
+# [2024, 2020] hit the same entry, and a data version bump makes every older entry unreachable.
+# Values are stored pickled: that gives an exact size for the memory bound, and every hit returns
+# a fresh copy that the caller may mutate (compare() adds colors to its records).
+
+import hashlib
+import json
+import logging
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+
+def make_key(name, filters, version):
+    payload = json.dumps([name, filters, version], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class LocalLRUBackend:
+    """In-process LRU with a byte budget and a per-entry TTL."""
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, blob)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, blob = entry
+            if expires_at < time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                return None
+            self._entries.move_to_end(key)
+            return blob
+
+    def set(self, key, blob):
+        if len(blob) > self.max_bytes:
+            return  # Never let one huge result flush the whole cache.
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, blob)
+            self._bytes += len(blob)
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, blob = self._entries.pop(key)
+        self._bytes -= len(blob)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def usage(self):
+        return {'entries': len(self._entries), 'bytes': self._bytes, 'max_bytes': self.max_bytes,
+                'evictions': self.evictions, 'expirations': self.expirations}
+
+
+class RedisBackend:
+    """
+    Shared backend so all gunicorn workers see each other's results. Redis does the LRU/TTL
+    eviction (configure maxmemory-policy allkeys-lru on the server); invalidation bumps a
+    generation number that is part of every key.
+    """
+
+    def __init__(self, url, ttl, prefix='perth:results'):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("RESULT_CACHE_REDIS_URL is set but the 'redis' package is not installed.") from e
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def _generation(self):
+        return int(self.client.get(f'{self.prefix}:generation') or 0)
+
+    def get(self, key):
+        return self.client.get(f'{self.prefix}:{self._generation()}:{key}')
+
+    def set(self, key, blob):
+        self.client.setex(f'{self.prefix}:{self._generation()}:{key}', self.ttl, blob)
+
+    def clear(self):
+        self.client.incr(f'{self.prefix}:generation')
+
+    def usage(self):
+        info = self.client.info('memory')
+        return {'bytes': info.get('used_memory'), 'max_bytes': info.get('maxmemory')}
+
+
+class ResultCache:
+    """
+    Front of the query functions: get_or_compute() returns the cached result or runs `compute`.
+    A failing backend (e.g. Redis down) never fails the request; the query just runs uncached.
+    """
+
+    def __init__(self, backend, enabled=True):
+        self.backend = backend
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self._version = None
+
+    def get_or_compute(self, name, filters, version, compute):
+        if not self.enabled or version is None:
+            # No version means the database couldn't be reached, so nothing can be keyed safely.
+            return compute()
+        if version != self._version:
+            # The data changed: local entries for the old version can never be hit again, so free
+            # them now. Shared entries are left to expire, other workers may still be on that version.
+            if self._version is not None and isinstance(self.backend, LocalLRUBackend):
+                self.backend.clear()
+            self._version = version
+
+        key = make_key(name, filters, version)
+        try:
+            blob = self.backend.get(key)
+        except Exception as e:
+            self.errors += 1
+            logging.warning(f"Result cache read failed: {e}")
+            blob = None
+        if blob is not None:
+            self.hits += 1
+            return pickle.loads(blob)
+
+        self.misses += 1
+        result = compute()
+        try:
+            self.backend.set(key, pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+        except Exception as e:
+            self.errors += 1
+            logging.warning(f"Result cache write failed: {e}")
+        return result
+
+    def invalidate(self):
+        """Drops every cached result (called after writes that don't bump the data version)."""
+        self.backend.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'enabled': self.enabled, 'backend': type(self.backend).__name__,
+                'hits': self.hits, 'misses': self.misses, 'errors': self.errors,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else None,
+                **self.backend.usage()}
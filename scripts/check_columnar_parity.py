@@ -0,0 +1,145 @@
+# check_columnar_parity.py - Checks that the in-memory backend returns the same results as the SQL queries
+#
+# Runs a grid of /explore, /compare and /trend filters through queries.run_* (the fact table, not
+# the cube) and through columnar.ColumnarFacts, and compares every value. The synthetic data includes
+# sales with a NULL or unknown suburb or layout and sales without a date, so both backends must apply
+# the same joins. Exits 1 on any mismatch.
+#
+# Usage (from the repo root):
+#   python scripts/check_columnar_parity.py                       # the app's perth_property_db
+#   python scripts/check_columnar_parity.py --synthetic 200000    # a generated SQLite stand-in
+
+import argparse
+import itertools
+import math
+import numbers
+import os
+import sys
+import tempfile
+
+from sqlalchemy import create_engine
+from werkzeug.datastructures import MultiDict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import queries  # noqa: E402
+from columnar import load_columnar  # noqa: E402
+
+
+def same(a, b):
+    """Equal up to float rounding (DECIMAL averages vs float64) and date/str/None representations."""
+    if isinstance(a, dict) and isinstance(b, dict):
+        return a.keys() == b.keys() and all(same(a[key], b[key]) for key in a)
+    if isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+        return len(a) == len(b) and all(same(x, y) for x, y in zip(a, b))
+    for value in (a, b):
+        if value is None or (isinstance(value, float) and math.isnan(value)):
+            return (a is None or (isinstance(a, float) and math.isnan(a))) and \
+                   (b is None or (isinstance(b, float) and math.isnan(b)))
+    try:
+        return math.isclose(float(a), float(b), rel_tol=1e-9, abs_tol=1e-6)
+    except (TypeError, ValueError):
+        return str(a)[:10] == str(b)[:10] if hasattr(a, 'isoformat') or hasattr(b, 'isoformat') else str(a) == str(b)
+
+
+def same_explore(expected, actual):
+    """Like same(), but rows that tie on price may come in any order (and any of them may fill the
+    last places of the top list), as with the original ORDER BY price DESC LIMIT."""
+    (expected_stats, expected_top), (actual_stats, actual_top) = expected, actual
+    if not same(expected_stats, actual_stats) or len(expected_top) != len(actual_top):
+        return False
+    if not same([row['Price'] for row in expected_top], [row['Price'] for row in actual_top]):
+        return False
+    last_price = expected_top[-1]['Price'] if expected_top else None
+
+    def by_price(rows):
+        groups = {}
+        for row in rows:
+            if row['Price'] != last_price:
+                groups.setdefault(row['Price'], []).append(
+                    [str(float(v)) if isinstance(v, numbers.Real) else str(v) for v in row.values()])
+        return {price: sorted(group) for price, group in groups.items()}
+    return by_price(expected_top) == by_price(actual_top)
+
+
+def explore_cases(years, suburb_ids, layout_ids):
+    for year, suburb_id, layout_id in itertools.product([None] + years[:2], [None] + suburb_ids[:3], [None] + layout_ids[:2]):
+        yield {'year': year, 'suburb_id': suburb_id, 'layout_id': layout_id}
+    yield {'year': None, 'suburb_id': 10 ** 9, 'layout_id': None}  # unknown id: no rows
+
+
+def compare_cases(years, suburb_ids, layout_ids):
+    for chosen_years, chosen_suburbs, chosen_layouts in itertools.product(
+            [[], years[:1], years[:3]], [[], suburb_ids[:1], suburb_ids[:4]], [[], layout_ids[:2]]):
+        if chosen_years or chosen_suburbs or chosen_layouts:
+            yield {'years': chosen_years, 'suburb_ids': chosen_suburbs, 'layout_ids': chosen_layouts}
+
+
+def trend_cases(years, suburb_ids, layout_ids, postcodes, property_types):
+    year = years[0]
+    for filter_by, layout_id, property_type, dates in itertools.product(
+            ['suburb', 'postcode'], [None, layout_ids[0]], [None, property_types[0]],
+            [(None, None), (f'{year}-01-01', f'{year}-12-31'), (f'{year}-02-14', f'{year}-09-03')]):
+        yield trend_filters(filter_by=filter_by, suburb_id=suburb_ids[:1], postcode=postcodes[:1],
+                            property_type=[property_type] if property_type else [],
+                            layout_id=[layout_id] if layout_id else [], start_date=dates[0], end_date=dates[1])
+    # Several series at once, by each dimension, raw and smoothed, and downsampled to a few points.
+    for series_by, smooth, window, max_points in [('area', None, None, None), ('area', 'mean', 3, None),
+                                                  ('area', 'median', 6, 20), ('layout', 'median', 3, None),
+                                                  ('property_type', 'mean', 12, 10)]:
+        yield trend_filters(series_by=series_by, suburb_id=suburb_ids, layout_id=layout_ids,
+                            property_type=[p for p in property_types if p], smooth=smooth, window=window,
+                            max_points=max_points)
+
+
+def trend_filters(**fields):
+    """A /trend filter dict, parsed from form fields like the page does (None and [] leave a field out)."""
+    values = MultiDict()
+    for name, value in fields.items():
+        for item in (value if isinstance(value, list) else [value]):
+            if item is not None:
+                values.add(name, str(item))
+    return queries.parse_trend_filters(values)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the SQL and in-memory analytics backends.')
+    parser.add_argument('--synthetic', type=int, default=0, help='rows for a generated SQLite stand-in')
+    args = parser.parse_args()
+
+    if args.synthetic:
+        from benchmarks.generator import generate_star_schema, register_mysql_functions, seed_unjoined_sales
+        engine = create_engine(f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'parity.db')}")
+        register_mysql_functions(engine)
+        generate_star_schema(engine, args.synthetic, build_cube=False)
+        seed_unjoined_sales(engine)
+    else:
+        import app as app_module
+        engine = app_module.engine
+    queries.USE_MONTHLY_CUBE = False  # Compare against the raw fact table.
+
+    facts = load_columnar(engine, version='parity')
+    years = sorted(set(int(y) for y in facts.year if y), reverse=True)
+    suburb_ids = [int(i) for i in facts.suburb_ids[:5]]
+    layout_ids = [int(i) for i in facts.layout_ids[:3]]
+    postcodes = [int(p) for p in facts.suburb_postcodes[:1]]
+    property_types = list(facts.property_types[:3]) or [None]
+
+    checks = (
+        [('explore', queries.run_explore, facts.explore, f) for f in explore_cases(years, suburb_ids, layout_ids)]
+        + [('compare', queries.run_compare, facts.compare, f) for f in compare_cases(years, suburb_ids, layout_ids)]
+        + [('trend', queries.run_trend, facts.trend, f)
+           for f in trend_cases(years, suburb_ids, layout_ids, postcodes, property_types)])
+
+    failures = 0
+    for name, run_sql, run_memory, filters in checks:
+        expected, actual = run_sql(engine, filters), run_memory(filters)
+        if not (same_explore if name == 'explore' else same)(expected, actual):
+            failures += 1
+            print(f"FAIL {name} {filters}")
+    print(f"{len(checks) - failures}/{len(checks)} cases identical.")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# check_cube_parity.py - Checks that the monthly cube returns the same /trend and /compare results as the fact table
+#
+# Runs the /trend and /compare filter grids of check_columnar_parity.py through queries.run_* twice,
+# with USE_MONTHLY_CUBE on and off, and compares every value. The synthetic data includes sales with
+# a NULL or unknown suburb or layout and sales without a date, so the two paths must agree on which
+# sales they count. Exits 1 on any mismatch, or if a cube query failed and fell back to the fact table.
+#
+# Usage (from the repo root):
+#   python scripts/check_cube_parity.py                      # the app's perth_property_db
+#   python scripts/check_cube_parity.py --synthetic 50000    # a generated SQLite stand-in
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+
+import pandas as pd
+from sqlalchemy import create_engine, text
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import cube  # noqa: E402
+import queries  # noqa: E402
+from check_columnar_parity import compare_cases, same, trend_cases  # noqa: E402
+
+
+class FallbackCounter(logging.Handler):
+    """Counts the 'Monthly cube query failed' warnings of queries.read_sql_prefer_cube."""
+
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.count = 0
+
+    def emit(self, record):
+        if record.getMessage().startswith("Monthly cube query failed"):
+            self.count += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the cube and fact-table answers of /trend and /compare.')
+    parser.add_argument('--synthetic', type=int, default=0, help='rows for a generated SQLite stand-in')
+    args = parser.parse_args()
+
+    if args.synthetic:
+        from benchmarks.generator import generate_star_schema, register_mysql_functions, seed_unjoined_sales
+        engine = create_engine(f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'cube.db')}")
+        register_mysql_functions(engine)
+        generate_star_schema(engine, args.synthetic, build_cube=False)
+        seed_unjoined_sales(engine)
+        with engine.begin() as connection:
+            cube.refresh_monthly_cube(connection)
+    else:
+        import app as app_module
+        engine = app_module.engine
+
+    with engine.connect() as connection:
+        years = [int(y) for y in pd.read_sql(text(
+            "SELECT DISTINCT YEAR(date_sold) AS y FROM FACT_Properties WHERE date_sold IS NOT NULL ORDER BY y DESC"),
+            connection)['y']]
+        suburbs = pd.read_sql(text("SELECT suburb_id, postcode FROM DIM_Suburbs ORDER BY suburb_id LIMIT 5"), connection)
+        layout_ids = [int(i) for i in pd.read_sql(text(
+            "SELECT layout_id FROM DIM_Layouts ORDER BY layout_id LIMIT 3"), connection)['layout_id']]
+        property_types = list(pd.read_sql(text(
+            "SELECT DISTINCT property_type FROM FACT_Properties WHERE property_type IS NOT NULL "
+            "ORDER BY property_type LIMIT 3"), connection)['property_type'])
+    suburb_ids = [int(i) for i in suburbs['suburb_id']]
+    postcodes = [int(suburbs['postcode'].iloc[0])]
+
+    checks = ([('compare', queries.run_compare, f) for f in compare_cases(years, suburb_ids, layout_ids)]
+              + [('trend', queries.run_trend, f)
+                 for f in trend_cases(years, suburb_ids, layout_ids, postcodes, property_types)])
+
+    fallbacks = FallbackCounter()
+    logging.getLogger().addHandler(fallbacks)
+    failures = 0
+    for name, run, filters in checks:
+        queries.USE_MONTHLY_CUBE = False
+        expected = run(engine, filters)
+        queries.USE_MONTHLY_CUBE = True
+        actual = run(engine, filters)
+        if not same(expected, actual):
+            failures += 1
+            print(f"FAIL {name} {filters}")
+    print(f"{len(checks) - failures}/{len(checks)} cases identical, {fallbacks.count} cube query failure(s).")
+    sys.exit(1 if failures or fallbacks.count else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+# check_export.py - Checks that /explore/export streams every row, in EXPORT_BATCH_ROWS-sized batches
+#
+# Exports a grid of /explore filters through export.stream_batches as CSV and as Parquet and checks:
+# the CSV has a header plus one line per matching row; the Parquet file has the same rows, one row
+# group per batch of EXPORT_BATCH_ROWS (not one per row), and its prices equal the database's to the
+# cent; and the row count equals the /explore "total sales" for the same filters. The synthetic data
+# includes sales with a NULL or unknown suburb or layout, which both must count. Exits 1 on any mismatch.
+#
+# Usage (from the repo root):
+#   python scripts/check_export.py                       # the app's perth_property_db
+#   python scripts/check_export.py --synthetic 20000     # a generated SQLite stand-in
+
+import argparse
+import csv
+import io
+import math
+import os
+import sys
+import tempfile
+
+from sqlalchemy import create_engine
+from werkzeug.datastructures import MultiDict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import queries  # noqa: E402
+from export import (EXPORT_BATCH_ROWS, EXPORT_COLUMNS, count_export_rows, csv_chunks,  # noqa: E402
+                    parquet_chunks, stream_batches)
+
+
+def check(engine, label, filters):
+    """Exports `filters` both ways; returns a list of problems (empty when everything matches)."""
+    import pyarrow.parquet as pq
+
+    expected_rows = count_export_rows(engine, filters)
+    expected_groups = math.ceil(expected_rows / EXPORT_BATCH_ROWS)
+    problems = []
+
+    stats_summary, _ = queries.run_explore(engine, filters)
+    total_sales = stats_summary['total_sales'] if stats_summary else 0
+    if total_sales != expected_rows:
+        problems.append(f"/explore counts {total_sales:,} sales, the export {expected_rows:,}")
+
+    lines = list(csv.reader(io.StringIO(b"".join(csv_chunks(stream_batches(engine, filters))).decode('utf-8'))))
+    if lines[0] != EXPORT_COLUMNS or len(lines) - 1 != expected_rows:
+        problems.append(f"CSV has {len(lines) - 1:,} rows, expected {expected_rows:,}")
+
+    parquet = pq.ParquetFile(io.BytesIO(b"".join(parquet_chunks(stream_batches(engine, filters)))))
+    if parquet.metadata.num_rows != expected_rows:
+        problems.append(f"Parquet has {parquet.metadata.num_rows:,} rows, expected {expected_rows:,}")
+    if parquet.metadata.num_row_groups != expected_groups:
+        problems.append(f"Parquet has {parquet.metadata.num_row_groups:,} row groups, expected {expected_groups:,}")
+    csv_prices = sorted(round(float(line[2]), 2) for line in lines[1:])
+    parquet_prices = sorted(float(price) for price in parquet.read(columns=['price']).column('price').to_pylist())
+    if csv_prices != parquet_prices:
+        problems.append("Parquet prices differ from the CSV")
+
+    status = 'ok' if not problems else 'MISMATCH'
+    print(f"{label:<40}{expected_rows:>10,} rows{parquet.metadata.num_row_groups:>6} row groups  {status}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the /explore export batching and encodings.')
+    parser.add_argument('--synthetic', type=int, default=None,
+                        help='generate this many rows into a temporary SQLite file instead of using MySQL')
+    args = parser.parse_args()
+
+    if args.synthetic:
+        from benchmarks.generator import generate_star_schema, register_mysql_functions, seed_unjoined_sales
+        engine = create_engine(f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'export.db')}?detect_types=1")
+        register_mysql_functions(engine)
+        generate_star_schema(engine, args.synthetic)
+        seed_unjoined_sales(engine)
+    else:
+        import app as app_module
+        engine = app_module.engine
+
+    cases = [('all sales', {}), ('suburb 1', {'suburb_select': '1'}), ('2020', {'year_select': '2020'}),
+             ('2019, suburb 2, layout 1', {'year_select': '2019', 'suburb_select': '2', 'layout_select': '1'}),
+             ('no matches', {'year_select': '1900'})]
+    problems = []
+    for label, fields in cases:
+        filters = queries.parse_explore_filters(MultiDict(fields))
+        problems += [f"{label}: {problem}" for problem in check(engine, label, filters)]
+
+    for problem in problems:
+        print(problem)
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+# check_query_plans.py - Shows which plan MySQL picks for every route's generated SQL
+#
+# Drives /explore, /compare and /trend through the Flask test client, captures each query they send
+# to FACT_Properties and runs EXPLAIN on it with the same parameters. Each case names the access type
+# the indexes in create_tables.sql were designed to give the fact table ('range' for year and
+# date-range filters, 'ref' for equality-only filters) and the indexes meant to serve it. The script
+# prints the observed plan next to that one and fails on any difference, including 'ALL' and 'index'
+# (a full scan of the table or of an index) and 'index_merge'.
+#
+# Needs MySQL: EXPLAIN output and access types are MySQL's, so there is no --synthetic SQLite mode.
+# The expectations below are the design, not recorded results: this has not yet been run against a
+# loaded perth_property_db.
+#
+# Usage (from the repo root, against a loaded perth_property_db with the indexes from create_tables.sql):
+#   python scripts/check_query_plans.py
+
+import os
+import sys
+
+from sqlalchemy import event
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app as app_module  # noqa: E402
+import queries  # noqa: E402
+
+
+def representative_requests(dimensions):
+    """Filter mixes that the pages send in practice, built from real ids in the database.
+
+    Each case is (route, form, expected access type, indexes that may serve it).
+    """
+    year = dimensions['available_years'][0]
+    years = list(dimensions['available_years'][:2])
+    suburb_id = dimensions['suburbs'][0]['suburb_id']
+    suburb_ids = [item['suburb_id'] for item in dimensions['suburbs'][:3]]
+    layout_id = dimensions['layouts'][0]['layout_id']
+    property_type = dimensions['property_types'][0]
+    return [
+        ('/explore', {'year_select': year}, 'range', {'idx_fact_date_price'}),
+        ('/explore', {'year_select': year, 'suburb_select': suburb_id},
+         'range', {'idx_fact_suburb_date', 'idx_fact_date_price'}),
+        ('/explore', {'suburb_select': suburb_id, 'layout_select': layout_id},
+         'ref', {'idx_fact_suburb_date', 'idx_fact_layout_date'}),
+        ('/compare', {'suburb_select': suburb_ids, 'year_select': years},
+         'range', {'idx_fact_suburb_date', 'idx_fact_date_price'}),
+        ('/compare', {'layout_select': [layout_id], 'year_select': years},
+         'range', {'idx_fact_layout_date', 'idx_fact_date_price'}),
+        # suburb_id = ? AND date_sold IS NOT NULL covers both key parts of idx_fact_suburb_date.
+        ('/trend', {'filter_by': 'suburb', 'suburb_id': suburb_id}, 'range', {'idx_fact_suburb_date'}),
+        ('/trend', {'filter_by': 'suburb', 'suburb_id': suburb_id,
+                    'start_date': f'{year}-01-15', 'end_date': f'{year}-06-15'},
+         'range', {'idx_fact_suburb_date'}),
+        ('/trend', {'filter_by': 'postcode', 'property_type': property_type,
+                    'start_date': f'{year}-01-01', 'end_date': f'{year}-12-31'},
+         'range', {'idx_fact_type_date'}),
+    ]
+
+
+def explain(engine, statement, parameters):
+    """Runs EXPLAIN on a DBAPI-level statement and returns its rows as dicts."""
+    raw_connection = engine.raw_connection()
+    try:
+        cursor = raw_connection.cursor()
+        cursor.execute("EXPLAIN " + statement, parameters)
+        columns = [description[0] for description in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+    finally:
+        raw_connection.close()
+
+
+def main():
+    # The real per-process engine, so the event listener and EXPLAIN see the app's own pool.
+    engine = app_module.engine.get()
+    # Aggregates must come from the fact table here; the cube has its own small indexes.
+    queries.USE_MONTHLY_CUBE = False
+    # Every request must reach the database, not the result cache.
+    app_module.result_cache.enabled = False
+    dimensions = app_module.dimension_catalog.get()
+
+    captured = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if 'FACT_Properties p' in statement:
+            captured.append((statement, parameters))
+
+    event.listen(engine, 'before_cursor_execute', capture)
+    client = app_module.app.test_client()
+
+    failures = 0
+    for route, form, expected_type, expected_keys in representative_requests(dimensions):
+        captured.clear()
+        client.post(route, data=form)
+        if not captured:
+            print(f"FAIL {route} {form}: no FACT_Properties query was captured")
+            failures += 1
+            continue
+        for statement, parameters in captured:
+            plan = explain(engine, statement, parameters)
+            fact_rows = [row for row in plan if row.get('table') == 'p']
+            ok = bool(fact_rows) and all(
+                row['type'] == expected_type and row['key'] in expected_keys for row in fact_rows)
+            summary = ", ".join(f"{row['type']} via {row['key']}" for row in fact_rows) or 'no fact table row'
+            wanted = f"{expected_type} via {' or '.join(sorted(expected_keys))}"
+            print(f"{'ok  ' if ok else 'FAIL'} {route} {form}: {summary} (expected {wanted})")
+            failures += 0 if ok else 1
+
+    event.remove(engine, 'before_cursor_execute', capture)
+    print(f"\n{failures} failing quer{'y' if failures == 1 else 'ies'}.")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
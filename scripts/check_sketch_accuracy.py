@@ -0,0 +1,122 @@
+# check_sketch_accuracy.py - Checks the /compare percentiles against exact values from the raw prices
+#
+# Runs random /compare filter combinations through queries.run_compare (which merges the sketches in
+# AGG_Monthly_Price_Sketch) and compares every group's p25 / median / p75 / p90 with the exact order
+# statistic computed from FACT_Properties. Each must be within sketch.ALPHA (relative), the bound
+# documented in sketch.py. Also checks that sketches bucketed straight from the fact table (the
+# fallback) give the same numbers as the stored ones. Exits 1 on any violation.
+#
+# Usage (from the repo root):
+#   python scripts/check_sketch_accuracy.py                       # the app's perth_property_db
+#   python scripts/check_sketch_accuracy.py --synthetic 200000    # a generated SQLite stand-in
+
+import argparse
+import os
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import queries  # noqa: E402
+from sketch import ALPHA, QUANTILE_COLUMNS, exact_quantiles  # noqa: E402
+
+PRICES_QUERY = """
+    SELECT s.suburb_name, l.layout_name, YEAR(p.date_sold) AS sale_year, p.price
+    FROM FACT_Properties p
+    JOIN DIM_Suburbs s ON p.suburb_id = s.suburb_id
+    JOIN DIM_Layouts l ON p.layout_id = l.layout_id
+    WHERE p.date_sold IS NOT NULL AND p.price > 0
+"""
+
+
+def random_filters(rng, years, suburb_ids, layout_ids):
+    """A random /compare selection: any mix of years, suburbs and layouts (at least one filter)."""
+    while True:
+        filters = {
+            'years': sorted(rng.choice(years, rng.integers(1, 5), replace=False).tolist()) if rng.random() < 0.7 else [],
+            'suburb_ids': sorted(rng.choice(suburb_ids, rng.integers(1, 6), replace=False).tolist()) if rng.random() < 0.8 else [],
+            'layout_ids': sorted(rng.choice(layout_ids, rng.integers(1, 4), replace=False).tolist()) if rng.random() < 0.4 else [],
+        }
+        if any(filters.values()):
+            return filters
+
+
+def exact_group_prices(prices, filters, dimension_names):
+    """The raw prices of every /compare group for `filters`, keyed like the result records."""
+    suburb_names, layout_names = dimension_names
+    mask = np.ones(len(prices), dtype=bool)
+    if filters['years']:
+        mask &= prices['sale_year'].isin(filters['years']).to_numpy()
+    if filters['suburb_ids']:
+        mask &= prices['suburb_name'].isin([suburb_names[i] for i in filters['suburb_ids']]).to_numpy()
+    if filters['layout_ids']:
+        mask &= prices['layout_name'].isin([layout_names[i] for i in filters['layout_ids']]).to_numpy()
+    group_columns = (['suburb_name'] + (['layout_name'] if filters['layout_ids'] else [])
+                     + (['sale_year'] if filters['years'] else []))
+    return group_columns, {key if isinstance(key, tuple) else (key,): group['price'].to_numpy(dtype=np.float64)
+                           for key, group in prices[mask].groupby(group_columns)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the /compare percentiles against exact values.')
+    parser.add_argument('--synthetic', type=int, default=0, help='rows for a generated SQLite stand-in')
+    parser.add_argument('--cases', type=int, default=200, help='random filter combinations to check')
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+
+    if args.synthetic:
+        from benchmarks.generator import generate_star_schema, register_mysql_functions
+        engine = create_engine(f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'sketch.db')}")
+        register_mysql_functions(engine)
+        generate_star_schema(engine, args.synthetic)
+    else:
+        import app as app_module
+        engine = app_module.engine
+
+    prices = pd.read_sql(PRICES_QUERY, engine)
+    prices['sale_year'] = prices['sale_year'].astype(int)
+    dimensions = pd.read_sql("SELECT suburb_id, suburb_name FROM DIM_Suburbs", engine)
+    layouts = pd.read_sql("SELECT layout_id, layout_name FROM DIM_Layouts", engine)
+    dimension_names = (dict(zip(dimensions['suburb_id'], dimensions['suburb_name'])),
+                       dict(zip(layouts['layout_id'], layouts['layout_name'])))
+    years = sorted(prices['sale_year'].unique().tolist())
+    suburb_ids, layout_ids = sorted(dimension_names[0]), sorted(dimension_names[1])
+
+    rng = np.random.default_rng(args.seed)
+    worst = {column: 0.0 for column in QUANTILE_COLUMNS}
+    groups = violations = fallback_mismatches = 0
+    for _ in range(args.cases):
+        filters = random_filters(rng, years, suburb_ids, layout_ids)
+        queries.USE_MONTHLY_CUBE = True
+        records = queries.run_compare(engine, filters)
+        queries.USE_MONTHLY_CUBE = False
+        group_columns, exact_prices = exact_group_prices(prices, filters, dimension_names)
+        # Only the percentiles: the averages differ in the last digits between cube and fact table.
+        sketch_view = lambda rows: [[row[column] for column in group_columns + list(QUANTILE_COLUMNS)] for row in rows]
+        if sketch_view(records) != sketch_view(queries.run_compare(engine, filters)):
+            fallback_mismatches += 1
+            print(f"FAIL stored and fact-table sketches differ for {filters}")
+
+        for record in records:
+            exact = exact_quantiles(exact_prices[tuple(record[column] for column in group_columns)])
+            groups += 1
+            for column in QUANTILE_COLUMNS:
+                error = abs(record[column] - exact[column]) / exact[column]
+                worst[column] = max(worst[column], error)
+                if error > ALPHA * (1 + 1e-9):
+                    violations += 1
+                    print(f"FAIL {column} {record[column]:,.0f} vs exact {exact[column]:,.0f} "
+                          f"({error:.3%}) for {filters}")
+
+    print(f"{groups:,} groups in {args.cases} filter combinations; worst relative error (bound {ALPHA:.0%}): "
+          + ", ".join(f"{column} {error:.3%}" for column, error in worst.items()))
+    print(f"{violations} bound violations, {fallback_mismatches} stored/fallback mismatches.")
+    sys.exit(1 if violations or fallback_mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,488 @@
+# fact_loader.py - Streaming, chunked and parallel loader for FACT_Properties
+#
+# Replaces the single df_fact.to_sql(...) call of the ETL notebook for full reloads:
+#   - the source CSV is read in chunks, so peak memory is a few chunks instead of the whole file
+#     plus its merged copies;
+#   - foreign keys are resolved against in-memory dicts (name -> id); new dimension members are
+#     inserted as they are first seen and their ids fetched back once;
+#   - fact rows are written by several writer connections in parallel, either with multi-row
+#     executemany batches or with LOAD DATA LOCAL INFILE.
+#
+# Usage (from the repo root):
+#   python scripts/fact_loader.py perth_property_data.csv
+#   python scripts/fact_loader.py perth_property_data.csv --recreate --workers 4 --chunk-size 50000
+#   python scripts/fact_loader.py perth_property_data.csv --method infile   # needs local_infile=1 on the server
+#   python scripts/fact_loader.py daily_feed.csv --mode incremental         # upsert, no DROP, re-runs are no-ops
+#   python scripts/fact_loader.py perth_property_data.csv --staging staging  # clean once into Parquet (scripts/staging.py)
+
+import argparse
+import logging
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+
+import pandas as pd
+from sqlalchemy import bindparam, create_engine, text
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from catalog import bump_data_version  # noqa: E402
+from cube import refresh_monthly_cube  # noqa: E402
+
+FACT_COLUMNS = [
+    'listing_id', 'price', 'address', 'longitude', 'latitude', 'property_type', 'parking_spaces',
+    'date_sold', 'land_size', 'distance_to_cbd', 'primary_school_distance', 'secondary_school_distance',
+    'suburb_id', 'agency_id', 'layout_id', 'primary_school_id', 'secondary_school_id',
+]
+FK_COLUMNS = ['suburb_id', 'agency_id', 'layout_id', 'primary_school_id', 'secondary_school_id']
+
+# CSV column -> FACT_Properties column, for the columns copied as they are.
+FACT_RENAMES = {
+    'Listing_ID': 'listing_id', 'Price': 'price', 'Address': 'address', 'Longitude': 'longitude',
+    'Latitude': 'latitude', 'Property_Type': 'property_type', 'Parking_Spaces': 'parking_spaces',
+    'Date_Sold': 'date_sold', 'Land_Size': 'land_size', 'Distance_to_CBD': 'distance_to_cbd',
+    'Primary_School_Distance': 'primary_school_distance', 'Secondary_School_Distance': 'secondary_school_distance',
+}
+SOURCE_COLUMNS = list(FACT_RENAMES) + [
+    'Suburb', 'Postcode', 'Agency_Name', 'Bedrooms', 'Bathrooms',
+    'Primary_School_Name', 'Primary_School_ICSEA', 'Secondary_School_Name', 'Secondary_School_ICSEA',
+]
+
+INSERT_FACT_SQL = (f"INSERT INTO FACT_Properties ({', '.join(FACT_COLUMNS)}) "
+                   f"VALUES ({', '.join(['%s'] * len(FACT_COLUMNS))})")
+UPSERT_FACT_SQL = INSERT_FACT_SQL + " ON DUPLICATE KEY UPDATE " + ", ".join(
+    f"{column} = VALUES({column})" for column in FACT_COLUMNS[1:])
+
+# Decimal places each numeric fact column is stored with; used to compare CSV values with the DB.
+NUMERIC_SCALES = {
+    'price': 2, 'longitude': 8, 'latitude': 8, 'parking_spaces': 0, 'land_size': 0, 'distance_to_cbd': 0,
+    'primary_school_distance': 0, 'secondary_school_distance': 0,
+    'suburb_id': 0, 'agency_id': 0, 'layout_id': 0, 'primary_school_id': 0, 'secondary_school_id': 0,
+}
+
+
+def get_engine(db_url=None, local_infile=False):
+    """Same connection settings as app.py, overridable with --db-url."""
+    if db_url is None:
+        db_url = (f"mysql+pymysql://{os.getenv('DB_USER', 'root')}:{os.getenv('DB_PASS', 'password')}"
+                  f"@{os.getenv('DB_HOST', 'localhost')}:{os.getenv('DB_PORT', '3306')}"
+                  f"/{os.getenv('DB_NAME', 'perth_property_db')}")
+    connect_args = {'local_infile': True} if local_infile else {}
+    return create_engine(db_url, connect_args=connect_args)
+
+
+# --- 1. Cleaning (the same rules as the notebook, applied per chunk) ---
+
+def load_corrections(path):
+    """Reads corrections.csv into (ids to delete, {column: Series(listing_id -> new value)})."""
+    if not path or not os.path.exists(path):
+        logging.warning("corrections.csv not found. Proceeding with raw data.")
+        return set(), {}
+    df_corrections = pd.read_csv(path)
+    is_delete = df_corrections['New_Value'] == 'DELETE_ROW'
+    ids_to_delete = set(df_corrections.loc[is_delete, 'Listing_ID'].astype(int))
+    updates = df_corrections.loc[~is_delete].copy()
+    updates['Listing_ID'] = updates['Listing_ID'].astype(int)
+    updates['New_Value'] = pd.to_numeric(updates['New_Value'])
+    by_column = {column: group.drop_duplicates('Listing_ID', keep='last').set_index('Listing_ID')['New_Value']
+                 for column, group in updates.groupby('Column_To_Correct')}
+    return ids_to_delete, by_column
+
+
+def apply_corrections(chunk, ids_to_delete, updates):
+    """Vectorized version of the notebook's iterrows() loop: one isin() and one map() per column."""
+    chunk = chunk[~chunk['Listing_ID'].isin(ids_to_delete)].copy()
+    for column, new_values in updates.items():
+        corrected = chunk['Listing_ID'].map(new_values)
+        chunk[column] = corrected.where(corrected.notna(), chunk[column])
+    return chunk
+
+
+def clean_chunk(chunk):
+    for col in ['Agency_Name', 'Primary_School_Name', 'Secondary_School_Name']:
+        # object with older pandas, 'str' with pandas 3; all-NaN columns are read as float and skipped.
+        if pd.api.types.is_string_dtype(chunk[col]):
+            chunk[col] = chunk[col].str.strip().str.lower()
+    chunk['Date_Sold'] = pd.to_datetime(chunk['Date_Sold'], errors='coerce')
+    chunk = chunk.dropna(subset=['Date_Sold'])
+    chunk['Layout'] = chunk['Bedrooms'].astype(str) + 'b' + chunk['Bathrooms'].astype(str) + 'b'
+    return chunk
+
+
+# --- 2. Foreign key resolution against in-memory lookups ---
+
+class DimensionResolver:
+    """
+    Keeps name -> id dicts for every dimension. Members not seen before are inserted
+    (INSERT IGNORE, so concurrent or repeated runs are safe) and their ids read back once.
+    """
+
+    # dimension: (table, id column, name column, CSV name column, extra {CSV column: table column})
+    DIMENSIONS = {
+        'suburb_id': ('DIM_Suburbs', 'suburb_id', 'suburb_name', 'Suburb', {'Postcode': 'postcode'}),
+        'agency_id': ('DIM_Agencies', 'agency_id', 'agency_name', 'Agency_Name', {}),
+        'layout_id': ('DIM_Layouts', 'layout_id', 'layout_name', 'Layout',
+                      {'Bedrooms': 'bedrooms', 'Bathrooms': 'bathrooms'}),
+        'primary_school_id': ('DIM_Primary_Schools', 'primary_school_id', 'primary_school_name',
+                              'Primary_School_Name', {'Primary_School_ICSEA': 'primary_school_icsea'}),
+        'secondary_school_id': ('DIM_Secondary_Schools', 'secondary_school_id', 'secondary_school_name',
+                                'Secondary_School_Name', {'Secondary_School_ICSEA': 'secondary_school_icsea'}),
+    }
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.lookups = {}
+        self.inserted = {fk: 0 for fk in self.DIMENSIONS}
+        with engine.connect() as connection:
+            for fk, (table, id_col, name_col, _, _) in self.DIMENSIONS.items():
+                rows = connection.execute(text(f"SELECT {name_col}, {id_col} FROM {table}"))
+                self.lookups[fk] = dict(rows.fetchall())
+
+    def resolve(self, chunk):
+        """Adds the five FK columns to `chunk`, inserting unseen dimension members first."""
+        for fk, (table, id_col, name_col, source_col, extra) in self.DIMENSIONS.items():
+            names = chunk[source_col]
+            ids = names.map(self.lookups[fk])
+            unseen = names.notna() & ids.isna()
+            if unseen.any():
+                self._insert_members(chunk.loc[unseen], fk)
+                ids = names.map(self.lookups[fk])
+            chunk[fk] = ids
+        return chunk
+
+    def _insert_members(self, rows, fk):
+        table, id_col, name_col, source_col, extra = self.DIMENSIONS[fk]
+        members = rows[[source_col] + list(extra)].drop_duplicates(subset=[source_col])
+        members = members.astype(object).where(members.notna(), None)
+        columns = [name_col] + list(extra.values())
+        insert = text(f"INSERT IGNORE INTO {table} ({', '.join(columns)}) "
+                      f"VALUES ({', '.join(':' + c for c in columns)})")
+        params = [dict(zip(columns, values)) for values in members.itertuples(index=False, name=None)]
+        with self.engine.begin() as connection:
+            connection.execute(insert, params)
+            fetched = connection.execute(
+                text(f"SELECT {name_col}, {id_col} FROM {table} WHERE {name_col} IN :names")
+                .bindparams(bindparam('names', expanding=True)),
+                {'names': members[source_col].tolist()})
+            self.lookups[fk].update(fetched.fetchall())
+        self.inserted[fk] += len(members)
+
+
+def to_fact_frame(chunk):
+    """Selects and renames the fact columns and drops rows whose foreign keys could not be resolved."""
+    df_fact = chunk.rename(columns=FACT_RENAMES)[FACT_COLUMNS]
+    df_fact = df_fact.dropna(subset=FK_COLUMNS)
+    df_fact = df_fact.astype({fk: 'int64' for fk in FK_COLUMNS})
+    df_fact['date_sold'] = df_fact['date_sold'].dt.date
+    return df_fact
+
+
+# --- 3. Parallel writers ---
+
+class LoadStats:
+    def __init__(self):
+        self.rows = 0
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add(self, rows):
+        with self._lock:
+            self.rows += rows
+
+    @property
+    def rows_per_second(self):
+        return self.rows / max(time.perf_counter() - self.started, 1e-9)
+
+
+def _write_executemany(cursor, df_fact):
+    rows = df_fact.astype(object).where(df_fact.notna(), None).itertuples(index=False, name=None)
+    # PyMySQL rewrites INSERT ... VALUES executemany into multi-row INSERT statements.
+    cursor.executemany(INSERT_FACT_SQL, list(rows))
+
+
+def _write_infile(cursor, df_fact):
+    with tempfile.NamedTemporaryFile('w', suffix='.tsv', delete=False, encoding='utf-8') as f:
+        df_fact.to_csv(f, sep='\t', header=False, index=False, na_rep='\\N', lineterminator='\n')
+        path = f.name
+    try:
+        cursor.execute(f"LOAD DATA LOCAL INFILE %s INTO TABLE FACT_Properties "
+                       f"FIELDS TERMINATED BY '\\t' LINES TERMINATED BY '\\n' ({', '.join(FACT_COLUMNS)})",
+                       (path,))
+    finally:
+        os.remove(path)
+
+
+def _write_upsert(cursor, df_fact):
+    rows = df_fact.astype(object).where(df_fact.notna(), None).itertuples(index=False, name=None)
+    cursor.executemany(UPSERT_FACT_SQL, list(rows))
+
+
+WRITE_METHODS = {'executemany': _write_executemany, 'infile': _write_infile, 'upsert': _write_upsert}
+
+
+def _writer(engine, batches, method, stats, errors):
+    """Writer thread: one connection, one commit per batch, until it receives None."""
+    write = WRITE_METHODS[method]
+    raw_connection = engine.raw_connection()
+    try:
+        cursor = raw_connection.cursor()
+        while True:
+            df_fact = batches.get()
+            if df_fact is None:
+                break
+            if errors:
+                continue  # Keep draining so the reader never blocks on a full queue.
+            try:
+                write(cursor, df_fact)
+                raw_connection.commit()
+                stats.add(len(df_fact))
+            except Exception as e:
+                raw_connection.rollback()
+                errors.append(e)
+    finally:
+        raw_connection.close()
+
+
+def write_facts(engine, fact_frames, workers=4, method='executemany', batch_size=5000, report_every=5.0):
+    """
+    Writes an iterable of fact DataFrames with `workers` parallel connections.
+    Returns the LoadStats; raises the first writer error after all writers have stopped.
+    """
+    batches = queue.Queue(maxsize=workers * 2)  # Bounds memory to a few batches in flight.
+    stats, errors = LoadStats(), []
+    threads = [threading.Thread(target=_writer, args=(engine, batches, method, stats, errors), daemon=True)
+               for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    last_report = time.perf_counter()
+    try:
+        for df_fact in fact_frames:
+            for start in range(0, len(df_fact), batch_size):
+                batches.put(df_fact.iloc[start:start + batch_size])
+            if time.perf_counter() - last_report >= report_every:
+                logging.info(f"{stats.rows:,} rows written ({stats.rows_per_second:,.0f} rows/s)")
+                last_report = time.perf_counter()
+    finally:
+        for _ in threads:
+            batches.put(None)
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+    return stats
+
+
+# --- 4. The full pipeline ---
+
+def recreate_tables(engine, script_path):
+    """Same as the notebook: runs create_tables.sql statement by statement (drops everything)."""
+    with open(script_path, 'r') as f:
+        statements = [s for s in f.read().split(';') if s.strip()]
+    with engine.begin() as connection:
+        for statement in statements:
+            connection.execute(text(statement))
+
+
+def _cleaned_csv_chunks(csv_path, corrections, chunk_size):
+    ids_to_delete, updates = corrections
+    for chunk in pd.read_csv(csv_path, usecols=SOURCE_COLUMNS, chunksize=chunk_size):
+        yield clean_chunk(apply_corrections(chunk, ids_to_delete, updates))
+
+
+def _staged_chunks(csv_path, staging_dir, corrections_path, chunk_size):
+    """Cleaned chunks from the Parquet staging dataset, (re)built first if the CSV changed."""
+    from staging import build_staging, iter_staging
+    build_staging(csv_path, staging_dir, corrections_path=corrections_path, chunk_size=chunk_size)
+    # Strings arrive as categoricals, so FK resolution maps each distinct name once per chunk.
+    yield from iter_staging(staging_dir, columns=SOURCE_COLUMNS + ['Layout'], batch_size=chunk_size)
+
+
+def iter_fact_chunks(csv_path, resolver, corrections, chunk_size, staging_dir=None, corrections_path=None):
+    if staging_dir:
+        chunks = _staged_chunks(csv_path, staging_dir, corrections_path, chunk_size)
+    else:
+        chunks = _cleaned_csv_chunks(csv_path, corrections, chunk_size)
+    for chunk in chunks:
+        chunk = resolver.resolve(chunk)
+        df_fact = to_fact_frame(chunk)
+        dropped = len(chunk) - len(df_fact)
+        if dropped:
+            logging.info(f"Dropped {dropped} rows due to null foreign keys.")
+        yield df_fact
+
+
+def load(csv_path, engine, corrections_path='corrections.csv', chunk_size=50_000, workers=4,
+         method='executemany', recreate=False, script_path=os.path.join('sql', 'create_tables.sql'),
+         staging_dir=None):
+    if recreate:
+        recreate_tables(engine, script_path)
+        logging.info("Executed create_tables.sql (all tables dropped and recreated).")
+
+    resolver = DimensionResolver(engine)
+    corrections = load_corrections(corrections_path)
+    chunks = iter_fact_chunks(csv_path, resolver, corrections, chunk_size,
+                              staging_dir=staging_dir, corrections_path=corrections_path)
+    stats = write_facts(engine, chunks, workers=workers, method=method)
+
+    with engine.begin() as connection:
+        refresh_monthly_cube(connection)
+        bump_data_version(connection)
+
+    elapsed = time.perf_counter() - stats.started
+    logging.info(f"Loaded {stats.rows:,} rows into FACT_Properties in {elapsed:,.1f}s "
+                 f"({stats.rows_per_second:,.0f} rows/s). New dimension members: {resolver.inserted}")
+    return stats
+
+
+# --- 5. The incremental (upsert) pipeline ---
+
+def _normalize(df):
+    """Brings CSV and DB values to one representation (rounded floats, ISO dates, str) for comparison."""
+    normalized = pd.DataFrame(index=df.index)
+    for column in FACT_COLUMNS:
+        if column in NUMERIC_SCALES:
+            normalized[column] = pd.to_numeric(df[column], errors='coerce').astype('float64').round(NUMERIC_SCALES[column])
+        elif column == 'date_sold':
+            normalized[column] = pd.to_datetime(df[column]).dt.strftime('%Y-%m-%d')
+        else:
+            normalized[column] = df[column].astype(object).where(df[column].notna(), None)
+    return normalized
+
+
+def diff_against_existing(connection, df_fact):
+    """
+    Splits a fact chunk by listing_id into new rows and rows whose values differ from the DB.
+    Returns (rows to upsert, n_new, n_changed, months touched incl. the old month of moved sales).
+    """
+    existing = pd.read_sql(
+        text(f"SELECT {', '.join(FACT_COLUMNS)} FROM FACT_Properties WHERE listing_id IN :ids")
+        .bindparams(bindparam('ids', expanding=True)),
+        connection, params={'ids': df_fact['listing_id'].astype(int).tolist()})
+
+    incoming = _normalize(df_fact).set_index('listing_id', drop=False)
+    current = _normalize(existing).set_index('listing_id', drop=False)
+
+    is_new = ~incoming.index.isin(current.index)
+    both = incoming.index[~is_new]
+    a, b = incoming.loc[both], current.loc[both]
+    same = ((a == b) | (a.isna() & b.isna())).all(axis=1)
+    changed_ids = same.index[~same.to_numpy()]
+
+    write_mask = is_new | incoming.index.isin(changed_ids)
+    months = set(pd.to_datetime(incoming.loc[write_mask, 'date_sold']))
+    months.update(pd.to_datetime(current.loc[changed_ids, 'date_sold']))
+    return df_fact[write_mask], int(is_new.sum()), len(changed_ids), months
+
+
+def apply_corrections_in_db(engine, ids_to_delete, updates):
+    """
+    Applies corrections.csv to rows already in FACT_Properties with set-based statements:
+    one DELETE for all DELETE_ROW ids and one UPDATE ... JOIN per corrected column.
+    Only changed rows are touched, so re-applying the same rules is a no-op.
+    Returns (rows deleted, rows updated, months touched).
+    """
+    deleted, updated, months = 0, 0, set()
+    with engine.begin() as connection:
+        if ids_to_delete:
+            ids = {'ids': sorted(int(i) for i in ids_to_delete)}
+            select_ids = bindparam('ids', expanding=True)
+            months.update(pd.to_datetime(row[0]) for row in connection.execute(
+                text("SELECT date_sold FROM FACT_Properties WHERE listing_id IN :ids").bindparams(select_ids), ids))
+            deleted = connection.execute(
+                text("DELETE FROM FACT_Properties WHERE listing_id IN :ids").bindparams(select_ids), ids).rowcount
+
+        for source_column, new_values in updates.items():
+            column = FACT_RENAMES.get(source_column)
+            if column is None:
+                # Postcode corrections belong to DIM_Suburbs and are applied while extracting suburbs.
+                continue
+            connection.execute(text(
+                "CREATE TEMPORARY TABLE IF NOT EXISTS tmp_corrections "
+                "(listing_id BIGINT PRIMARY KEY, new_value DECIMAL(20, 8))"))
+            connection.execute(text("DELETE FROM tmp_corrections"))
+            connection.execute(text("INSERT INTO tmp_corrections VALUES (:listing_id, :new_value)"),
+                               [{'listing_id': int(k), 'new_value': float(v)} for k, v in new_values.items()])
+            months.update(pd.to_datetime(row[0]) for row in connection.execute(text(
+                f"SELECT f.date_sold FROM FACT_Properties f JOIN tmp_corrections c ON c.listing_id = f.listing_id "
+                f"WHERE NOT (f.{column} <=> c.new_value)")))
+            updated += connection.execute(text(
+                f"UPDATE FACT_Properties f JOIN tmp_corrections c ON c.listing_id = f.listing_id "
+                f"SET f.{column} = c.new_value WHERE NOT (f.{column} <=> c.new_value)")).rowcount
+        connection.execute(text("DROP TEMPORARY TABLE IF EXISTS tmp_corrections"))
+    return deleted, updated, months
+
+
+def load_incremental(csv_path, engine, corrections_path='corrections.csv', chunk_size=50_000, workers=4,
+                     staging_dir=None):
+    """
+    Upserts a CSV into the existing tables without dropping anything:
+    new dimension members are inserted, new or changed fact rows are written with
+    INSERT ... ON DUPLICATE KEY UPDATE, unchanged rows are skipped, corrections are applied
+    set-based, and only the touched months of the monthly cube are refreshed.
+    Running the same file twice writes nothing the second time.
+    """
+    resolver = DimensionResolver(engine)
+    ids_to_delete, updates = load_corrections(corrections_path)
+    report = {'rows_read': 0, 'new': 0, 'changed': 0, 'unchanged': 0}
+    months = set()
+
+    def changed_chunks():
+        for df_fact in iter_fact_chunks(csv_path, resolver, (ids_to_delete, updates), chunk_size,
+                                        staging_dir=staging_dir, corrections_path=corrections_path):
+            with engine.connect() as connection:
+                to_write, n_new, n_changed, touched = diff_against_existing(connection, df_fact)
+            report['rows_read'] += len(df_fact)
+            report['new'] += n_new
+            report['changed'] += n_changed
+            report['unchanged'] += len(df_fact) - n_new - n_changed
+            months.update(touched)
+            if not to_write.empty:
+                yield to_write
+
+    write_facts(engine, changed_chunks(), workers=workers, method='upsert')
+
+    report['deleted'], report['corrected'], corrected_months = apply_corrections_in_db(engine, ids_to_delete, updates)
+    months.update(corrected_months)
+
+    if months:
+        # Something changed: refresh the touched cube months and bump the data version together.
+        with engine.begin() as connection:
+            refresh_monthly_cube(connection, months)
+            bump_data_version(connection, months)
+    report['cube_months_refreshed'] = len({(m.year, m.month) for m in months})
+    report['new_dimension_members'] = resolver.inserted
+    logging.info(f"Incremental load finished: {report}")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bulk-load FACT_Properties from the raw property CSV.')
+    parser.add_argument('csv_path')
+    parser.add_argument('--corrections', default='corrections.csv')
+    parser.add_argument('--chunk-size', type=int, default=50_000, help='CSV rows read per chunk')
+    parser.add_argument('--workers', type=int, default=4, help='parallel writer connections')
+    parser.add_argument('--method', choices=['executemany', 'infile'], default='executemany')
+    parser.add_argument('--mode', choices=['full', 'incremental'], default='full',
+                        help='full: append everything; incremental: upsert new/changed rows only')
+    parser.add_argument('--recreate', action='store_true', help='drop and recreate all tables first (full mode)')
+    parser.add_argument('--staging', default=None, metavar='DIR',
+                        help='clean into a Parquet staging dataset in DIR (skipped if the CSV is unchanged) and load from it')
+    parser.add_argument('--db-url', default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    engine = get_engine(args.db_url, local_infile=args.method == 'infile')
+    if args.mode == 'incremental':
+        load_incremental(args.csv_path, engine, corrections_path=args.corrections,
+                         chunk_size=args.chunk_size, workers=args.workers, staging_dir=args.staging)
+    else:
+        load(args.csv_path, engine, corrections_path=args.corrections, chunk_size=args.chunk_size,
+             workers=args.workers, method=args.method, recreate=args.recreate, staging_dir=args.staging)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+# staging.py - Typed, year-partitioned Parquet staging dataset for the ETL
+#
+# The cleaning stage (corrections.csv, text normalization, date parsing, the Layout feature) runs
+# once over the raw CSV, in chunks, and writes the result as Parquet under <staging_dir>/Sale_Year=YYYY/.
+# Strings are stored as dictionary columns (pandas categoricals), numbers and dates keep their types,
+# so downstream steps don't re-parse text or re-infer dtypes. They read only the columns and years
+# they need, memory-mapped.
+#
+# A manifest records a SHA-256 of the CSV, corrections.csv and STAGING_VERSION; building again from
+# unchanged inputs is skipped. Bump STAGING_VERSION whenever the cleaning rules change.
+#
+# Usage (from the repo root):
+#   python scripts/staging.py perth_property_data.csv                 # -> staging/
+#   python scripts/staging.py perth_property_data.csv --force
+#   python scripts/fact_loader.py perth_property_data.csv --staging staging --recreate
+
+import argparse
+import datetime
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fact_loader import apply_corrections, clean_chunk, load_corrections  # noqa: E402
+
+STAGING_VERSION = 1
+MANIFEST_NAME = '_manifest.json'
+PARTITION_COLUMN = 'Sale_Year'
+PARTITIONING = ds.partitioning(pa.schema([(PARTITION_COLUMN, pa.int16())]), flavor='hive')
+ROWS_PER_GROUP = 64_000
+CATEGORY = pa.dictionary(pa.int32(), pa.string())
+
+# Types of the known source columns; other columns are inferred from the first chunk.
+COLUMN_TYPES = {
+    'Listing_ID': pa.int64(), 'Price': pa.float64(), 'Longitude': pa.float64(), 'Latitude': pa.float64(),
+    **{column: pa.int64() for column in ['Postcode', 'Bedrooms', 'Bathrooms', 'Parking_Spaces', 'Land_Size',
+                                         'Distance_to_CBD', 'Primary_School_Distance', 'Secondary_School_Distance',
+                                         'Primary_School_ICSEA', 'Secondary_School_ICSEA']},
+    'Date_Sold': pa.timestamp('ms'),
+    **{column: CATEGORY for column in ['Address', 'Suburb', 'Property_Type', 'Agency_Name', 'Layout',
+                                       'Primary_School_Name', 'Secondary_School_Name']},
+}
+
+
+def source_hash(csv_path, corrections_path=None):
+    """SHA-256 over the CSV, corrections.csv (if present) and STAGING_VERSION."""
+    digest = hashlib.sha256(f"staging-v{STAGING_VERSION}\n".encode())
+    for path in (csv_path, corrections_path):
+        if path and os.path.exists(path):
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def read_manifest(staging_dir):
+    path = os.path.join(staging_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def staging_schema(chunk):
+    """Arrow schema for the cleaned chunks: COLUMN_TYPES, strings as dictionaries, other numbers as float64."""
+    fields = []
+    for column in chunk.columns:
+        if column == PARTITION_COLUMN:
+            continue
+        if column in COLUMN_TYPES:
+            column_type = COLUMN_TYPES[column]
+        elif pd.api.types.is_bool_dtype(chunk[column]):
+            column_type = pa.bool_()
+        elif pd.api.types.is_numeric_dtype(chunk[column]):
+            column_type = pa.float64()
+        else:
+            column_type = CATEGORY
+        fields.append((column, column_type))
+    return pa.schema(fields + [(PARTITION_COLUMN, pa.int16())])
+
+
+def _cleaned_batches(csv_path, corrections, chunk_size, stats):
+    ids_to_delete, updates = corrections
+    schema = None
+    for chunk in pd.read_csv(csv_path, chunksize=chunk_size):
+        stats['rows_read'] += len(chunk)
+        chunk = clean_chunk(apply_corrections(chunk, ids_to_delete, updates))
+        chunk[PARTITION_COLUMN] = chunk['Date_Sold'].dt.year
+        if schema is None:
+            schema = staging_schema(chunk)
+            yield schema
+        for field in schema:
+            if field.type == CATEGORY:
+                chunk[field.name] = chunk[field.name].astype('category')
+        stats['rows_staged'] += len(chunk)
+        yield from pa.Table.from_pandas(chunk, schema=schema, preserve_index=False).to_batches()
+
+
+def build_staging(csv_path, staging_dir='staging', corrections_path='corrections.csv', chunk_size=100_000,
+                  force=False):
+    """
+    Cleans the CSV into the Parquet staging dataset unless the existing one was built from the same inputs.
+    Returns the manifest (with 'skipped': True if nothing was rebuilt).
+    """
+    content_hash = source_hash(csv_path, corrections_path)
+    manifest = read_manifest(staging_dir)
+    if manifest and manifest['source_hash'] == content_hash and not force:
+        logging.info(f"Staging in {staging_dir} is up to date ({manifest['rows']:,} rows); skipping.")
+        return dict(manifest, skipped=True)
+
+    stats = {'rows_read': 0, 'rows_staged': 0}
+    batches = _cleaned_batches(csv_path, load_corrections(corrections_path), chunk_size, stats)
+    try:
+        schema = next(batches)
+    except (StopIteration, pd.errors.EmptyDataError):
+        raise ValueError(f"{csv_path} has no rows to stage.") from None
+
+    # Build next to the old dataset and swap it in, so readers never see half a dataset.
+    building_dir = staging_dir.rstrip('/') + '.building'
+    old_dir = staging_dir.rstrip('/') + '.old'
+    shutil.rmtree(building_dir, ignore_errors=True)
+    ds.write_dataset(batches, building_dir, schema=schema, format='parquet', partitioning=PARTITIONING,
+                     min_rows_per_group=ROWS_PER_GROUP, max_rows_per_group=4 * ROWS_PER_GROUP,
+                     existing_data_behavior='error')
+    if stats['rows_staged'] == 0:
+        # Only a header, or corrections.csv deleted every row: keep the current dataset.
+        shutil.rmtree(building_dir, ignore_errors=True)
+        raise ValueError(f"{csv_path} has no rows to stage.")
+
+    years = sorted(int(name.split('=')[1]) for name in os.listdir(building_dir) if name.startswith(PARTITION_COLUMN))
+    manifest = {'source': os.path.abspath(csv_path), 'source_hash': content_hash,
+                'staging_version': STAGING_VERSION, 'rows': stats['rows_staged'],
+                'rows_dropped': stats['rows_read'] - stats['rows_staged'], 'years': years,
+                'columns': {field.name: str(field.type) for field in schema},
+                'built_at': datetime.datetime.now().isoformat(timespec='seconds')}
+    with open(os.path.join(building_dir, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    # Two renames: staging_dir is missing only between them, never while the old files are deleted.
+    # Readers that already opened the old files keep reading them (unlinked files stay readable).
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(staging_dir):
+        os.replace(staging_dir, old_dir)
+    os.replace(building_dir, staging_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    logging.info(f"Staged {manifest['rows']:,} rows ({manifest['rows_dropped']} dropped) "
+                 f"into {len(years)} year partitions in {staging_dir}.")
+    return dict(manifest, skipped=False)
+
+
+def open_staging(staging_dir='staging'):
+    """The staging dataset, with memory-mapped file access."""
+    if read_manifest(staging_dir) is None:
+        raise FileNotFoundError(f"No staging dataset in {staging_dir}; run build_staging() first.")
+    return ds.dataset(staging_dir, format='parquet', partitioning=PARTITIONING,
+                      filesystem=pafs.LocalFileSystem(use_mmap=True),
+                      exclude_invalid_files=False, ignore_prefixes=['_', '.'])
+
+
+def _year_filter(years):
+    return None if years is None else ds.field(PARTITION_COLUMN).isin([int(year) for year in years])
+
+
+def read_staging(staging_dir='staging', columns=None, years=None):
+    """
+    Reads the given columns (default: all) of the given sale years (default: all) as a DataFrame.
+    Only the matching partitions and column chunks are read; strings come back as categoricals.
+    """
+    table = open_staging(staging_dir).to_table(columns=columns, filter=_year_filter(years))
+    return table.to_pandas()
+
+
+def iter_staging(staging_dir='staging', columns=None, years=None, batch_size=50_000):
+    """Like read_staging(), in DataFrames of at most batch_size rows."""
+    dataset = open_staging(staging_dir)
+    for batch in dataset.to_batches(columns=columns, filter=_year_filter(years), batch_size=batch_size):
+        if batch.num_rows:
+            yield batch.to_pandas()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Clean the raw property CSV into the Parquet staging dataset.')
+    parser.add_argument('csv_path')
+    parser.add_argument('--staging-dir', default='staging')
+    parser.add_argument('--corrections', default='corrections.csv')
+    parser.add_argument('--chunk-size', type=int, default=100_000, help='CSV rows read per chunk')
+    parser.add_argument('--force', action='store_true', help='rebuild even if the inputs are unchanged')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    build_staging(args.csv_path, args.staging_dir, corrections_path=args.corrections,
+                  chunk_size=args.chunk_size, force=args.force)
+
+
+if __name__ == '__main__':
+    main()
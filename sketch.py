@@ -0,0 +1,65 @@
+# sketch.py - Mergeable price-quantile sketches behind the /compare median and percentile columns
+#
+# A sketch is a log-bucketed histogram of prices (the DDSketch scheme): a price x > 0 is counted in
+# bucket ceil(log(x) / log(GAMMA)) with GAMMA = (1 + ALPHA) / (1 - ALPHA). Bucket i holds the prices
+# in (GAMMA^(i-1), GAMMA^i] and is read back as 2 * GAMMA^i / (GAMMA + 1), which is within ALPHA
+# (relative) of every price in it. So:
+#   - a sketch is just (bucket, count) pairs, and merging sketches is adding counts. That is exact
+#     and order-independent, so any combination of months / suburbs / layouts merges without
+#     accumulating error (unlike t-digest or KLL, whose merges add error);
+#   - the q-quantile read from a sketch is within ALPHA of the exact order statistic
+#     x[floor(q * (n - 1))] of the sketched prices (0-based, sorted), for every q and any n.
+# AGG_Monthly_Price_Sketch (see cube.py) stores one sketch per (month, suburb, layout), one row
+# per non-empty bucket, so the database does the merging with GROUP BY ... SUM(sales_count).
+
+import math
+
+import numpy as np
+
+ALPHA = 0.01  # Guaranteed relative error of every quantile
+GAMMA = (1 + ALPHA) / (1 - ALPHA)
+LOG_GAMMA = math.log(GAMMA)
+
+# Result column -> quantile, in the order they are shown.
+QUANTILE_COLUMNS = {'p25_price': 0.25, 'median_price': 0.5, 'p75_price': 0.75, 'p90_price': 0.9}
+
+# The bucket of a price as a SQL expression (MySQL's LN; the SQLite stand-in registers one).
+# Rounded to 9 decimals first, so that MySQL and NumPy agree on prices that fall right on a bucket edge.
+BUCKET_SQL = f"CEIL(ROUND(LN({{price}}) / {LOG_GAMMA!r}, 9))"
+
+
+def price_bucket(prices):
+    """The bucket of each price (prices must be > 0)."""
+    return np.ceil(np.round(np.log(np.asarray(prices, dtype=np.float64)) / LOG_GAMMA, 9)).astype(np.int64)
+
+
+def bucket_value(buckets):
+    """The value a bucket stands for: within ALPHA of every price counted in it."""
+    return 2 * GAMMA ** np.asarray(buckets, dtype=np.float64) / (GAMMA + 1)
+
+
+def merged_quantiles(group, buckets, counts, quantiles=QUANTILE_COLUMNS):
+    """
+    Reads quantiles from merged sketches. `group` says which sketch each (bucket, count) pair
+    belongs to; the pairs must be sorted by group, then bucket, with counts > 0.
+    Returns {column: array} with one value per group, in the order the groups appear.
+    """
+    group, buckets, counts = np.asarray(group), np.asarray(buckets), np.asarray(counts, dtype=np.int64)
+    if group.size == 0:
+        return {column: np.array([], dtype=np.float64) for column in quantiles}
+    starts = np.flatnonzero(np.r_[True, group[1:] != group[:-1]])
+    cumulative = np.cumsum(counts)
+    before = np.r_[0, cumulative[starts[1:] - 1]]  # Sales in all earlier groups
+    totals = np.add.reduceat(counts, starts)
+    result = {}
+    for column, q in quantiles.items():
+        # The bucket holding the group's value of 0-based rank floor(q * (n - 1)).
+        rank = before + np.floor(q * (totals - 1)).astype(np.int64)
+        result[column] = bucket_value(buckets[np.searchsorted(cumulative, rank, side='right')])
+    return result
+
+
+def exact_quantiles(prices, quantiles=QUANTILE_COLUMNS):
+    """The order statistics the sketch approximates, for checking it against raw prices."""
+    ordered = np.sort(np.asarray(prices, dtype=np.float64))
+    return {column: ordered[int(math.floor(q * (ordered.size - 1)))] for column, q in quantiles.items()}
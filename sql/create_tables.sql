@@ -9,6 +9,9 @@
 
 -- Drop tables in reverse order of dependency to avoid foreign key constraint errors.
 -- FACT_Properties depends on all DIM tables, so it must be dropped first.
+-- The AGG_ tables are derived from FACT_Properties and are rebuilt by the ETL after every load.
+DROP TABLE IF EXISTS AGG_Monthly_Price_Sketch;
+DROP TABLE IF EXISTS AGG_Monthly_Sales;
 DROP TABLE IF EXISTS FACT_Properties;
 DROP TABLE IF EXISTS DIM_Layouts;
 DROP TABLE IF EXISTS DIM_Suburbs;
@@ -17,6 +20,26 @@ DROP TABLE IF EXISTS DIM_Primary_Schools;
 DROP TABLE IF EXISTS DIM_Secondary_Schools;
 
 
+-- Data version counter. Every load (full ETL, incremental upsert, web writes) increments it, and the
+-- web app folds it into its cache keys and ETags. It is deliberately NOT dropped above, so the
+-- version keeps increasing across full rebuilds and never repeats an old value.
+CREATE TABLE IF NOT EXISTS META_Data_Version (
+    id TINYINT PRIMARY KEY,
+    version BIGINT NOT NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+);
+INSERT IGNORE INTO META_Data_Version (id, version) VALUES (1, 1);
+
+-- The months each data version changed, written by catalog.bump_data_version() in the same transaction.
+-- A NULL sale_month means anything may have changed (e.g. a full ETL run). The web app's in-memory
+-- stores use it to reload only the changed months. Kept across rebuilds like META_Data_Version.
+CREATE TABLE IF NOT EXISTS META_Data_Changes (
+    version BIGINT NOT NULL,
+    sale_month DATE,                                -- First day of the month, NULL for everything
+    INDEX idx_changes_version (version)
+);
+
+
 -- Dimension Table for property layouts (Bedrooms & Bathrooms combination)
 CREATE TABLE DIM_Layouts (
     layout_id INTEGER PRIMARY KEY AUTO_INCREMENT, -- Use SERIAL for PostgreSQL
@@ -77,10 +100,56 @@ CREATE TABLE FACT_Properties (
     primary_school_id INTEGER,
     secondary_school_id INTEGER,
     
+    -- Composite indexes meant for the app's access patterns. Routes filter dates with half-open
+    -- ranges (date_sold >= start AND date_sold < end), which keep date_sold usable by them; the
+    -- plans MySQL picks are unverified until scripts/check_query_plans.py has been run.
+    -- The suburb and layout indexes also serve as the indexes for their foreign keys.
+    INDEX idx_fact_suburb_date (suburb_id, date_sold),   -- /explore, /compare, /trend by suburb
+    INDEX idx_fact_layout_date (layout_id, date_sold),   -- Layout filters
+    INDEX idx_fact_date_price (date_sold, price),        -- Year-only filters, covers price stats
+    INDEX idx_fact_type_date (property_type, date_sold), -- /trend by property type
+    
     -- Defining the relationships
     FOREIGN KEY (suburb_id) REFERENCES DIM_Suburbs(suburb_id),
     FOREIGN KEY (agency_id) REFERENCES DIM_Agencies(agency_id),
     FOREIGN KEY (layout_id) REFERENCES DIM_Layouts(layout_id),
     FOREIGN KEY (primary_school_id) REFERENCES DIM_Primary_Schools(primary_school_id),
     FOREIGN KEY (secondary_school_id) REFERENCES DIM_Secondary_Schools(secondary_school_id)
+);
+
+-- Pre-aggregated monthly cube, one row per (month, suburb, layout, property type).
+-- Stores count, sum(price) and sum(price^2) so averages and variances can be rolled up
+-- to any coarser grain (year, postcode, all layouts ...) without touching FACT_Properties.
+-- Populated and incrementally refreshed by cube.refresh_monthly_cube() in the ETL.
+CREATE TABLE AGG_Monthly_Sales (
+    sale_month DATE NOT NULL,                       -- First day of the month
+    sale_year SMALLINT NOT NULL,
+    suburb_id INTEGER NOT NULL,
+    postcode INTEGER,                               -- Denormalised from DIM_Suburbs for postcode trends
+    layout_id INTEGER NOT NULL,                     -- 0 stands for a sale without a layout
+    property_type VARCHAR(50) NOT NULL DEFAULT '',  -- '' stands for an unknown property type
+    sales_count INTEGER NOT NULL,
+    price_sum DECIMAL(20, 2) NOT NULL,
+    price_sq_sum DOUBLE NOT NULL,
+
+    PRIMARY KEY (sale_month, suburb_id, layout_id, property_type),
+    INDEX idx_agg_suburb_month (suburb_id, sale_month),
+    INDEX idx_agg_postcode_month (postcode, sale_month),
+    INDEX idx_agg_year_suburb (sale_year, suburb_id)
+);
+
+-- Price sketches for medians and percentiles, one per (month, suburb, layout), stored as one row per
+-- non-empty price bucket (see sketch.py). A sketch at any coarser grain is the SUM(sales_count) of
+-- its buckets, with every quantile within 1% of the exact value.
+-- Populated and refreshed together with AGG_Monthly_Sales by cube.refresh_monthly_cube().
+CREATE TABLE AGG_Monthly_Price_Sketch (
+    sale_month DATE NOT NULL,                       -- First day of the month
+    sale_year SMALLINT NOT NULL,
+    suburb_id INTEGER NOT NULL,
+    layout_id INTEGER NOT NULL,
+    price_bucket SMALLINT NOT NULL,                 -- CEIL(LN(price) / LN(GAMMA))
+    sales_count INTEGER NOT NULL,
+
+    PRIMARY KEY (sale_month, suburb_id, layout_id, price_bucket),
+    INDEX idx_sketch_year_suburb (sale_year, suburb_id)
 );
\ No newline at end of file
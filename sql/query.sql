@@ -44,7 +44,7 @@ stats_2020 AS (
     JOIN
         DIM_Suburbs s ON p.suburb_id = s.suburb_id
     WHERE
-        YEAR(p.date_sold) = 2020
+        p.date_sold >= '2020-01-01' AND p.date_sold < '2021-01-01' -- Sargable form of YEAR(p.date_sold) = 2020
     GROUP BY
         s.suburb_id, s.suburb_name
 ),
@@ -60,7 +60,7 @@ stats_2024 AS (
     JOIN
         DIM_Suburbs s ON p.suburb_id = s.suburb_id
     WHERE
-        YEAR(p.date_sold) = 2024
+        p.date_sold >= '2024-01-01' AND p.date_sold < '2025-01-01' -- Sargable form of YEAR(p.date_sold) = 2024
     GROUP BY
         s.suburb_id
 )
@@ -0,0 +1,105 @@
+# timeseries.py - Builds the /trend chart series from monthly (series, month, count, price sum) cells
+#
+# Both backends reduce the sales to one cell per (series, month) first: the SQL path with a
+# GROUP BY on the cube or the fact table, the in-memory path with np.bincount. Everything after
+# that is done here, on arrays of O(series x months), so the work and the payload depend on the
+# number of points drawn, never on the number of sales:
+#   - optional smoothing over a trailing window of `window` calendar months:
+#       'mean'   the average price of all sales in the window (sum of prices / number of sales),
+#       'median' the median of the window's monthly average prices (months without sales skipped);
+#   - every point carries its month's sales count, the volume series;
+#   - each series is cut down to at most `max_points` points with Largest-Triangle-Three-Buckets
+#     (Steinarsson, 2013), which keeps the first and last month and the peaks and troughs that
+#     shape the line, instead of every n-th month.
+
+import numpy as np
+
+SMOOTHING = ('mean', 'median')
+DEFAULT_MAX_POINTS = 200
+
+
+def month_label(month_index):
+    """year * 12 + (month - 1) -> 'YYYY-MM'."""
+    year, month = divmod(int(month_index), 12)
+    return f"{year:04d}-{month + 1:02d}"
+
+
+def lttb(x, y, max_points):
+    """The indices of at most `max_points` points of (x, y) that keep the line's shape (x ascending)."""
+    n = len(x)
+    if max_points >= n or max_points < 3:
+        return list(range(n))
+    # Plain Python: a series has a few hundred months, where per-call NumPy overhead would dominate.
+    x, y = [float(v) for v in x], [float(v) for v in y]
+    every = (n - 2) / (max_points - 2)
+    picked = [0]
+    a = 0
+    for i in range(max_points - 2):
+        start, end = int(i * every) + 1, int((i + 1) * every) + 1
+        # The next bucket's average point (the last point, for the last bucket).
+        next_end = min(int((i + 2) * every) + 1, n)
+        next_x = sum(x[end:next_end]) / (next_end - end)
+        next_y = sum(y[end:next_end]) / (next_end - end)
+        # Keep the point forming the largest triangle with the previously kept point and that average.
+        ax, ay = x[a], y[a]
+        a = max(range(start, end), key=lambda j: abs((ax - next_x) * (y[j] - ay) - (ax - x[j]) * (next_y - ay)))
+        picked.append(a)
+    picked.append(n - 1)
+    return picked
+
+
+def _trailing_sums(grid, window):
+    """Sum over the trailing `window` months of every cell of a (series, months) grid."""
+    cumulative = np.cumsum(np.pad(grid, ((0, 0), (1, 0))), axis=1)
+    start = np.maximum(np.arange(grid.shape[1]) + 1 - window, 0)
+    return cumulative[:, 1:] - cumulative[:, start]
+
+
+def build_series(keys, series, months, counts, sums, smooth=None, window=3, max_points=DEFAULT_MAX_POINTS):
+    """
+    Builds the chart data from monthly cells. Cell i belongs to series `series[i]` (an index into
+    `keys`), month `months[i]` (year * 12 + month - 1) and holds `counts[i]` sales with prices
+    summing to `sums[i]`. Returns {'series': [{'key', 'months', 'points'}]}, one entry per key with
+    sales, where points are [month label, price, sales count] and 'months' is the number of months
+    before downsampling; or None when there are no sales at all.
+    """
+    series, months = np.asarray(series, dtype=np.int64), np.asarray(months, dtype=np.int64)
+    counts, sums = np.asarray(counts, dtype=np.float64), np.asarray(sums, dtype=np.float64)
+    keep = counts > 0
+    series, months, counts, sums = series[keep], months[keep], counts[keep], sums[keep]
+    if series.size == 0:
+        return None
+
+    # A dense (series, month) grid: at most series x months cells, whatever the number of sales.
+    first = months.min()
+    shape = (len(keys), int(months.max() - first) + 1)
+    count_grid = np.zeros(shape)
+    sum_grid = np.zeros(shape)
+    np.add.at(count_grid, (series, months - first), counts)
+    np.add.at(sum_grid, (series, months - first), sums)
+    has_sales = count_grid > 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        value_grid = sum_grid / count_grid
+
+    if smooth == 'mean':
+        with np.errstate(invalid='ignore', divide='ignore'):
+            value_grid = _trailing_sums(sum_grid, window) / _trailing_sums(count_grid, window)
+    elif smooth == 'median':
+        # Each month's trailing window of monthly averages; a month with sales never has an all-NaN window.
+        padded = np.pad(value_grid, ((0, 0), (window - 1, 0)), constant_values=np.nan)
+        windows = np.lib.stride_tricks.sliding_window_view(padded, window, axis=1)
+        smoothed = np.full(shape, np.nan)
+        smoothed[has_sales] = np.nanmedian(windows[has_sales], axis=-1)
+        value_grid = smoothed
+
+    result = []
+    for i, key in enumerate(keys):
+        offsets = np.flatnonzero(has_sales[i])
+        if offsets.size == 0:
+            continue
+        values = value_grid[i, offsets]
+        picked = lttb(offsets.astype(np.float64), values, max_points)
+        result.append({'key': key, 'months': int(offsets.size),
+                       'points': [[month_label(first + offsets[j]), round(float(values[j]), 2),
+                                   int(count_grid[i, offsets[j]])] for j in picked]})
+    return {'series': result}
@@ -0,0 +1,457 @@
+# write_queue.py - Durable write path for /add: a local write-ahead queue flushed to FACT_Properties in batches
+#
+# /add never writes to MySQL inside the request. A submitted sale is committed to a local SQLite file
+# (WAL mode, synchronous=FULL, shared by every worker process on the host) and the request returns.
+# A background thread in each worker flushes pending sales to FACT_Properties with multi-row INSERTs;
+# a lease row in the queue file makes sure only one worker flushes at a time. Every batch is inserted,
+# its cube months refreshed and the data version bumped (naming those months) in one transaction;
+# each worker picks the new sales up at its next data version check.
+# - Flushed sales stay in the queue (status 'flushed') for a retention period, so the queue's
+#   primary key rejects a listing_id submitted twice through any worker, even after its flush.
+# - A batch the database rejects is retried row by row; bad rows are marked 'failed' with the
+#   error, so one bad sale can't block the queue. If the database is down, sales wait in the queue.
+# - While the database is down the dimension catalog may be empty, so the suburb and layout can't
+#   be checked in the request. The sale is queued anyway; the writer checks them before inserting
+#   and marks sales with unknown ones 'failed'.
+# - Listing ids already in FACT_Properties are caught before queueing by ListingIndex, a Bloom
+#   filter over the fact table's listing_ids (a hit is confirmed with a primary key lookup).
+
+import datetime
+import json
+import logging
+import math
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+import numpy as np
+from sqlalchemy import bindparam, text
+from sqlalchemy.exc import DataError, IntegrityError
+
+from catalog import bump_data_version
+from cube import refresh_monthly_cube
+
+# FACT_Properties columns a submitted sale can fill (the rest stay NULL).
+RECORD_COLUMNS = ['listing_id', 'price', 'address', 'property_type', 'date_sold', 'land_size', 'parking_spaces',
+                  'suburb_id', 'layout_id', 'agency_id', 'primary_school_id', 'secondary_school_id']
+
+INSERT_RECORD_SQL = (f"INSERT INTO FACT_Properties ({', '.join(RECORD_COLUMNS)}) "
+                     f"VALUES ({', '.join(':' + column for column in RECORD_COLUMNS)})")
+
+QUEUE_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS write_queue (
+        listing_id INTEGER PRIMARY KEY,
+        record TEXT NOT NULL,                    -- JSON with the RECORD_COLUMNS
+        status TEXT NOT NULL DEFAULT 'pending',  -- pending | flushed | failed
+        queued_at REAL NOT NULL,
+        flushed_at REAL,
+        error TEXT)""",
+    "CREATE INDEX IF NOT EXISTS idx_write_queue_status ON write_queue (status, queued_at)",
+    "CREATE TABLE IF NOT EXISTS writer_lease (id INTEGER PRIMARY KEY CHECK (id = 1), owner TEXT, expires_at REAL)",
+]
+
+
+class DuplicateListing(Exception):
+    """The listing_id is already in the database or the write queue."""
+
+
+def record_from_form(form, dimensions):
+    """
+    Validates an /add form and returns the sale as a record dict. The suburb and layout are checked
+    against the dimension snapshot when one is loaded; otherwise the writer checks them (see
+    BatchWriter._reject_unknown_dimensions).
+    """
+    listing_id_str = form.get('listing_id', '').strip()
+    if not listing_id_str.isdigit() or len(listing_id_str) < 9:
+        raise ValueError("Listing ID must be at least 9 digits long.")
+    try:
+        price = float(form.get('price', ''))
+    except ValueError:
+        raise ValueError("Price must be a number.")
+    if not math.isfinite(price) or price <= 0:
+        raise ValueError("Price must be greater than zero.")
+    try:
+        date_sold = datetime.date.fromisoformat(form.get('date_sold', '').strip())
+    except ValueError:
+        raise ValueError("Date Sold must be a date (YYYY-MM-DD).")
+    address = form.get('address', '').strip()
+    if not address:
+        raise ValueError("Address is required.")
+
+    def optional_int(name):
+        value = form.get(name, '').strip()
+        if not value:
+            return None
+        if not value.isdigit():
+            raise ValueError(f"{name.replace('_', ' ').title()} must be a whole number.")
+        return int(value)
+
+    record = {
+        'listing_id': int(listing_id_str),
+        'price': price,
+        'address': address,
+        'property_type': form.get('property_type') or None,
+        'date_sold': date_sold.isoformat(),
+        'land_size': optional_int('land_size'),
+        'parking_spaces': optional_int('parking_spaces'),
+        'suburb_id': optional_int('suburb_id'),
+        'layout_id': optional_int('layout_id'),
+        'agency_id': optional_int('agency_id'),
+        'primary_school_id': optional_int('primary_school_id'),
+        'secondary_school_id': optional_int('secondary_school_id'),
+    }
+    # An unloaded catalog (version None, the database is down) has no names to check against.
+    catalog_loaded = dimensions.version is not None
+    if record['suburb_id'] is None or (catalog_loaded and record['suburb_id'] not in dimensions.suburb_names):
+        raise ValueError("Please select a suburb from the list.")
+    if record['layout_id'] is None or (catalog_loaded and record['layout_id'] not in dimensions.layout_names):
+        raise ValueError("Please select a layout from the list.")
+    return record
+
+
+class WriteQueue:
+    """
+    The queue file. Each thread of each process gets its own SQLite connection to it.
+    Like LazyEngine, nothing is opened on construction: the file is created by the first enqueue(),
+    so importing the app (scripts, benchmarks, the notebook) leaves no queue file behind.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def exists(self):
+        """False until the first sale is queued; there is nothing to read or flush before that."""
+        return os.path.exists(self.path)
+
+    def _connect(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            # Autocommit; explicit BEGIN IMMEDIATE where a read-then-write must be atomic.
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=FULL")  # Acknowledged sales survive a power loss
+            for statement in QUEUE_SCHEMA:
+                connection.execute(statement)
+            self._local.connection, self._local.pid = connection, os.getpid()
+        return connection
+
+    def enqueue(self, record):
+        """Durably queues a sale. Raises DuplicateListing if its listing_id was queued before."""
+        try:
+            self._connect().execute(
+                "INSERT INTO write_queue (listing_id, record, queued_at) VALUES (?, ?, ?)",
+                (record['listing_id'], json.dumps(record), time.time()))
+        except sqlite3.IntegrityError:
+            raise DuplicateListing(f"Listing ID {record['listing_id']} has already been submitted.")
+
+    def pending(self, limit):
+        """The oldest pending sales, as (listing_id, record) pairs."""
+        rows = self._connect().execute(
+            "SELECT listing_id, record FROM write_queue WHERE status = 'pending' ORDER BY queued_at LIMIT ?",
+            (limit,)).fetchall()
+        return [(listing_id, json.loads(record)) for listing_id, record in rows]
+
+    def mark_flushed(self, listing_ids):
+        connection = self._connect()
+        with connection:  # Commits, or rolls back on an error
+            connection.execute("BEGIN IMMEDIATE")
+            connection.executemany("UPDATE write_queue SET status = 'flushed', flushed_at = ?, error = NULL "
+                                   "WHERE listing_id = ?", [(time.time(), i) for i in listing_ids])
+
+    def mark_failed(self, listing_id, error):
+        self._connect().execute("UPDATE write_queue SET status = 'failed', error = ? WHERE listing_id = ?",
+                                (str(error)[:500], listing_id))
+
+    def prune(self, retention_seconds):
+        """Forgets flushed sales older than the retention period (their ids are in FACT_Properties by then)."""
+        cursor = self._connect().execute("DELETE FROM write_queue WHERE status = 'flushed' AND flushed_at < ?",
+                                         (time.time() - retention_seconds,))
+        return cursor.rowcount
+
+    def acquire_lease(self, owner, ttl):
+        """Makes `owner` the only flusher for `ttl` seconds; False while another live owner holds it."""
+        connection = self._connect()
+        now = time.time()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute("SELECT owner, expires_at FROM writer_lease WHERE id = 1").fetchone()
+            if row is not None and row[0] != owner and row[1] > now:
+                return False
+            connection.execute("INSERT OR REPLACE INTO writer_lease (id, owner, expires_at) VALUES (1, ?, ?)",
+                               (owner, now + ttl))
+            return True
+
+    def release_lease(self, owner):
+        self._connect().execute("DELETE FROM writer_lease WHERE id = 1 AND owner = ?", (owner,))
+
+    def recent(self, limit=20):
+        """The latest submissions with their status, newest first, for the /add page."""
+        if not self.exists():
+            return []
+        rows = self._connect().execute(
+            "SELECT record, status, error FROM write_queue ORDER BY queued_at DESC LIMIT ?", (limit,)).fetchall()
+        return [{**json.loads(record), 'status': status, 'error': error} for record, status, error in rows]
+
+    def stats(self):
+        if not self.exists():
+            return {'pending': 0, 'flushed': 0, 'failed': 0, 'oldest_pending_seconds': 0.0}
+        connection = self._connect()
+        counts = dict(connection.execute("SELECT status, COUNT(*) FROM write_queue GROUP BY status").fetchall())
+        oldest = connection.execute("SELECT MIN(queued_at) FROM write_queue WHERE status = 'pending'").fetchone()[0]
+        return {'pending': counts.get('pending', 0), 'flushed': counts.get('flushed', 0),
+                'failed': counts.get('failed', 0),
+                'oldest_pending_seconds': round(time.time() - oldest, 3) if oldest else 0.0}
+
+
+def _mix64(x):
+    """splitmix64's finalizer: a fast, well-spread 64-bit hash of uint64 values."""
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+class ListingIndex:
+    """
+    A Bloom filter over FACT_Properties.listing_id: a membership test costs `n_hashes` bit lookups and
+    no query. A miss is certain; a hit (a duplicate, or a false positive at `false_positive_rate`) is
+    confirmed with a primary key lookup. Sized with `headroom` for ids added after the build.
+    The filter is only built for a worker that serves /add: exists() asks the database while there
+    is no filter, or it is older than `max_age` seconds (it may miss sales loaded by the ETL), and
+    flags it as wanted; the writer thread then builds it off the request path (see needs_build()).
+    """
+
+    def __init__(self, engine, false_positive_rate=0.001, headroom=2.0, max_age=600):
+        self.engine = engine
+        self.false_positive_rate = false_positive_rate
+        self.headroom = headroom
+        self.max_age = max_age
+        self._filter = None  # (bits, n_bits, n_hashes, built_at)
+        self._lock = threading.Lock()
+        self._wanted = False
+        self.stats = {'builds': 0, 'ids': 0, 'checks': 0, 'db_confirmations': 0, 'false_positives': 0}
+
+    def build(self, chunk_size=200_000):
+        """Reads every listing_id and swaps in a new filter."""
+        with self.engine.connect() as connection:
+            count = connection.execute(text("SELECT COUNT(*) FROM FACT_Properties")).scalar() or 0
+            capacity = max(int(count * self.headroom), 10_000)
+            n_bits = int(math.ceil(-capacity * math.log(self.false_positive_rate) / math.log(2) ** 2))
+            n_hashes = max(1, round(n_bits / capacity * math.log(2)))
+            bits = np.zeros(n_bits, dtype=bool)
+            result = connection.execution_options(stream_results=True).execute(
+                text("SELECT listing_id FROM FACT_Properties"))
+            while True:
+                rows = result.fetchmany(chunk_size)
+                if not rows:
+                    break
+                ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+                bits[self._positions(ids, n_bits, n_hashes).ravel()] = True
+        with self._lock:
+            self._filter = (np.packbits(bits, bitorder='little'), n_bits, n_hashes, time.monotonic())
+            self._wanted = False
+        self.stats['builds'] += 1
+        self.stats['ids'] = count
+        logging.info(f"Built listing_id filter: {count:,} ids, {n_bits / 8 / 2**20:.1f} MiB, {n_hashes} hashes.")
+
+    @staticmethod
+    def _positions(ids, n_bits, n_hashes):
+        # Double hashing: bit i of an id is h1 + i * h2 (Kirsch & Mitzenmacher).
+        ids = np.asarray(ids, dtype=np.int64).astype(np.uint64)
+        h1 = _mix64(ids)
+        h2 = _mix64(h1) | np.uint64(1)
+        steps = np.arange(n_hashes, dtype=np.uint64)
+        return (h1[:, None] + steps[None, :] * h2[:, None]) % np.uint64(n_bits)
+
+    def is_stale(self):
+        return self._filter is None or time.monotonic() - self._filter[3] > self.max_age
+
+    def needs_build(self):
+        """True once exists() found the filter missing or stale; workers that never serve /add never scan."""
+        return self._wanted
+
+    def add(self, listing_ids):
+        """Records ids that were just written, so they are caught before the next rebuild."""
+        with self._lock:
+            if self._filter is None:
+                return
+            packed, n_bits, n_hashes, _ = self._filter
+            positions = self._positions(listing_ids, n_bits, n_hashes).ravel()
+            np.bitwise_or.at(packed, positions >> np.uint64(3),
+                             (np.uint8(1) << (positions & np.uint64(7)).astype(np.uint8)))
+
+    def might_contain(self, listing_id):
+        packed, n_bits, n_hashes, _ = self._filter
+        positions = self._positions([listing_id], n_bits, n_hashes)[0]
+        return bool(np.all((packed[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1))
+
+    def exists(self, listing_id):
+        """True if the listing_id is in FACT_Properties."""
+        self.stats['checks'] += 1
+        stale = self.is_stale()
+        if stale:
+            self._wanted = True
+        elif not self.might_contain(listing_id):
+            return False
+        # A filter hit, or no fresh filter: ask the database (a primary key lookup).
+        self.stats['db_confirmations'] += 1
+        with self.engine.connect() as connection:
+            found = connection.execute(text("SELECT 1 FROM FACT_Properties WHERE listing_id = :id"),
+                                       {'id': listing_id}).first() is not None
+        if not found and not stale:
+            self.stats['false_positives'] += 1
+        return found
+
+    def memory_bytes(self):
+        return int(self._filter[0].nbytes) if self._filter is not None else 0
+
+
+class BatchWriter:
+    """
+    The background thread that drains the queue into FACT_Properties, `batch_size` sales per
+    transaction, waking every `interval` seconds.
+    """
+
+    def __init__(self, queue, engine, index, batch_size=2000, interval=1.0, retention=86400):
+        self.queue = queue
+        self.engine = engine
+        self.index = index
+        self.batch_size = batch_size
+        self.interval = interval
+        self.retention = retention
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self.stats = {'batches': 0, 'flushed': 0, 'failed': 0, 'errors': 0, 'last_error': None,
+                      'last_batch_ms': 0.0}
+
+    @property
+    def owner(self):
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def ensure_running(self):
+        """Starts this process's writer thread (threads don't survive a fork, so once per process)."""
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._thread = threading.Thread(target=self._run, name='batch-writer', daemon=True)
+                self._pid = os.getpid()
+                self._thread.start()
+
+    def notify(self):
+        """Wakes the writer early (it still flushes whatever has queued up by then, in batches)."""
+        self._wake.set()
+
+    def _run(self):
+        backoff = self.interval
+        last_prune = 0.0
+        while True:
+            self._wake.wait(backoff)
+            self._wake.clear()
+            try:
+                if self.index.needs_build():
+                    self.index.build()
+                self.flush()
+                if time.monotonic() - last_prune > 3600 and self.queue.exists():
+                    self.queue.prune(self.retention)
+                    last_prune = time.monotonic()
+                backoff = self.interval
+            except Exception as e:
+                # Most likely the database is unreachable: the sales stay queued, retry with backoff.
+                self.stats['errors'] += 1
+                self.stats['last_error'] = str(e)
+                logging.error(f"Batch writer failed, retrying in {min(backoff * 2, 30):g}s: {e}")
+                backoff = min(backoff * 2, 30)
+
+    def flush(self):
+        """Writes every pending sale, batch by batch, if this process holds the lease. Returns the rows written."""
+        written = 0
+        if not self.queue.exists():
+            return written
+        while self.queue.acquire_lease(self.owner, ttl=max(30, self.interval * 10)):
+            batch = self.queue.pending(self.batch_size)
+            if not batch:
+                break
+            start = time.perf_counter()
+            batch = self._reject_unknown_dimensions(batch)
+            if not batch:
+                continue
+            try:
+                flushed = self._write_batch([record for _, record in batch])
+            except Exception as e:
+                if not _is_data_error(e):
+                    raise
+                logging.warning(f"Batch of {len(batch)} rejected ({e}); writing its sales one by one.")
+                flushed = self._write_rows_individually(batch)
+            if flushed:
+                self.queue.mark_flushed(flushed)
+                self.index.add(flushed)
+            self.stats['batches'] += 1
+            self.stats['flushed'] += len(flushed)
+            self.stats['last_batch_ms'] = (time.perf_counter() - start) * 1000
+            written += len(flushed)
+        return written
+
+    def _reject_unknown_dimensions(self, batch):
+        """Marks sales whose suburb or layout is not in the database 'failed'; returns the rest."""
+        checks = [('suburb_id', "SELECT suburb_id FROM DIM_Suburbs WHERE suburb_id IN :ids"),
+                  ('layout_id', "SELECT layout_id FROM DIM_Layouts WHERE layout_id IN :ids")]
+        known = {}
+        with self.engine.connect() as connection:
+            for column, query in checks:
+                ids = sorted({record[column] for _, record in batch})
+                statement = text(query).bindparams(bindparam('ids', expanding=True))
+                known[column] = {row[0] for row in connection.execute(statement, {'ids': ids})}
+        valid = []
+        for listing_id, record in batch:
+            unknown = [column for column, _ in checks if record[column] not in known[column]]
+            if unknown:
+                error = ', '.join(f"unknown {column} {record[column]}" for column in unknown)
+                self.queue.mark_failed(listing_id, error)
+                self.stats['failed'] += 1
+                logging.error(f"Could not write listing {listing_id}: {error}")
+            else:
+                valid.append((listing_id, record))
+        return valid
+
+    def _write_batch(self, records):
+        """Inserts the sales, refreshes their cube months and bumps the data version, in one transaction."""
+        months = {record['date_sold'] for record in records}
+        with self.engine.begin() as connection:
+            connection.execute(text(INSERT_RECORD_SQL), records)
+            refresh_monthly_cube(connection, months)
+            bump_data_version(connection, months)
+        return [record['listing_id'] for record in records]
+
+    def _write_rows_individually(self, batch):
+        flushed = []
+        for listing_id, record in batch:
+            try:
+                flushed += self._write_batch([record])
+            except Exception as e:
+                if not _is_data_error(e):
+                    raise
+                if self._already_written(record):
+                    # Written by an earlier flush that stopped before marking it (e.g. a crash).
+                    flushed.append(listing_id)
+                    continue
+                self.queue.mark_failed(listing_id, e)
+                self.stats['failed'] += 1
+                logging.error(f"Could not write listing {listing_id}: {e}")
+        return flushed
+
+    def _already_written(self, record):
+        with self.engine.connect() as connection:
+            row = connection.execute(text("SELECT price, address FROM FACT_Properties WHERE listing_id = :id"),
+                                     {'id': record['listing_id']}).first()
+        return row is not None and float(row[0]) == record['price'] and row[1] == record['address']
+
+
+def _is_data_error(error):
+    """True for errors caused by the rows themselves (duplicate key, bad foreign key), not the connection."""
+    return isinstance(error, (IntegrityError, DataError))